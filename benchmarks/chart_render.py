@@ -0,0 +1,79 @@
+"""Время и память отрисовки графиков: matplotlib против raster
+
+Каждый способ меряется в отдельном процессе, как в пуле отрисовки бота:
+подготовка (импорт matplotlib и заготовка фигуры), первый и последующие
+графики активности за 30 дней и тепловые карты, пиковая память процесса.
+
+    python benchmarks/chart_render.py [графиков]
+"""
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from common import import_bot, timed
+
+BACKENDS = ('matplotlib', 'raster')
+
+
+def peak_rss_mb() -> float:
+    # В Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(backend: str, charts: int) -> dict:
+    """Замеры одного способа отрисовки в текущем процессе"""
+    bot = import_bot()
+    base_mb = peak_rss_mb()
+
+    started = time.perf_counter()
+    if backend == 'matplotlib':
+        bot._init_chart_worker()
+    setup = time.perf_counter() - started
+
+    dates, counts = [], []
+    for offset in range(30):
+        dates.append(bot.day_string(bot.utc_today() - 29 + offset))
+        counts.append((offset * 37) % 50)
+    grid = [(hour * 13) % 40 for hour in range(7 * 24)]
+    render_activity, render_heatmap = (
+        bot.CHART_KINDS[kind][BACKENDS.index(backend)] for kind in ('activity', 'heatmap')
+    )
+
+    started = time.perf_counter()
+    png = render_activity(dates, counts, 'Активность')
+    first = time.perf_counter() - started
+    activity = timed(render_activity, dates, counts, 'Активность', repeat=charts)
+    heatmap = timed(render_heatmap, grid, 'Активность по часам', repeat=charts)
+    return {
+        'setup': setup, 'first': first, 'activity': activity, 'heatmap': heatmap,
+        'png_kb': len(png) / 1024, 'base_mb': base_mb, 'peak_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        print(json.dumps(measure(sys.argv[2], int(sys.argv[3]))))
+        return 0
+
+    charts = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f"{'способ':>10} {'подготовка':>11} {'первый':>9} {'активность':>11} {'карта':>9} "
+          f"{'PNG':>8} {'память':>14}")
+    for backend in BACKENDS:
+        result = subprocess.run(
+            [sys.executable, __file__, '--child', backend, str(charts)],
+            capture_output=True, text=True
+        )
+        if result.returncode:
+            print(f"{backend:>10} не удалось: {result.stderr.strip().splitlines()[-1]}")
+            continue
+        r = json.loads(result.stdout.splitlines()[-1])
+        print(f"{backend:>10} {r['setup'] * 1000:8.0f} мс {r['first'] * 1000:6.0f} мс "
+              f"{r['activity'] * 1000:8.1f} мс {r['heatmap'] * 1000:6.1f} мс {r['png_kb']:5.0f} КБ "
+              f"+{r['peak_mb'] - r['base_mb']:5.0f} из {r['peak_mb']:4.0f} МБ")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Время отчёта /chatstats по ActivityMatrix на 50 000 пользователей x 365 дней
+
+Требование: report() укладывается в 100 мс на полном окне.
+
+    python benchmarks/chat_stats.py [пользователей] [дней]
+"""
+import sys
+import time
+from array import array
+
+import numpy as np
+
+from common import import_bot, timed
+
+bot = import_bot()
+
+BUDGET_MS = 100
+
+
+def make_stats(users: int, window: int, today: int) -> dict:
+    """Синтетическая статистика: у каждого пользователя до window дней редкой активности"""
+    rng = np.random.default_rng(1)
+    stats = {}
+    for user_id in range(users):
+        length = int(rng.integers(1, window + 1))
+        start = today - int(rng.integers(length - 1, window + 90))
+        counts = rng.poisson(0.7, length).astype(np.uint32)
+        activity = array('I')
+        activity.frombytes(counts.tobytes())
+        stats[str(user_id)] = {
+            'full_name': f'User {user_id}',
+            'first_seen': bot.day_string(start),
+            'total_messages': int(counts.sum()),
+            'activity': bot.DailyActivity(start, activity)
+        }
+    return stats
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+    today = bot.utc_today()
+    stats = make_stats(users, window, today)
+
+    matrix = bot.ActivityMatrix(window)
+    started = time.perf_counter()
+    matrix.load(stats, today)
+    load_ms = (time.perf_counter() - started) * 1000
+
+    print(f"Пользователей: {users}, дней: {window}, матрица {matrix.counts.nbytes / 1024 / 1024:.1f} МБ")
+    print(f"построение при запуске: {load_ms:8.1f} мс")
+    worst = 0
+    for days in (7, 30, 90, window):
+        elapsed = timed(matrix.report, days) * 1000
+        worst = max(worst, elapsed)
+        print(f"report({days:>3}):            {elapsed:8.1f} мс")
+    print(f"{'уложились' if worst < BUDGET_MS else 'превышен'} бюджет {BUDGET_MS} мс")
+    return 0 if worst < BUDGET_MS else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Общая подготовка бенчмарков: окружение бота и поддельные сообщения
+
+bot.py читает конфигурацию и создаёт файлы состояния при импорте,
+поэтому переменные окружения и рабочий каталог задаются до импорта,
+как в tests/conftest.py.
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_bot():
+    """Модуль бота с рабочим каталогом во временной папке"""
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCH-TOKEN')
+    os.environ.setdefault('ADMIN_CHAT_ID', '-1000')
+    os.chdir(tempfile.mkdtemp(prefix='moderation-bot-bench-'))
+    logging.getLogger('bot').setLevel(logging.WARNING)
+    import bot
+    return bot
+
+
+def timed(func, *args, repeat: int = 5) -> float:
+    """Лучшее время вызова из repeat попыток, в секундах"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f'user{user_id}'
+        self.full_name = f'User {user_id}'
+
+    def mention_html(self) -> str:
+        return self.full_name
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class FakeMessage:
+    """Сообщение с полями, которые читают проверки бота, без обращений к сети"""
+
+    def __init__(self, user: FakeUser, chat_id: int, text: str = None, entities: list = None,
+                 caption: str = None, document=None, reply_markup=None):
+        self.from_user = user
+        self.chat = FakeChat(chat_id)
+        self.message_id = random.randrange(1, 1 << 31)
+        self.text = text
+        self.entities = entities
+        self.caption = caption
+        self.caption_entities = None
+        self.document = document
+        self.reply_markup = reply_markup
+        self.date = datetime.now(timezone.utc)
+
+    async def answer(self, text, **kwargs):
+        return self
+
+
+def patch_network(bot):
+    """Заглушки сетевых вызовов: бенчмарк меряет только работу бота"""
+    async def no_call(*args, **kwargs):
+        return []
+
+    bot.bot.restrict_chat_member = no_call
+    bot.admin_roster.get = no_call
+    bot.delete_message_soon = lambda message: None
+    bot.schedule_delete = lambda message, delay: None
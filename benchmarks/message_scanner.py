@@ -0,0 +1,135 @@
+"""Однопроходный scan_message против прежних отдельных проверок на типичных сообщениях
+
+Прежний путь: contains_links, поиск фраз в тексте, отдельный обход entities,
+имени документа и кнопок, каждый со своим lower() и any(phrase in ...).
+
+    python benchmarks/message_scanner.py [сообщений на вид]
+"""
+import random
+import string
+import sys
+
+from aiogram.types import Message
+
+from common import import_bot, timed
+
+bot = import_bot()
+
+LINK_MARKERS = ['http://', 'https://', 'www.', 't.me/', 'vk.com']
+
+
+def message(**fields) -> Message:
+    return Message.model_validate({
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': -100, 'type': 'supergroup'},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'User'},
+        **fields
+    })
+
+
+def url_entity(text: str, url: str) -> dict:
+    return {'type': 'url', 'offset': text.index(url), 'length': len(url)}
+
+
+LONG_TEXT = 'Сегодня обсуждали расписание встреч и планы на выходные. ' * 12
+LINK_TEXT = 'Полезная статья https://habr.com/ru/articles/123456/ и ещё https://example.org/a'
+
+SHAPES = {
+    'короткий текст': message(text='Всем привет, во сколько встреча?'),
+    'длинный текст': message(text=LONG_TEXT),
+    'текст со ссылками': message(text=LINK_TEXT, entities=[
+        url_entity(LINK_TEXT, 'https://habr.com/ru/articles/123456/'),
+        url_entity(LINK_TEXT, 'https://example.org/a')
+    ]),
+    'запрещённая ссылка': message(text='смотри https://vk.com/clip-1_2', entities=[
+        url_entity('смотри https://vk.com/clip-1_2', 'https://vk.com/clip-1_2')
+    ]),
+    'фото с подписью': message(photo=[{'file_id': 'a', 'file_unique_id': 'b', 'width': 1, 'height': 1}],
+                               caption='Фото с вечера, подробнее по ссылке',
+                               caption_entities=[{'type': 'text_link', 'offset': 23, 'length': 11,
+                                                  'url': 'https://example.org/photos'}]),
+    'документ': message(document={'file_id': 'a', 'file_unique_id': 'b', 'file_name': 'отчёт за май.pdf'},
+                        caption='Отчёт'),
+    'кнопки': message(text='Подписывайтесь', reply_markup={'inline_keyboard': [[
+        {'text': 'Канал', 'url': 'https://t.me/somechannel'},
+        {'text': 'Сайт', 'url': 'https://example.org'}
+    ]]})
+}
+
+
+def legacy_scan(message: Message, phrases: list[str]):
+    """Отдельные проходы, как до scan_message"""
+    text = message.text or message.caption
+    has_links = False
+    if text:
+        lowered = text.lower()
+        has_links = any(marker in lowered for marker in LINK_MARKERS)
+    for entity in message.entities or message.caption_entities or []:
+        if entity.type in ('url', 'text_link'):
+            has_links = True
+    if message.reply_markup:
+        for row in message.reply_markup.inline_keyboard:
+            for button in row:
+                if button.url:
+                    has_links = True
+
+    phrase = text and any(phrase in text.lower() for phrase in phrases)
+    for entity in (message.entities or []) + (message.caption_entities or []):
+        if entity.type in ('url', 'text_link'):
+            url = entity.extract_from(text) if entity.type == 'url' else entity.url
+            phrase = phrase or any(p in url.lower() for p in phrases)
+    if message.document and message.document.file_name:
+        phrase = phrase or any(p in message.document.file_name.lower() for p in phrases)
+    if message.reply_markup:
+        for row in message.reply_markup.inline_keyboard:
+            for button in row:
+                if button.url:
+                    phrase = phrase or any(p in button.url.lower() for p in phrases)
+    return has_links, phrase
+
+
+def use_phrases(phrases: list[str]):
+    """Пересборка индексов бота под другой список фраз, как при запуске"""
+    bot.BANNED_PHRASES = phrases
+    bot.url_blocklist = bot.UrlBlocklist(phrases)
+    bot.banned_matcher = bot.PhraseMatcher(phrases)
+    bot.text_phrases = set(bot.PhraseMatcher(
+        [phrase for phrase in phrases if bot.UrlBlocklist.parse_rule(phrase) is None]
+    ).phrases)
+    bot.scan_matcher = bot.PhraseMatcher(list(bot.text_phrases | set(bot.LINK_MARKERS)))
+
+
+def run_legacy(message: Message, count: int):
+    for _ in range(count):
+        legacy_scan(message, bot.BANNED_PHRASES)
+
+
+def run_scanner(message: Message, count: int):
+    for _ in range(count):
+        bot.scan_message(message)
+
+
+def report(count: int):
+    print(f"Фраз в списке: {len(bot.BANNED_PHRASES)}, сообщений на вид: {count}")
+    print(f"{'вид сообщения':<20} {'прежние, мкс':>13} {'scan_message, мкс':>18}")
+    for name, shape in SHAPES.items():
+        before = timed(run_legacy, shape, count, repeat=3) / count * 1e6
+        after = timed(run_scanner, shape, count, repeat=3) / count * 1e6
+        print(f"{name:<20} {before:>13.2f} {after:>18.2f}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    report(count)
+
+    # Большой список: домены и @каналы, как в крупных чатах
+    random.seed(1)
+    words = [''.join(random.choices(string.ascii_lowercase, k=random.randint(5, 12))) for _ in range(1000)]
+    use_phrases(bot.BANNED_PHRASES + [f"{word}.com" for word in words[:700]] + [f"@{word}" for word in words[700:]])
+    print()
+    report(count // 10)
+
+
+if __name__ == '__main__':
+    main()
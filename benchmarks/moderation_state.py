@@ -0,0 +1,69 @@
+"""Сообщений в секунду через check_regular_message: файл на каждое событие и состояние в памяти
+
+До: load_data/save_data читают и переписывают moderation_data.json на каждое
+событие, как было до ModerationState. После: состояние в памяти с фоновой записью.
+
+    python benchmarks/moderation_state.py [сообщений] [пользователей в файле]
+"""
+import asyncio
+import random
+import sys
+import time
+
+from common import FakeMessage, FakeUser, import_bot, patch_network
+
+bot = import_bot()
+patch_network(bot)
+
+
+def seed_data(users: int):
+    """Файл модерации размером с рабочий: предупреждения и ограничения"""
+    data = bot.read_data_file()
+    for user_id in range(1, users + 1):
+        data['warnings'][str(user_id)] = 1
+        data['warned_at'][str(user_id)] = '2024-05-01 10:00:00'
+    for user_id in range(1, users // 10 + 1):
+        data['restricted_users']['no_forwards'][str(user_id)] = {'name': f'User {user_id}', 'banned_at': '2024-05-01 10:00:00'}
+    bot.write_data_file(data)
+
+
+def make_messages(count: int) -> list[FakeMessage]:
+    """Каждое пятое сообщение со ссылкой на заблокированный домен"""
+    messages = []
+    for index in range(count):
+        user = FakeUser(random.randrange(100_000, 200_000))
+        text = 'привет всем, как дела?' if index % 5 else 'смотрите vk.com/clip-1_2'
+        messages.append(FakeMessage(user, -100, text))
+    return messages
+
+
+async def run(messages: list[FakeMessage]) -> float:
+    started = time.perf_counter()
+    for message in messages:
+        await bot.check_regular_message(message)
+    # Записи журнала статистики в потоке ввода-вывода тоже входят в стоимость
+    await bot.run_io('bench_barrier', lambda: None)
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    seed_data(users)
+    messages = make_messages(count)
+
+    resident_load, resident_save = bot.load_data, bot.save_data
+    bot.load_data, bot.save_data = bot.read_data_file, bot.write_data_file
+    before = asyncio.run(run(messages))
+
+    bot.load_data, bot.save_data = resident_load, resident_save
+    bot.moderation_state.data = None
+    after = asyncio.run(run(messages))
+
+    print(f"Сообщений: {count}, пользователей в файле модерации: {users}")
+    print(f"файл на каждое событие: {count / before:10.0f} сообщений/с")
+    print(f"состояние в памяти:     {count / after:10.0f} сообщений/с  (x{before / after:.1f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""PhraseMatcher против any(phrase in text) при росте списка фраз от 10 до 10 000
+
+    python benchmarks/phrase_matcher.py
+"""
+import random
+import string
+
+from common import import_bot, timed
+
+bot = import_bot()
+
+TEXTS = 1000
+
+
+def random_word(length: int) -> str:
+    return ''.join(random.choices(string.ascii_lowercase, k=length))
+
+
+def make_texts() -> list[str]:
+    """Обычные сообщения длиной 50-400 символов без запрещённых фраз"""
+    words = [random_word(random.randint(2, 9)) for _ in range(2000)]
+    return [' '.join(random.choices(words, k=random.randint(10, 60))) for _ in range(TEXTS)]
+
+
+def substring_scan(phrases: list[str], texts: list[str]):
+    for text in texts:
+        lowered = text.lower()
+        any(phrase in lowered for phrase in phrases)
+
+
+def automaton_scan(matcher, texts: list[str]):
+    for text in texts:
+        matcher.search(text)
+
+
+def main():
+    random.seed(1)
+    texts = make_texts()
+    print(f"{'фраз':>7} {'any(in), мкс':>14} {'автомат, мкс':>14} {'ускорение':>10}")
+    for size in (10, 100, 1000, 10_000):
+        phrases = [f"{random_word(random.randint(5, 12))}.com" for _ in range(size)]
+        matcher = bot.PhraseMatcher(phrases)
+        before = timed(substring_scan, phrases, texts, repeat=3) / TEXTS * 1e6
+        after = timed(automaton_scan, matcher, texts, repeat=3) / TEXTS * 1e6
+        print(f"{size:>7} {before:>14.1f} {after:>14.1f} {before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
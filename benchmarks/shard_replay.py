@@ -0,0 +1,171 @@
+"""Пропускная способность шардирования: обновления через ShardRouterMiddleware в N процессов
+
+Приёмник раскладывает обновления по шардам так же, как run_sharded, а
+процессы-обработчики прогоняют их через dp.feed_raw_update, как
+shard_worker_main. Время считается от первого обновления до обработки
+последнего всеми шардами; запуск процессов в замер не входит.
+
+Обновления берутся из файла (по одному JSON объекта Update в строке,
+например записанные из getUpdates) или генерируются: обычные сообщения
+в группах с текстом, ссылками и подписями.
+
+    python benchmarks/shard_replay.py [обновлений] [процессов через запятую] [файл]
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from aiogram import Dispatcher
+from aiogram.types import Update
+
+from common import import_bot, patch_network
+
+bot = import_bot()
+# Строка лога на каждое обновление замеряла бы вывод, а не обработку
+logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+
+CHATS = 64
+TEXTS = [
+    'Всем привет, во сколько встреча?',
+    'Сегодня обсуждали расписание встреч и планы на выходные. ' * 8,
+    'Полезная статья https://habr.com/ru/articles/123456/ и ещё example.org/a',
+    'Кто-нибудь пробовал новую версию? У меня после обновления всё работает',
+]
+
+
+def make_updates(count: int) -> list[dict]:
+    """Синтетические обновления: сообщения пользователей в CHATS группах"""
+    rng = random.Random(1)
+    now = int(time.time())
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = rng.randrange(1, 5000)
+        message = {
+            'message_id': update_id,
+            'date': now,
+            'chat': {'id': -1001000000000 - rng.randrange(CHATS), 'type': 'supergroup', 'title': 'Чат'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+        }
+        text = rng.choice(TEXTS)
+        if rng.random() < 0.2:
+            message['photo'] = [{'file_id': 'a', 'file_unique_id': 'b', 'width': 1, 'height': 1}]
+            message['caption'] = text
+        else:
+            message['text'] = text
+        updates.append({'update_id': update_id, 'message': message})
+    return updates
+
+
+def read_updates(path: str, count: int) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    return updates[:count]
+
+
+def replay_worker(inbox, done):
+    """Процесс-обработчик: как shard_worker_main, но без запуска фоновых задач и сети"""
+    patch_network(bot)
+    bot.activity_matrix.load({}, bot.utc_today())
+
+    async def work():
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        done.put(('ready',))
+        processed = 0
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item[0] == 'stop':
+                break
+            task = asyncio.create_task(bot.dp.feed_raw_update(bot.bot, json.loads(item[1])))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            processed += 1
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        done.put(('done', processed))
+
+    asyncio.run(work())
+
+
+async def route(updates: list[Update], router) -> float:
+    """Приёмник: раскладка обновлений по шардам, возвращает время раскладки"""
+    front_dp = Dispatcher()
+    front_dp.update.outer_middleware(router)
+    started = time.perf_counter()
+    for update in updates:
+        await front_dp.feed_update(bot.bot, update)
+    return time.perf_counter() - started
+
+
+def replay(updates: list[Update], workers: int) -> tuple[float, float, list[int]]:
+    """Прогон через workers процессов: (общее время, время раскладки, обновлений по шардам)"""
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(workers)]
+    done = context.Queue()
+
+    processes = []
+    for index in range(workers):
+        # Как в run_sharded: номер шарда процесс читает из окружения при импорте бота
+        os.environ['SHARD_INDEX'] = str(index)
+        os.environ['SHARD_WORKERS'] = str(workers)
+        process = context.Process(target=replay_worker, args=(inboxes[index], done))
+        process.start()
+        processes.append(process)
+    os.environ.pop('SHARD_INDEX', None)
+    os.environ.pop('SHARD_WORKERS', None)
+    for _ in processes:
+        done.get()
+
+    bot.SHARD_WORKERS = workers
+    router = bot.ShardRouterMiddleware(inboxes)
+    started = time.perf_counter()
+    routing = asyncio.run(route(updates, router))
+    for inbox in inboxes:
+        inbox.put(('stop',))
+    processed = sum(done.get()[1] for _ in processes)
+    elapsed = time.perf_counter() - started
+
+    for process in processes:
+        process.join()
+    assert processed == len(updates), f"обработано {processed} из {len(updates)}"
+    return elapsed, routing, router.routed
+
+
+def route_only(updates: list[Update], workers: int) -> float:
+    """Потолок приёмника: раскладка без процессов-обработчиков, обновлений в секунду"""
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(workers)]
+    bot.SHARD_WORKERS = workers
+    routing = asyncio.run(route(updates, bot.ShardRouterMiddleware(inboxes)))
+    for inbox in inboxes:
+        # Читателей нет, накопленное в очередях не нужно
+        inbox.cancel_join_thread()
+        inbox.close()
+    return len(updates) / routing
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    counts = [int(value) for value in sys.argv[2].split(',')] if len(sys.argv) > 2 else [1, 2, 4]
+    raw = read_updates(sys.argv[3], count) if len(sys.argv) > 3 else make_updates(count)
+    updates = [Update.model_validate(update) for update in raw]
+
+    print(f"Обновлений: {len(updates)}, процессов: {counts}, ядер: {os.cpu_count()}")
+    print(f"только приёмник: {route_only(updates, max(counts)):8.0f} обн/с")
+    base = None
+    for workers in counts:
+        elapsed, routing, routed = replay(updates, workers)
+        rate = len(updates) / elapsed
+        base = base or rate / workers
+        print(f"{workers} проц.: {rate:8.0f} обн/с (x{rate / base:.2f}), "
+              f"раскладка {len(updates) / routing:8.0f} обн/с, по шардам {routed}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
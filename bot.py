@@ -1,11 +1,29 @@
 import logging
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ChatType, ContentType
-from aiogram.filters import Command, BaseFilter
+from aiogram.filters import Command, CommandObject, BaseFilter
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import (
+    AnswerCallbackQuery,
+    BanChatMember,
+    DeleteMessage,
+    DeleteMessages,
+    EditMessageText,
+    GetUpdates,
+    RestrictChatMember,
+    SendMessage,
+    SendPhoto
+)
 
 from aiogram.types import (
+    Update,
     Message,
+    MessageEntity,
     CallbackQuery,
+    ChatMemberUpdated,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ChatPermissions,
@@ -13,10 +31,30 @@ from aiogram.types import (
     BufferedInputFile
 )
 from aiogram.fsm.storage.memory import MemoryStorage
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import html
 import json
 import os
+import shutil
+import sqlite3
 import asyncio
+import copy
+import hashlib
+import heapq
+import queue
+import time
+import atexit
+import multiprocessing
+import re
+import signal
+import struct
+from array import array
+from bisect import bisect_left, insort
+import zlib
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 
 from aiogram import Dispatcher
@@ -24,27 +62,31 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
+from aiohttp import web
 import numpy as np
-import matplotlib.pyplot as plt
 from datetime import datetime
 import io
 
 
 
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 
 # Загрузка переменных окружения
 load_dotenv()
 
 # Настройка логирования
+# Запись в файл и консоль выполняет отдельный поток, обработчики лишь кладут записи в очередь
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.FileHandler('moderation.log'), logging.StreamHandler())
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('moderation.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Конфигурация бота
@@ -54,7 +96,33 @@ BAN_DURATION = int(os.getenv('BAN_DURATION', 3))
 AUTO_REMOVE = int(os.getenv('AUTO_REMOVE', 30))
 BANNED_PHRASES = os.getenv('BANNED_PHRASES', 'vk.com,vk.ru,vkontakte.ru').split(',')
 ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', 0))
-CHAT_IDS = os.getenv('CHAT_IDS', '6585252422,5653011096').split(',')
+# Пустой список - бот работает во всех чатах, куда добавлен
+CHAT_IDS = os.getenv('CHAT_IDS', '').split(',')
+# Интервал фоновой записи состояния модерации на диск (секунды)
+FLUSH_INTERVAL = int(os.getenv('FLUSH_INTERVAL', 5))
+# Режим хранения статистики: journal (журнал приращений) или json (перезапись файла)
+STATS_STORAGE = os.getenv('STATS_STORAGE', 'journal')
+# Интервал сжатия журнала статистики в снимок (секунды)
+STATS_COMPACT_INTERVAL = int(os.getenv('STATS_COMPACT_INTERVAL', 300))
+# fsync после каждой записи в журнал (защита от потери питания)
+STATS_JOURNAL_FSYNC = os.getenv('STATS_JOURNAL_FSYNC', '0') == '1'
+# Хранилище данных модерации и статистики: json или sqlite
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'moderation.db')
+# Каталог файлов состояния; в контейнер монтируется целиком, чтобы замена файлов была атомарной
+DATA_DIR = os.getenv('DATA_DIR', '.')
+# Время жизни кэша статуса администратора (секунды) для админов и не-админов
+ADMIN_CACHE_TTL = int(os.getenv('ADMIN_CACHE_TTL', 600))
+ADMIN_CACHE_NEGATIVE_TTL = int(os.getenv('ADMIN_CACHE_NEGATIVE_TTL', 60))
+# Время жизни списка администраторов чата (секунды)
+ADMIN_ROSTER_TTL = int(os.getenv('ADMIN_ROSTER_TTL', 1800))
+
+# Число процессов-обработчиков с разделением чатов между ними (0 - один процесс)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 0))
+# Номер шарда текущего процесса; выставляется самим ботом при запуске обработчиков
+SHARD_INDEX = int(os.environ['SHARD_INDEX']) if os.getenv('SHARD_INDEX') else None
+
+MODERATED_CHATS = {int(chat_id) for chat_id in CHAT_IDS if chat_id.strip()}
 
 # Проверка конфигурации
 if not API_TOKEN:
@@ -68,11 +136,84 @@ storage = MemoryStorage()
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher(storage=storage)
 
+
+
+def shard_file(path: str, index: int) -> str:
+    """Имя файла состояния шарда index"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def shard_path(path: str) -> str:
+    """Имя файла состояния с учётом шарда текущего процесса"""
+    return path if SHARD_INDEX is None else shard_file(path, SHARD_INDEX)
+
+
+def data_path(name: str) -> str:
+    """Путь к файлу состояния в каталоге данных"""
+    return shard_path(os.path.join(DATA_DIR, name))
+
+
 # Файл для хранения данных
-DATA_FILE = 'moderation_data.json'
+DATA_FILE = data_path('moderation_data.json')
 
 # Константы
-STATS_FILE = 'user_stats.json'
+STATS_FILE = data_path('user_stats.json')
+STATS_JOURNAL_FILE = data_path('user_stats.journal')
+PENDING_DELETIONS_FILE = data_path('pending_deletions.json')
+HOUR_ACTIVITY_FILE = data_path('hour_activity.json')
+LEADERBOARD_FILE = data_path('leaderboard.json')
+
+# Лимиты исходящих запросов к Telegram: всего в секунду и сообщений в минуту на чат
+API_GLOBAL_RATE = float(os.getenv('API_GLOBAL_RATE', 30))
+API_CHAT_RATE_PER_MINUTE = float(os.getenv('API_CHAT_RATE_PER_MINUTE', 20))
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', 3))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес (без пути), по которому Telegram доставляет обновления
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+# Максимум одновременно обрабатываемых обновлений в режиме webhook
+WEBHOOK_MAX_UPDATES = int(os.getenv('WEBHOOK_MAX_UPDATES', 40))
+HEALTH_PATH = os.getenv('HEALTH_PATH', '/health')
+
+# Через сколько часов без новых нарушений сбрасываются предупреждения (0 - не сбрасываются)
+WARNING_DECAY_HOURS = float(os.getenv('WARNING_DECAY_HOURS', 0))
+
+# Число полос блокировок для последовательной обработки одного пользователя
+USER_LOCK_STRIPES = int(os.getenv('USER_LOCK_STRIPES', 64))
+
+# Окно накопления удалений для пакетного deleteMessages (секунды)
+DELETE_BATCH_WINDOW = float(os.getenv('DELETE_BATCH_WINDOW', 0.3))
+DELETE_BATCH_SIZE = 100
+
+# Способ отрисовки графиков: matplotlib (качественно) или raster (быстро, только NumPy)
+CHART_BACKEND = os.getenv('CHART_BACKEND', 'matplotlib')
+
+# Число процессов (для raster - потоков) отрисовки графиков и размер кеша готовых изображений
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 1))
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', 256))
+
+# Сколько file_id отправленных графиков помнить и как долго (в часах)
+CHART_FILE_ID_CACHE_SIZE = int(os.getenv('CHART_FILE_ID_CACHE_SIZE', 1024))
+CHART_FILE_ID_TTL = float(os.getenv('CHART_FILE_ID_TTL', 24))
+
+# Сколько последних дней хранит матрица активности для /chatstats
+CHATSTATS_WINDOW_DAYS = int(os.getenv('CHATSTATS_WINDOW_DAYS', 365))
+
+# Сдвиг часового пояса (в часах от UTC) для тепловой карты активности
+HEATMAP_UTC_OFFSET = float(os.getenv('HEATMAP_UTC_OFFSET', 0))
+
+# Сколько участников показывает /top
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 10))
+
+# Каталог и предельный размер (в мегабайтах) дискового кеша графиков
+CHART_DISK_CACHE_DIR = os.getenv('CHART_DISK_CACHE_DIR', 'chart_cache')
+CHART_DISK_CACHE_MB = float(os.getenv('CHART_DISK_CACHE_MB', 50))
 
 
 class AdminFilter(BaseFilter):
@@ -86,10 +227,337 @@ class AdminFilter(BaseFilter):
             return False
 
 
+# ======================
+# ФОНОВЫЙ ВВОД-ВЫВОД
+# ======================
+
+# Один поток: записи журнала и обращения к SQLite выполняются строго по порядку
+io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='io')
+
+# Время ввода-вывода по местам вызова: [вызовов, ожидание в очереди, выполнение, максимум]
+io_timings = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+
+# Функции, возвращающие строки для команды /metrics
+metric_reporters = []
+
+
+def metrics_reporter(func):
+    """Регистрация источника метрик для команды /metrics"""
+    metric_reporters.append(func)
+    return func
+
+
+def _timed_io(site: str, submitted: float, func, *args):
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        finished = time.perf_counter()
+        timing = io_timings[site]
+        timing[0] += 1
+        timing[1] += started - submitted
+        timing[2] += finished - started
+        timing[3] = max(timing[3], finished - started)
+
+
+async def run_io(site: str, func, *args):
+    """Выполнение блокирующей операции в потоке ввода-вывода с ожиданием результата"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, _timed_io, site, time.perf_counter(), func, *args)
+
+
+def submit_io(site: str, func, *args):
+    """Фоновая блокирующая операция без ожидания (ошибки только логируются)"""
+    future = io_executor.submit(_timed_io, site, time.perf_counter(), func, *args)
+    future.add_done_callback(
+        lambda f: f.exception() and logger.error(f"Ошибка ввода-вывода ({site}): {f.exception()}")
+    )
+    return future
+
+
+@metrics_reporter
+def io_metrics() -> list[str]:
+    lines = ["💾 Ввод-вывод (вызовов / ожидание / выполнение / максимум, мс):"]
+    for site, (calls, waited, spent, worst) in sorted(io_timings.items()):
+        lines.append(
+            f"• {site}: {calls} / {waited / calls * 1000:.1f} / "
+            f"{spent / calls * 1000:.1f} / {worst * 1000:.1f}"
+        )
+    return lines
+
+
+# ======================
+# ИСХОДЯЩИЕ ЗАПРОСЫ
+# ======================
+
+# Полосы приоритета: модерация раньше предупреждений, предупреждения раньше справки
+LANE_MODERATION, LANE_NOTICE, LANE_INFO = range(3)
+LANE_NAMES = {LANE_MODERATION: "модерация", LANE_NOTICE: "уведомления", LANE_INFO: "справка"}
+LANE_FLAGS = {"moderation": LANE_MODERATION, "notice": LANE_NOTICE, "info": LANE_INFO}
+
+METHOD_LANES = {
+    DeleteMessage: LANE_MODERATION,
+    DeleteMessages: LANE_MODERATION,
+    RestrictChatMember: LANE_MODERATION,
+    BanChatMember: LANE_MODERATION,
+    AnswerCallbackQuery: LANE_MODERATION,
+    SendPhoto: LANE_INFO
+}
+
+# Методы, на которые действует лимит сообщений в чат
+SEND_METHODS = (SendMessage, SendPhoto, EditMessageText)
+
+# Полоса запросов текущего обработчика (выставляется флагом lane у хендлера)
+request_lane = ContextVar('request_lane', default=None)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Сколько секунд ждать до появления токена"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RequestGovernor(BaseRequestMiddleware):
+    """Регулятор исходящих запросов к Bot API
+
+    Каждый запрос (кроме getUpdates) ждёт разрешения в очереди своей
+    полосы. Разрешения выдаются строго по приоритету полос с учётом общего
+    лимита и лимита сообщений на чат. Ответ 429 приостанавливает все
+    запросы на retry_after секунд, после чего запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float, chat_rate_per_minute: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate_per_minute / 60
+        self.chat_capacity = chat_rate_per_minute
+        self.chat_buckets = {}
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self._lanes = [deque() for _ in LANE_NAMES]
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Задержка в очереди по полосам: [запросов, сумма, максимум]
+        self.latency = [[0, 0.0, 0.0] for _ in LANE_NAMES]
+        self.retries = 0
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        lane = request_lane.get()
+        if lane is None:
+            lane = METHOD_LANES.get(type(method), LANE_NOTICE)
+        chat_id = getattr(method, 'chat_id', None) if isinstance(method, SEND_METHODS) else None
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(lane, chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retries += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                logger.warning(f"Telegram просит подождать {e.retry_after} с ({type(method).__name__})")
+                if attempt == self.max_retries:
+                    raise
+
+    async def _acquire(self, lane: int, chat_id):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        enqueued = time.monotonic()
+        self._lanes[lane].append((future, chat_id))
+        self._wakeup.set()
+        await future
+
+        waited = time.monotonic() - enqueued
+        stats = self.latency[lane]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_capacity)
+        return bucket
+
+    def _grant(self) -> float | None:
+        """Выдать одно разрешение; иначе вернуть время ожидания (None - очередь пуста)"""
+        wait = self.global_bucket.wait_time()
+        pending = False
+        for lane_queue in self._lanes:
+            for index, (future, chat_id) in enumerate(lane_queue):
+                if future.done():
+                    del lane_queue[index]
+                    return 0.0
+                pending = True
+                if wait > 0:
+                    return wait
+                if chat_id is not None:
+                    chat_wait = self._chat_bucket(chat_id).wait_time()
+                    if chat_wait > 0:
+                        wait = chat_wait if not wait else min(wait, chat_wait)
+                        continue
+                    self._chat_bucket(chat_id).take()
+                self.global_bucket.take()
+                del lane_queue[index]
+                future.set_result(None)
+                return 0.0
+        return wait if pending else None
+
+    async def _run(self):
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            wait = self._grant()
+            if wait == 0.0:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+class LaneMiddleware(BaseMiddleware):
+    """Перенос флага lane обработчика в полосу его исходящих запросов"""
+
+    async def __call__(self, handler, event, data):
+        lane = get_flag(data, "lane")
+        if lane is None:
+            return await handler(event, data)
+        token = request_lane.set(LANE_FLAGS[lane])
+        try:
+            return await handler(event, data)
+        finally:
+            request_lane.reset(token)
+
+
+# Общий лимит делится между процессами-обработчиками; лимит на чат - нет, чат живёт в одном шарде
+request_governor = RequestGovernor(
+    API_GLOBAL_RATE / SHARD_WORKERS if SHARD_INDEX is not None else API_GLOBAL_RATE,
+    API_CHAT_RATE_PER_MINUTE,
+    API_MAX_RETRIES
+)
+bot.session.middleware(request_governor)
+dp.message.middleware(LaneMiddleware())
+
+
+@metrics_reporter
+def request_metrics() -> list[str]:
+    lines = ["📡 Задержка в очереди запросов (запросов / среднее / максимум, мс):"]
+    for lane, (count, total, worst) in enumerate(request_governor.latency):
+        average = total / count * 1000 if count else 0.0
+        lines.append(f"• {LANE_NAMES[lane]}: {count} / {average:.1f} / {worst * 1000:.1f}")
+    lines.append(f"📡 Повторов после 429: {request_governor.retries}")
+    return lines
+
+
+class AllowedChatsMiddleware(BaseMiddleware):
+    """Отбрасывание обновлений из чатов вне CHAT_IDS до фильтров и обработчиков"""
+
+    def __init__(self, allowed: set[int]):
+        self.allowed = allowed
+        self.processed = 0
+        self.dropped = 0
+
+    async def __call__(self, handler, event: Update, data):
+        chat_id = get_update_chat_id(event)
+        if self.allowed and chat_id is not None and chat_id not in self.allowed:
+            self.dropped += 1
+            return None
+        self.processed += 1
+        return await handler(event, data)
+
+
+allowed_chats = AllowedChatsMiddleware(MODERATED_CHATS | ({ADMIN_CHAT_ID} if ADMIN_CHAT_ID else set()))
+dp.update.outer_middleware(allowed_chats)
+
+
+@metrics_reporter
+def allowed_chats_metrics() -> list[str]:
+    return [f"🚪 Обновлений обработано: {allowed_chats.processed}, отброшено: {allowed_chats.dropped}"]
+
+
+def ensure_data_dir():
+    """Создание каталога данных при первом запуске"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+
+def _copy_durable(source: str, target: str):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+
+def write_json_file(path: str, data, **dump_options):
+    """Атомарная запись JSON: временный файл, fsync и os.replace
+
+    Если файл смонтирован в контейнер отдельным volume (прежняя схема
+    развёртывания), замена невозможна и файл перезаписывается на месте.
+    На время перезаписи предыдущая версия сохраняется в .bak, чтобы обрыв
+    записи не оставил только порванный файл.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **dump_options)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        backup = f"{path}.bak"
+        if os.path.exists(path):
+            _copy_durable(path, backup)
+        _copy_durable(tmp_path, path)
+        os.remove(tmp_path)
+        # Копия нужна только на время перезаписи, устаревшей она не остаётся
+        if os.path.exists(backup):
+            os.remove(backup)
+
+
+def read_json_file(path: str):
+    """Чтение JSON-файла состояния с откатом на резервную копию .bak
+
+    Повреждённый файл нельзя подменять пустым состоянием: следующая запись
+    затёрла бы всю историю. Без резервной копии запуск прерывается ошибкой.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError as e:
+        backup = f"{path}.bak"
+        if not os.path.exists(backup):
+            raise RuntimeError(f"Файл {path} повреждён и не имеет резервной копии: {e}") from e
+        logger.error(f"Файл {path} повреждён ({e}), используется резервная копия {backup}")
+        with open(backup, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
 def init_data_file():
     """Инициализация файла данных"""
-    data_dir = '/app'
-    data_file = os.path.join(data_dir, DATA_FILE)
+    data_file = DATA_FILE
 
     if not os.path.exists(data_file):
         initial_data = {
@@ -100,7 +568,8 @@ def init_data_file():
                 "fully_restricted": {},
                 "no_forwards": {}
             },
-            "banned_channels": {}  # Новая секция для заблокированных каналов
+            "banned_channels": {},  # Новая секция для заблокированных каналов
+            "warned_at": {}
         }
         with open(data_file, 'w') as f:
             json.dump(initial_data, f, indent=4)
@@ -108,248 +577,2457 @@ def init_data_file():
         logger.info("Создан новый файл данных с полной структурой")
 
 
-def load_data() -> dict:
-    """Загрузка данных из файла с гарантированным созданием всех ключей"""
-    default_data = {
-        "warnings": {},
-        "banned": {},
-        "restricted_users": {
-            "no_links": {},
-            "fully_restricted": {},
-            "no_forwards": {}
-        },
-        "banned_channels": {}  # Новая секция для заблокированных каналов
-    }
+def read_data_file() -> dict:
+    """Чтение файла данных с гарантированным созданием всех ключей"""
+    default_data = {
+        "warnings": {},
+        "banned": {},
+        "restricted_users": {
+            "no_links": {},
+            "fully_restricted": {},
+            "no_forwards": {}
+        },
+        "banned_channels": {},  # Новая секция для заблокированных каналов
+        "warned_at": {}  # Время последнего предупреждения для их затухания
+    }
+
+    if not os.path.exists(DATA_FILE):
+        init_data_file()
+        return default_data
+
+    data = read_json_file(DATA_FILE)
+
+    # Гарантируем наличие всех ключей первого уровня
+    for key in default_data:
+        if key not in data:
+            data[key] = default_data[key]
+
+    # Гарантируем структуру restricted_users
+    for subkey in default_data["restricted_users"]:
+        if subkey not in data["restricted_users"]:
+            data["restricted_users"][subkey] = {}
+
+    return data
+
+
+def write_data_file(data: dict):
+    """Запись данных в файл"""
+    write_json_file(DATA_FILE, data, indent=4)
+
+
+class PeriodicFlusher:
+    """Фоновый вызов flush раз в interval секунд с финальным вызовом при остановке"""
+
+    def __init__(self, flush, interval: float):
+        self.flush = flush
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class ModerationState:
+    """Резидентное состояние модерации с отложенной записью на диск
+
+    Файл читается один раз, все обработчики работают с объектом в памяти,
+    а изменения сбрасываются на диск фоновой задачей раз в FLUSH_INTERVAL
+    секунд и при остановке бота. Запись идёт из копии состояния в потоке
+    ввода-вывода, поэтому обработчики не ждут диска.
+
+    В режиме шардов изменения общих разделов (баны, ограничения,
+    заблокированные каналы) рассылаются остальным процессам.
+    """
+
+    # Разделы, одинаковые во всех шардах
+    REPLICATED = (
+        ('banned',),
+        ('banned_channels',),
+        ('restricted_users', 'no_links'),
+        ('restricted_users', 'fully_restricted'),
+        ('restricted_users', 'no_forwards')
+    )
+
+    def __init__(self, flush_interval: int):
+        self.data = None
+        self.dirty = False
+        self._flusher = PeriodicFlusher(self.flush, flush_interval)
+        self._replicated = {}
+
+    def load(self) -> dict:
+        """Данные из памяти (файл читается только при первом обращении)"""
+        if self.data is None:
+            self.data = data_storage.load_moderation()
+            self._replicated = {path: copy.deepcopy(self._section(path)) for path in self.REPLICATED}
+        return self.data
+
+    def _section(self, path: tuple) -> dict:
+        section = self.data
+        for key in path:
+            section = section.setdefault(key, {})
+        return section
+
+    def mark_dirty(self, data: dict = None):
+        """Пометить состояние как изменённое"""
+        if data is not None:
+            self.data = data
+        self.dirty = True
+        if shard_events is not None:
+            self._replicate()
+
+    def _replicate(self):
+        """Отправка изменений общих разделов другим шардам"""
+        for path in self.REPLICATED:
+            current = self._section(path)
+            previous = self._replicated.get(path, {})
+            if current == previous:
+                continue
+            for key, value in current.items():
+                if previous.get(key) != value:
+                    shard_events.put(('sync', SHARD_INDEX, path, key, value))
+            for key in previous.keys() - current.keys():
+                shard_events.put(('sync', SHARD_INDEX, path, key, None))
+            self._replicated[path] = copy.deepcopy(current)
+
+    def apply_replicated(self, path: tuple, key: str, value):
+        """Применение изменения, пришедшего из другого шарда"""
+        self.load()
+        section = self._section(path)
+        replicated = self._replicated.setdefault(path, {})
+        if value is None:
+            section.pop(key, None)
+            replicated.pop(key, None)
+        else:
+            section[key] = value
+            replicated[key] = copy.deepcopy(value)
+            if path == ('banned',):
+                expiry_index.track_ban(key, value)
+        self.dirty = True
+
+    async def flush(self):
+        """Сброс изменений на диск, если они есть"""
+        if not self.dirty or self.data is None:
+            return
+        self.dirty = False
+        snapshot = copy.deepcopy(self.data)
+        try:
+            await run_io('save_moderation', data_storage.save_moderation, snapshot)
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Ошибка сохранения данных: {e}")
+
+    async def start(self):
+        """Загрузка состояния и запуск фоновой записи"""
+        await run_io('load_moderation', self.load)
+        self._flusher.start()
+
+    async def stop(self):
+        """Остановка фоновой записи с финальным сбросом на диск"""
+        await self._flusher.stop()
+
+
+# Очередь событий для других шардов (только в процессе-обработчике)
+shard_events = None
+
+moderation_state = ModerationState(FLUSH_INTERVAL)
+
+
+class ExpiryIndex:
+    """Индекс сроков окончания банов и предупреждений (min-куча)
+
+    Фоновая задача спит до ближайшего срока и удаляет истёкшие записи:
+    закончившийся бан снимается (при включённом затухании - вместе с
+    предупреждениями), а предупреждения без новых нарушений за
+    WARNING_DECAY_HOURS сбрасываются.
+    Каждая запись кучи хранит отметку времени, с которой она создана;
+    если запись в состоянии с тех пор изменилась, устаревший элемент кучи
+    просто отбрасывается. Работа на одно истечение - O(log n).
+    """
+
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, decay_hours: float):
+        self.decay = decay_hours * 3600
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.expired_bans = 0
+        self.decayed_warnings = 0
+
+    def _push(self, when: float, kind: str, user_id: str, stamp: str):
+        heapq.heappush(self._heap, (when, kind, user_id, stamp))
+        self._wakeup.set()
+
+    def track_ban(self, user_id: str, until: str):
+        try:
+            when = datetime.strptime(until, self.TIME_FORMAT).timestamp()
+        except ValueError:
+            logger.error(f"Некорректный срок бана пользователя {user_id}: {until}")
+            return
+        self._push(when, 'ban', user_id, until)
+
+    def track_warning(self, user_id: str, warned_at: str):
+        if not self.decay:
+            return
+        when = datetime.strptime(warned_at, self.TIME_FORMAT).timestamp() + self.decay
+        self._push(when, 'warning', user_id, warned_at)
+
+    def rebuild(self, data: dict):
+        """Построение индекса по загруженному состоянию"""
+        self._heap = []
+        for user_id, until in data['banned'].items():
+            self.track_ban(user_id, until)
+        if self.decay:
+            # Предупреждениям из старых файлов без отметки времени отсчёт идёт с запуска
+            now = datetime.now().strftime(self.TIME_FORMAT)
+            for user_id, count in data['warnings'].items():
+                if count and user_id not in data['warned_at']:
+                    data['warned_at'][user_id] = now
+            for user_id, warned_at in data['warned_at'].items():
+                self.track_warning(user_id, warned_at)
+        heapq.heapify(self._heap)
+
+    def _expire(self, kind: str, user_id: str, stamp: str) -> bool:
+        data = load_data()
+        if kind == 'ban':
+            if data['banned'].get(user_id) != stamp:
+                return False
+            del data['banned'][user_id]
+            ban_chats.pop(user_id, None)
+            # Без затухания предупреждения остаются, как и до появления индекса
+            if self.decay:
+                data['warnings'].pop(user_id, None)
+                data['warned_at'].pop(user_id, None)
+            self.expired_bans += 1
+        else:
+            if data['warned_at'].get(user_id) != stamp or user_id in data['banned']:
+                return False
+            del data['warned_at'][user_id]
+            data['warnings'].pop(user_id, None)
+            self.decayed_warnings += 1
+        return True
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            changed = False
+            while self._heap and self._heap[0][0] <= time.time():
+                _, kind, user_id, stamp = heapq.heappop(self._heap)
+                async with user_locks.hold(user_id):
+                    changed = self._expire(kind, user_id, stamp) or changed
+            if changed:
+                save_data(load_data())
+
+    def start(self):
+        """Построение индекса и запуск фоновой очистки"""
+        self.rebuild(load_data())
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+expiry_index = ExpiryIndex(WARNING_DECAY_HOURS)
+
+
+@metrics_reporter
+def expiry_metrics() -> list[str]:
+    return [
+        f"⏳ Сроков в индексе: {len(expiry_index._heap)}, "
+        f"снято банов: {expiry_index.expired_bans}, сброшено предупреждений: {expiry_index.decayed_warnings}"
+    ]
+
+
+def load_data() -> dict:
+    """Получение данных модерации из памяти"""
+    return moderation_state.load()
+
+
+def save_data(data: dict):
+    """Пометка данных как изменённых (запись на диск выполняется в фоне)"""
+    moderation_state.mark_dirty(data)
+
+
+def day_number(date_str: str) -> int:
+    """Номер дня (ordinal) для даты в формате YYYY-MM-DD"""
+    return datetime.fromisoformat(date_str).toordinal()
+
+
+def day_string(day: int) -> str:
+    """Дата в формате YYYY-MM-DD по номеру дня"""
+    return datetime.fromordinal(day).strftime('%Y-%m-%d')
+
+
+class DailyActivity:
+    """Счётчики сообщений пользователя по дням
+
+    Вместо словаря строковых дат хранится номер первого дня и массив
+    array('I') со счётчиком на каждый следующий день: 4 байта на день
+    вместо сотни с лишним. Увеличение счётчика и срез последних дней
+    не требуют разбора и сортировки дат.
+
+    В user_stats.json записывается как ["YYYY-MM-DD", [счётчики...]];
+    прежний формат {"YYYY-MM-DD": число} читается через from_dict
+    и восстанавливается через to_dict.
+    """
+
+    __slots__ = ('start', 'counts')
+
+    def __init__(self, start: int = 0, counts: array = None):
+        self.start = start
+        self.counts = counts if counts is not None else array('I')
+
+    @classmethod
+    def from_dict(cls, activity: dict) -> 'DailyActivity':
+        if not activity:
+            return cls()
+        days = {day_number(date_str): count for date_str, count in activity.items()}
+        start = min(days)
+        counts = array('I', [0]) * (max(days) - start + 1)
+        for day, count in days.items():
+            counts[day - start] = count
+        return cls(start, counts)
+
+    @classmethod
+    def from_json(cls, value) -> 'DailyActivity':
+        """Чтение из снимка статистики в новом или прежнем формате"""
+        if isinstance(value, dict):
+            return cls.from_dict(value)
+        if not value:
+            return cls()
+        start, counts = value
+        return cls(day_number(start), array('I', counts))
+
+    def to_json(self) -> list:
+        if not self.counts:
+            return []
+        return [day_string(self.start), self.counts.tolist()]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def copy(self) -> 'DailyActivity':
+        return DailyActivity(self.start, array('I', self.counts))
+
+    def items(self):
+        """Пары (дата, число сообщений) по дням с ненулевой активностью"""
+        for offset, count in enumerate(self.counts):
+            if count:
+                yield day_string(self.start + offset), count
+
+    def _index(self, day: int) -> int:
+        if not self.counts:
+            self.start = day
+            self.counts.append(0)
+        elif day < self.start:
+            # Запись задним числом, например при проигрывании журнала
+            self.counts[0:0] = array('I', [0]) * (self.start - day)
+            self.start = day
+        elif day >= self.start + len(self.counts):
+            self.counts.extend(array('I', [0]) * (day - self.start - len(self.counts) + 1))
+        return day - self.start
+
+    def get(self, date_str: str) -> int:
+        offset = day_number(date_str) - self.start
+        return self.counts[offset] if 0 <= offset < len(self.counts) else 0
+
+    def increment(self, date_str: str) -> int:
+        """Увеличение счётчика дня, возвращает новое значение"""
+        index = self._index(day_number(date_str))
+        self.counts[index] += 1
+        return self.counts[index]
+
+    def merge_max(self, date_str: str, count: int):
+        index = self._index(day_number(date_str))
+        self.counts[index] = max(self.counts[index], count)
+
+    def last(self, days: int) -> tuple[list[str], list[int]]:
+        """Последние days дней до дня последней активности включительно"""
+        tail = self.counts[-days:]
+        first = self.start + len(self.counts) - len(tail)
+        return [day_string(first + offset) for offset in range(len(tail))], tail.tolist()
+
+    def __bool__(self) -> bool:
+        return bool(self.counts)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + self.counts.__sizeof__()
+
+
+def encode_stats_value(value):
+    """Сериализация DailyActivity при записи статистики в JSON"""
+    if isinstance(value, DailyActivity):
+        return value.to_json()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def init_stats_file():
+    """Инициализация файла статистики"""
+    if not os.path.exists(STATS_FILE):
+        with open(STATS_FILE, 'w') as f:
+            json.dump({}, f)
+        os.chmod(STATS_FILE, 0o666)
+        logger.info("Создан новый файл статистики")
+
+
+def read_stats_file() -> dict:
+    """Чтение снимка статистики из файла
+
+    Ошибка чтения не заменяется пустой статистикой: сжатие журнала
+    записало бы её поверх всей истории.
+    """
+    if not os.path.exists(STATS_FILE):
+        init_stats_file()
+        return {}
+
+    stats = read_json_file(STATS_FILE)
+    for user_stats in stats.values():
+        user_stats['activity'] = DailyActivity.from_json(user_stats.get('activity'))
+    return stats
+
+
+def write_stats_file(data: dict, path: str = None):
+    """Атомарная запись снимка статистики в файл"""
+    # Без отступов: иначе каждый дневной счётчик занимал бы отдельную строку
+    write_json_file(path or STATS_FILE, data, ensure_ascii=False, default=encode_stats_value)
+
+
+def copy_stats(stats: dict) -> dict:
+    """Копия статистики для записи из другого потока"""
+    return {
+        user_id: {**user_stats, 'activity': user_stats['activity'].copy()}
+        for user_id, user_stats in stats.items()
+    }
+
+
+class StatsJournal:
+    """Счётчики сообщений в памяти с журналом приращений на диске
+
+    Каждое сообщение дописывает в журнал одну короткую запись, поэтому
+    стоимость записи не зависит от объёма статистики. Фоновая задача
+    периодически сжимает журнал в снимок user_stats.json. Все файловые
+    операции выполняются в потоке ввода-вывода в порядке поступления.
+
+    Записи журнала содержат итоговые значения счётчиков (за день и всего),
+    а не дельты: счётчики только растут, поэтому повторное применение записи
+    через max() идемпотентно. Это делает безопасным сбой в любой момент
+    сжатия - журнал, уже учтённый в снимке, можно проиграть повторно.
+    """
+
+    def __init__(self, journal_path: str, compact_interval: int, fsync: bool = False):
+        self.journal_path = journal_path
+        self.old_journal_path = f"{journal_path}.old"
+        self.fsync = fsync
+        self.stats = None
+        self.pending = 0
+        self._file = None
+        self._compactor = PeriodicFlusher(self.compact, compact_interval)
+
+    def load(self) -> dict:
+        """Восстановление счётчиков из снимка и журнала"""
+        if self.stats is None:
+            self.stats = read_stats_file()
+            replayed = 0
+            for path in (self.old_journal_path, self.journal_path):
+                replayed += self._replay(path)
+            self.pending = replayed
+            if replayed:
+                logger.info(f"Из журнала статистики восстановлено записей: {replayed}")
+        return self.stats
+
+    def _replay(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная последняя строка после аварийной остановки
+                    continue
+                self._apply(record)
+                count += 1
+        return count
+
+    def _apply(self, record: dict):
+        user_id, date_str = record['u'], record['d']
+        user_stats = self.stats.get(user_id)
+        if user_stats is None:
+            user_stats = self.stats[user_id] = {
+                'total_messages': 0,
+                'activity': DailyActivity(),
+                'username': record.get('n'),
+                'full_name': record.get('f'),
+                'first_seen': record.get('s', date_str)
+            }
+        user_stats['activity'].merge_max(date_str, record['c'])
+        user_stats['total_messages'] = max(user_stats.get('total_messages', 0), record['t'])
+        user_stats['last_active'] = max(user_stats.get('last_active', date_str), date_str)
+
+    def record(self, user_id: str, date_str: str, username: str, full_name: str):
+        """Учёт одного сообщения пользователя"""
+        stats = self.load()
+        record = {'u': user_id, 'd': date_str}
+
+        if user_id not in stats:
+            stats[user_id] = {
+                'total_messages': 0,
+                'activity': DailyActivity(),
+                'username': username,
+                'full_name': full_name,
+                'first_seen': date_str
+            }
+            record.update({'n': username, 'f': full_name, 's': date_str})
+
+        user_stats = stats[user_id]
+        user_stats['total_messages'] += 1
+        record['c'] = user_stats['activity'].increment(date_str)
+        user_stats['last_active'] = date_str
+
+        record['t'] = user_stats['total_messages']
+        self.pending += 1
+        submit_io('stats_journal_append', self._append, json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _append(self, line: str):
+        if self._file is None:
+            self._file = open(self.journal_path, 'a', encoding='utf-8')
+        self._file.write(line)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_snapshot(self, snapshot: dict):
+        # Текущий журнал откладывается, новые записи пойдут в свежий файл
+        self._close()
+        if os.path.exists(self.journal_path) and not os.path.exists(self.old_journal_path):
+            os.replace(self.journal_path, self.old_journal_path)
+
+        write_stats_file(snapshot)
+
+        # Снимок содержит всё, что было в отложенном журнале
+        if os.path.exists(self.old_journal_path):
+            os.remove(self.old_journal_path)
+
+    async def compact(self):
+        """Сжатие журнала в снимок статистики"""
+        if self.stats is None or not self.pending:
+            return
+
+        self.pending = 0
+        try:
+            await run_io('stats_compact', self._write_snapshot, copy_stats(self.stats))
+        except Exception as e:
+            self.pending += 1
+            logger.error(f"Ошибка сжатия журнала статистики: {e}")
+
+    async def start(self):
+        """Загрузка статистики и запуск фонового сжатия"""
+        await run_io('stats_load', self.load)
+        self._compactor.start()
+
+    async def stop(self):
+        """Остановка фонового сжатия с финальным снимком"""
+        await self._compactor.stop()
+        await run_io('stats_journal_close', self._close)
+
+
+stats_journal = StatsJournal(STATS_JOURNAL_FILE, STATS_COMPACT_INTERVAL, STATS_JOURNAL_FSYNC)
+
+
+class JsonStorage:
+    """Хранилище в JSON-файлах moderation_data.json и user_stats.json"""
+
+    async def start(self):
+        await run_io('init_data_file', init_data_file)
+        await stats_journal.start()
+
+    async def stop(self):
+        await stats_journal.stop()
+
+    def load_moderation(self) -> dict:
+        return read_data_file()
+
+    def save_moderation(self, data: dict):
+        write_data_file(data)
+
+    def load_stats(self) -> dict:
+        return stats_journal.load()
+
+    def get_user_stats(self, user_id: str) -> dict:
+        return stats_journal.load().get(user_id, {})
+
+    def record_message(self, user_id: str, date_str: str, username: str, full_name: str):
+        if STATS_STORAGE == 'journal':
+            stats_journal.record(user_id, date_str, username, full_name)
+            return
+
+        # Режим json: прежняя полная перезапись файла на каждое сообщение
+        stats = stats_journal.load()
+        if user_id not in stats:
+            stats[user_id] = {
+                'total_messages': 0,
+                'activity': DailyActivity(),
+                'username': username,
+                'full_name': full_name,
+                'first_seen': date_str
+            }
+        stats[user_id]['total_messages'] += 1
+        stats[user_id]['activity'].increment(date_str)
+        stats[user_id]['last_active'] = date_str
+        submit_io('save_stats', save_stats, copy_stats(stats))
+
+
+class SqliteStorage:
+    """Хранилище в SQLite (режим WAL) с индексированными таблицами
+
+    При первом запуске однократно импортирует существующие
+    moderation_data.json и user_stats.json (вместе с журналом),
+    после чего переименовывает их в *.imported.
+
+    Состояние модерации сохраняется построчно: запоминаются строки
+    последней записи, и при следующей меняются только отличающиеся.
+    """
+
+    # Таблицы состояния модерации и столбцы их первичных ключей
+    MODERATION_TABLES = {
+        'warnings': ('user_id',),
+        'bans': ('user_id',),
+        'warning_times': ('user_id',),
+        'restrictions': ('kind', 'user_id'),
+        'channels': ('channel_id',),
+    }
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS warnings (
+            user_id TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id TEXT PRIMARY KEY,
+            until TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS bans_until ON bans (until);
+        CREATE TABLE IF NOT EXISTS warning_times (
+            user_id TEXT PRIMARY KEY,
+            warned_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS restrictions (
+            kind TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            info TEXT NOT NULL,
+            PRIMARY KEY (kind, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS channels (
+            channel_id TEXT PRIMARY KEY,
+            info TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            first_seen TEXT,
+            last_active TEXT,
+            total_messages INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS daily_activity (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self._saved_rows = None  # Строки таблиц модерации на момент последней записи
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
+        return self.conn
+
+    async def start(self):
+        await run_io('sqlite_open', self._open)
+
+    def _open(self):
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() is None:
+            self.import_json()
+
+    async def stop(self):
+        await run_io('sqlite_close', self._close)
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def import_json(self):
+        """Однократный импорт данных из JSON-файлов"""
+        conn = self._connect()
+        if os.path.exists(DATA_FILE):
+            self.save_moderation(read_data_file())
+
+        stats = stats_journal.load() if os.path.exists(STATS_FILE) else {}
+        with conn:
+            for user_id, user_stats in stats.items():
+                conn.execute(
+                    "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, user_stats.get('username'), user_stats.get('full_name'),
+                     user_stats.get('first_seen'), user_stats.get('last_active'),
+                     user_stats.get('total_messages', 0))
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO daily_activity VALUES (?, ?, ?)",
+                    [(user_id, day, count) for day, count in user_stats['activity'].items()]
+                )
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('json_imported', ?)", (datetime.now().isoformat(),))
+        logger.info(f"Импорт JSON в SQLite завершён: пользователей в статистике {len(stats)}")
+        self.archive_json()
+
+    def archive_json(self):
+        """Переименование импортированных JSON-файлов в *.imported
+
+        Вызывается только после фиксации импорта: при сбросе базы или
+        ручном переносе старые файлы не будут импортированы повторно.
+        """
+        for path in (DATA_FILE, STATS_FILE, STATS_JOURNAL_FILE, stats_journal.old_journal_path):
+            for source in (path, f"{path}.bak"):
+                if os.path.exists(source):
+                    os.replace(source, f"{source}.imported")
+                    logger.info(f"Импортированный файл {source} переименован в {source}.imported")
+
+    def load_moderation(self) -> dict:
+        conn = self._connect()
+        data = {
+            "warnings": dict(conn.execute("SELECT user_id, count FROM warnings")),
+            "banned": dict(conn.execute("SELECT user_id, until FROM bans")),
+            "warned_at": dict(conn.execute("SELECT user_id, warned_at FROM warning_times")),
+            "restricted_users": {
+                "no_links": {},
+                "fully_restricted": {},
+                "no_forwards": {}
+            },
+            "banned_channels": {
+                channel_id: json.loads(info)
+                for channel_id, info in conn.execute("SELECT channel_id, info FROM channels")
+            }
+        }
+        for kind, user_id, info in conn.execute("SELECT kind, user_id, info FROM restrictions"):
+            data["restricted_users"].setdefault(kind, {})[user_id] = json.loads(info)
+        self._saved_rows = self._moderation_rows(data)
+        return data
+
+    @staticmethod
+    def _moderation_rows(data: dict) -> dict[str, dict[tuple, tuple]]:
+        """Строки таблиц модерации: таблица -> {первичный ключ: остальные столбцы}"""
+        return {
+            'warnings': {(user_id,): (count,) for user_id, count in data['warnings'].items()},
+            'bans': {(user_id,): (until,) for user_id, until in data['banned'].items()},
+            'warning_times': {
+                (user_id,): (warned_at,) for user_id, warned_at in data.get('warned_at', {}).items()
+            },
+            'restrictions': {
+                (kind, user_id): (json.dumps(info, ensure_ascii=False),)
+                for kind, users in data['restricted_users'].items()
+                for user_id, info in users.items()
+            },
+            'channels': {
+                (channel_id,): (json.dumps(info, ensure_ascii=False),)
+                for channel_id, info in data.get('banned_channels', {}).items()
+            },
+        }
+
+    def save_moderation(self, data: dict):
+        """Запись изменившихся с прошлого сохранения строк (в первый раз - всех таблиц)"""
+        conn = self._connect()
+        rows = self._moderation_rows(data)
+        with conn:
+            for table, key_columns in self.MODERATION_TABLES.items():
+                if self._saved_rows is None:
+                    conn.execute(f"DELETE FROM {table}")
+                    saved = {}
+                else:
+                    saved = self._saved_rows[table]
+                current = rows[table]
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {table} VALUES ({', '.join('?' * (len(key_columns) + 1))})",
+                    [key + values for key, values in current.items() if saved.get(key) != values]
+                )
+                conn.executemany(
+                    f"DELETE FROM {table} WHERE {' AND '.join(f'{column} = ?' for column in key_columns)}",
+                    saved.keys() - current.keys()
+                )
+        # Если транзакция не удалась, следующая запись сравнивается с последней успешной
+        self._saved_rows = rows
+
+    def load_stats(self) -> dict:
+        conn = self._connect()
+        stats = {}
+        for user_id, username, full_name, first_seen, last_active, total in conn.execute("SELECT * FROM users"):
+            stats[user_id] = {
+                'total_messages': total,
+                'activity': {},
+                'username': username,
+                'full_name': full_name,
+                'first_seen': first_seen,
+                'last_active': last_active
+            }
+        for user_id, day, count in conn.execute("SELECT user_id, day, count FROM daily_activity"):
+            if user_id in stats:
+                stats[user_id]['activity'][day] = count
+        for user_stats in stats.values():
+            user_stats['activity'] = DailyActivity.from_dict(user_stats['activity'])
+        return stats
+
+    def get_user_stats(self, user_id: str) -> dict:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT username, full_name, first_seen, last_active, total_messages FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        if row is None:
+            return {}
+        return {
+            'total_messages': row[4],
+            'activity': DailyActivity.from_dict(dict(conn.execute(
+                "SELECT day, count FROM daily_activity WHERE user_id = ?", (user_id,)
+            ))),
+            'username': row[0],
+            'full_name': row[1],
+            'first_seen': row[2],
+            'last_active': row[3]
+        }
+
+    def record_message(self, user_id: str, date_str: str, username: str, full_name: str):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO users VALUES (?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT (user_id) DO UPDATE SET "
+                "total_messages = total_messages + 1, last_active = excluded.last_active",
+                (user_id, username, full_name, date_str, date_str)
+            )
+            conn.execute(
+                "INSERT INTO daily_activity VALUES (?, ?, 1) "
+                "ON CONFLICT (user_id, day) DO UPDATE SET count = count + 1",
+                (user_id, date_str)
+            )
+
+
+data_storage = SqliteStorage(data_path(SQLITE_FILE)) if STORAGE_BACKEND == 'sqlite' else JsonStorage()
+
+
+def load_stats() -> dict:
+    """Получение всей статистики"""
+    return data_storage.load_stats()
+
+
+async def get_user_stats(user_id: str) -> dict:
+    """Статистика одного пользователя"""
+    return await run_io('get_user_stats', data_storage.get_user_stats, user_id)
+
+
+def save_stats(data: dict):
+    """Полная перезапись файла статистики"""
+    try:
+        write_stats_file(data)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения статистики: {e}")
+
+
+def record_message_stats(message: Message):
+    """Учёт сообщения в статистике активности"""
+    args = (
+        str(message.from_user.id),
+        message.date.strftime('%Y-%m-%d'),
+        message.from_user.username,
+        message.from_user.full_name
+    )
+    if isinstance(data_storage, SqliteStorage):
+        submit_io('sqlite_record_message', data_storage.record_message, *args)
+    else:
+        data_storage.record_message(*args)
+    activity_matrix.record(args[0], message.date.toordinal(), message.from_user.full_name)
+    hour_activity.record(message.chat.id, args[0], message.date)
+    leaderboard.record(message.chat.id, args[0], message.from_user.full_name, message.date.toordinal())
+
+
+# ======================
+# АНАЛИТИКА ЧАТА
+# ======================
+
+def utc_today() -> int:
+    """Номер текущего дня по UTC, как в датах сообщений Telegram"""
+    return datetime.now(timezone.utc).toordinal()
+
+
+class ActivityMatrix:
+    """Матрица активности «пользователи x дни» для отчётов по всем чатам
+
+    Последние window дней хранятся кольцевым буфером NumPy: столбец дня
+    равен номеру дня по модулю window, при смене дня устаревшие столбцы
+    обнуляются. Матрица строится из статистики при запуске и дальше
+    обновляется на каждом сообщении, а отчёт считается векторно.
+    Статистика не разделена по чатам, поэтому отчёт общий для всех чатов
+    и доступен только в чате администраторов.
+    """
+
+    MAX_COUNT = np.iinfo(np.uint16).max
+
+    def __init__(self, window: int):
+        self.window = window
+        self.rows = {}  # user_id -> номер строки
+        self.names = []  # Имена пользователей по строкам
+        self.size = 0
+        self.counts = np.zeros((0, window), dtype=np.uint16)
+        self.first_day = np.zeros(0, dtype=np.int32)
+        self.today = 0
+        self.ready = False
+
+    def load(self, stats: dict, today: int):
+        """Построение матрицы по полной статистике"""
+        start = today - self.window + 1
+        size = len(stats)
+        counts = np.zeros((max(size, 16), self.window), dtype=np.uint16)
+        first_day = np.zeros(len(counts), dtype=np.int32)
+        rows, names = {}, []
+
+        for row, (user_id, user_stats) in enumerate(stats.items()):
+            rows[user_id] = row
+            names.append(user_stats.get('full_name') or user_stats.get('username') or user_id)
+            activity = user_stats['activity']
+            first_seen = user_stats.get('first_seen')
+            first_day[row] = day_number(first_seen) if first_seen else (activity.start if activity else today)
+
+            # Пересечение дней пользователя с окном матрицы
+            lo = max(start, activity.start)
+            hi = min(today + 1, activity.start + len(activity.counts))
+            if lo < hi:
+                days = np.arange(lo, hi)
+                values = np.frombuffer(activity.counts, dtype=np.uintc)[lo - activity.start:hi - activity.start]
+                counts[row, days % self.window] = np.minimum(values, self.MAX_COUNT)
+
+        self.rows, self.names, self.size = rows, names, size
+        self.counts, self.first_day = counts, first_day
+        self.today = today
+        self.ready = True
+
+    def _advance(self, day: int):
+        """Переход на новый день: обнуление столбцов, выпавших из окна"""
+        if day <= self.today:
+            return
+        if day - self.today >= self.window:
+            self.counts[:] = 0
+        else:
+            self.counts[:, np.arange(self.today + 1, day + 1) % self.window] = 0
+        self.today = day
+
+    def _row(self, user_id: str, name: str, day: int) -> int:
+        row = self.rows.get(user_id)
+        if row is not None:
+            return row
+
+        row = self.size
+        if row == len(self.counts):
+            # Рост в два раза, чтобы добавление пользователя было амортизированно O(1)
+            self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            self.first_day = np.concatenate([self.first_day, np.zeros_like(self.first_day)])
+        self.rows[user_id] = row
+        self.names.append(name)
+        self.first_day[row] = day
+        self.size += 1
+        return row
+
+    def record(self, user_id: str, day: int, name: str):
+        if not self.ready or day <= self.today - self.window:
+            return
+        self._advance(day)
+        row = self._row(user_id, name, day)
+        self.names[row] = name
+        column = day % self.window
+        if self.counts[row, column] < self.MAX_COUNT:
+            self.counts[row, column] += 1
+
+    def report(self, days: int, top: int = 10) -> dict:
+        """Сводка за последние days дней (не больше окна матрицы)"""
+        days = max(1, min(days, self.window))
+        self._advance(utc_today())
+        start = self.today - days + 1
+        columns = np.arange(start, self.today + 1) % self.window
+        counts = self.counts[:self.size]
+
+        if days == self.window:
+            totals = counts.sum(axis=1, dtype=np.int64)
+            daily = counts.sum(axis=0, dtype=np.int64)[columns]
+            active = np.count_nonzero(counts, axis=0)[columns]
+        else:
+            window_counts = counts[:, columns]
+            totals = window_counts.sum(axis=1, dtype=np.int64)
+            daily = window_counts.sum(axis=0, dtype=np.int64)
+            active = np.count_nonzero(window_counts, axis=0)
+
+        # Новые - впервые появившиеся в периоде, остальные активные - вернувшиеся
+        first_day = self.first_day[:self.size]
+        is_new = first_day >= start
+        new_daily = np.bincount(first_day[is_new] - start, minlength=days)[:days]
+        was_active = totals > 0
+
+        top_rows = []
+        if self.size:
+            k = min(top, self.size)
+            candidates = np.argpartition(-totals, k - 1)[:k]
+            top_rows = [row for row in candidates[np.argsort(-totals[candidates], kind='stable')] if totals[row]]
+
+        return {
+            'days': days,
+            'first_day': start,
+            'total_messages': int(daily.sum()),
+            'daily_messages': daily.tolist(),
+            'daily_active': active.tolist(),
+            'daily_new': new_daily.tolist(),
+            'active_users': int(np.count_nonzero(was_active)),
+            'new_users': int(np.count_nonzero(was_active & is_new)),
+            'returning_users': int(np.count_nonzero(was_active & ~is_new)),
+            'top': [(self.names[row], int(totals[row])) for row in top_rows],
+        }
+
+
+activity_matrix = ActivityMatrix(CHATSTATS_WINDOW_DAYS)
+
+
+@metrics_reporter
+def activity_matrix_metrics() -> list[str]:
+    return [
+        f"🧮 Матрица активности: {activity_matrix.size} пользователей x {activity_matrix.window} дней, "
+        f"{activity_matrix.counts.nbytes / 1024 / 1024:.1f} МБ"
+    ]
+
+
+WEEKDAY_NAMES = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+
+
+class HourOfWeekCounters:
+    """Счётчики сообщений по часам недели (7 x 24) для пользователей и чатов
+
+    На каждого пользователя и чат - один массив array('I') из 168 ячеек
+    (день недели * 24 + час), поэтому память не растёт с историей.
+    Счётчики пополняются вместе с дневной статистикой и периодически
+    сохраняются в файл в потоке ввода-вывода.
+    """
+
+    SLOTS = 7 * 24
+
+    def __init__(self, path: str, flush_interval: int, utc_offset: float):
+        self.path = path
+        self.offset = timedelta(hours=utc_offset)
+        self.users = {}
+        self.chats = {}
+        self.dirty = False
+        self._flusher = PeriodicFlusher(self.flush, flush_interval)
+
+    def slot(self, when: datetime) -> int:
+        local = when + self.offset
+        return local.weekday() * 24 + local.hour
+
+    def _counters(self, table: dict, key: str) -> array:
+        counters = table.get(key)
+        if counters is None:
+            counters = table[key] = array('I', [0]) * self.SLOTS
+        return counters
+
+    def record(self, chat_id: int, user_id: str, when: datetime):
+        slot = self.slot(when)
+        self._counters(self.chats, str(chat_id))[slot] += 1
+        self._counters(self.users, user_id)[slot] += 1
+        self.dirty = True
+
+    def _read(self) -> tuple[dict, dict]:
+        if not os.path.exists(self.path):
+            return {}, {}
+        saved = read_json_file(self.path)
+        return tuple(
+            {key: array('I', values) for key, values in saved.get(section, {}).items()
+             if len(values) == self.SLOTS}
+            for section in ('users', 'chats')
+        )
+
+    def _write(self, users: dict, chats: dict):
+        write_json_file(self.path, {
+            'users': {key: values.tolist() for key, values in users.items()},
+            'chats': {key: values.tolist() for key, values in chats.items()}
+        })
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        # Копии массивов снимаются быстро, преобразование в JSON идёт в потоке ввода-вывода
+        users = {key: values[:] for key, values in self.users.items()}
+        chats = {key: values[:] for key, values in self.chats.items()}
+        try:
+            await run_io('save_hour_activity', self._write, users, chats)
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Ошибка сохранения активности по часам: {e}")
+
+    async def start(self):
+        """Загрузка сохранённых счётчиков и запуск фоновой записи
+
+        Ошибка чтения останавливает запуск: пустые счётчики при первой
+        записи заменили бы собой всю историю.
+        """
+        self.users, self.chats = await run_io('load_hour_activity', self._read)
+        self._flusher.start()
+
+    async def stop(self):
+        await self._flusher.stop()
+
+
+hour_activity = HourOfWeekCounters(HOUR_ACTIVITY_FILE, STATS_COMPACT_INTERVAL, HEATMAP_UTC_OFFSET)
+
+
+@metrics_reporter
+def hour_activity_metrics() -> list[str]:
+    return [
+        f"🕒 Активность по часам недели: пользователей {len(hour_activity.users)}, "
+        f"чатов {len(hour_activity.chats)}"
+    ]
+
+
+# Скользящие окна рейтинга в днях
+LEADERBOARD_WINDOWS = {'day': 1, 'week': 7, 'month': 30}
+LEADERBOARD_WINDOW_NAMES = {'day': 'день', 'week': 'неделю', 'month': 'месяц'}
+LEADERBOARD_HISTORY = max(LEADERBOARD_WINDOWS.values())
+
+
+class ChatLeaderboard:
+    """Рейтинг участников одного чата по скользящим окнам
+
+    Сообщения за последние LEADERBOARD_HISTORY дней хранятся матрицей
+    «участники x дни» (столбец - номер дня по модулю истории). Для каждого
+    окна поддерживаются суммы по участникам и отсортированный список
+    (-сообщений, строка): новое сообщение переставляет одну запись
+    бинарным поиском, а верхние K берутся срезом. При смене дня суммы
+    пересчитываются векторно один раз.
+    """
+
+    def __init__(self, today: int):
+        self.today = today
+        self.rows = {}  # user_id -> номер строки
+        self.user_ids = []
+        self.names = []
+        self.counts = np.zeros((16, LEADERBOARD_HISTORY), dtype=np.uint32)
+        self.scores = {window: np.zeros(16, dtype=np.int64) for window in LEADERBOARD_WINDOWS}
+        self.ranked = {window: [] for window in LEADERBOARD_WINDOWS}
+
+    def _row(self, user_id: str, name: str) -> int:
+        row = self.rows.get(user_id)
+        if row is not None:
+            self.names[row] = name
+            return row
+
+        row = len(self.user_ids)
+        if row == len(self.counts):
+            self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            for window, scores in self.scores.items():
+                self.scores[window] = np.concatenate([scores, np.zeros_like(scores)])
+        self.rows[user_id] = row
+        self.user_ids.append(user_id)
+        self.names.append(name)
+        return row
+
+    def rebuild(self):
+        """Пересчёт сумм и порядка по всем окнам"""
+        size = len(self.user_ids)
+        for window, length in LEADERBOARD_WINDOWS.items():
+            columns = np.arange(self.today - length + 1, self.today + 1) % LEADERBOARD_HISTORY
+            scores = self.counts[:size, columns].sum(axis=1, dtype=np.int64)
+            self.scores[window][:size] = scores
+            active = np.flatnonzero(scores)
+            order = active[np.lexsort((active, -scores[active]))]
+            self.ranked[window] = [(-int(scores[row]), int(row)) for row in order]
+
+    def advance(self, day: int):
+        """Переход на новый день: вышедшие из истории дни обнуляются"""
+        if day <= self.today:
+            return
+        stale = np.arange(self.today + 1, min(day, self.today + LEADERBOARD_HISTORY) + 1)
+        self.counts[:, stale % LEADERBOARD_HISTORY] = 0
+        self.today = day
+        self.rebuild()
+
+    def record(self, user_id: str, name: str, day: int):
+        self.advance(day)
+        age = self.today - day
+        if age >= LEADERBOARD_HISTORY:
+            return
+
+        row = self._row(user_id, name)
+        self.counts[row, day % LEADERBOARD_HISTORY] += 1
+        for window, length in LEADERBOARD_WINDOWS.items():
+            if age >= length:
+                continue
+            scores, ranked = self.scores[window], self.ranked[window]
+            old = int(scores[row])
+            if old:
+                del ranked[bisect_left(ranked, (-old, row))]
+            scores[row] = old + 1
+            insort(ranked, (-old - 1, row))
+
+    def top(self, window: str, k: int) -> list[tuple[str, int]]:
+        return [(self.names[row], -score) for score, row in self.ranked[window][:k]]
+
+
+class Leaderboard:
+    """Рейтинги самых активных участников по всем чатам
+
+    Обновляется на каждом учтённом сообщении и отвечает на /top без
+    обращения к файлу статистики. Состояние периодически сохраняется
+    в файл в потоке ввода-вывода.
+    """
+
+    def __init__(self, path: str, flush_interval: int):
+        self.path = path
+        self.chats = {}
+        self.dirty = False
+        self._flusher = PeriodicFlusher(self.flush, flush_interval)
+
+    def record(self, chat_id: int, user_id: str, name: str, day: int):
+        board = self.chats.get(chat_id)
+        if board is None:
+            board = self.chats[chat_id] = ChatLeaderboard(day)
+        board.record(user_id, name, day)
+        self.dirty = True
+
+    def top(self, chat_id: int, window: str, k: int) -> list[tuple[str, int]]:
+        board = self.chats.get(chat_id)
+        if board is None:
+            return []
+        board.advance(utc_today())
+        return board.top(window, k)
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        saved = read_json_file(self.path)
+
+        chats = {}
+        for chat_id, state in saved.items():
+            board = ChatLeaderboard(state['today'])
+            for user_id, (name, counts) in state['users'].items():
+                row = board._row(user_id, name)
+                board.counts[row] = counts
+            board.rebuild()
+            chats[int(chat_id)] = board
+        return chats
+
+    def _write(self, snapshot: dict):
+        write_json_file(self.path, {
+            chat_id: {
+                'today': today,
+                'users': {
+                    user_id: [name, row.tolist()]
+                    for user_id, name, row in zip(user_ids, names, counts)
+                }
+            }
+            for chat_id, (today, user_ids, names, counts) in snapshot.items()
+        }, ensure_ascii=False)
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        snapshot = {
+            chat_id: (board.today, list(board.user_ids), list(board.names),
+                      board.counts[:len(board.user_ids)].copy())
+            for chat_id, board in self.chats.items()
+        }
+        try:
+            await run_io('save_leaderboard', self._write, snapshot)
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Ошибка сохранения рейтинга: {e}")
+
+    async def start(self):
+        """Загрузка сохранённых рейтингов и запуск фоновой записи
+
+        Как и для счётчиков по часам, ошибка чтения останавливает запуск.
+        """
+        self.chats = await run_io('load_leaderboard', self._read)
+        self._flusher.start()
+
+    async def stop(self):
+        await self._flusher.stop()
+
+
+leaderboard = Leaderboard(LEADERBOARD_FILE, STATS_COMPACT_INTERVAL)
+
+
+@metrics_reporter
+def leaderboard_metrics() -> list[str]:
+    members = sum(len(board.user_ids) for board in leaderboard.chats.values())
+    return [f"🏆 Рейтинги: чатов {len(leaderboard.chats)}, участников {members}"]
+
+
+def log_deleted_message(user_id: str, user_name: str, message_text: str, reason: str):
+    """Логирование удаленных сообщений"""
+    log_entry = {
+        'timestamp': str(datetime.now()),
+        'user_id': user_id,
+        'user_name': user_name,
+        'message': message_text,
+        'reason': reason
+    }
+    logger.info(f"Удалено сообщение: {log_entry}")
+
+
+class PhraseMatcher:
+    """Автомат Ахо-Корасик для поиска запрещённых фраз
+
+    Строится один раз из списка фраз и находит любую из них за один
+    линейный проход по тексту, независимо от количества фраз. Короткие
+    списки проверяются поиском подстрок: обход автомата идёт по символу
+    в Python и окупается только на сотнях фраз (benchmarks/phrase_matcher.py).
+    """
+
+    SUBSTRING_LIMIT = 128
+
+    def __init__(self, phrases: list[str]):
+        self.phrases = [phrase for phrase in dict.fromkeys(p.strip().lower() for p in phrases) if phrase]
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+
+        # Бор по всем фразам
+        for phrase in self.phrases:
+            state = 0
+            for char in phrase:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            self._output[state] = (phrase,)
+
+        # Суффиксные ссылки обходом в ширину
+        pending = list(self._goto[0].values())
+        for state in pending:
+            for char, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail if fail != next_state else 0
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def _scan(self, text: str):
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                yield from output[state]
+
+    def _matches(self, text: str):
+        if len(self.phrases) <= self.SUBSTRING_LIMIT:
+            lowered = text.lower()
+            return (phrase for phrase in self.phrases if phrase in lowered)
+        return self._scan(text)
+
+    def search(self, text: str) -> str | None:
+        """Первая найденная фраза или None"""
+        if not text or not self.phrases:
+            return None
+        return next(self._matches(text), None)
+
+    def find_all(self, text: str) -> set[str]:
+        """Все фразы, встречающиеся в тексте"""
+        if not text or not self.phrases:
+            return set()
+        return set(self._matches(text))
+
+
+class _UrlTrieNode:
+    __slots__ = ('children', 'prefixes')
+
+    def __init__(self):
+        self.children = {}
+        self.prefixes = []
+
+
+class UrlBlocklist:
+    """Индекс заблокированных доменов по перевёрнутым меткам хоста
+
+    Правило "vk.com" блокирует vk.com и все поддомены (m.vk.com), но не
+    notvk.com. Правило "vk.com/clip" дополнительно требует, чтобы путь
+    начинался с /clip. Стоимость проверки зависит от длины хоста, а не от
+    размера списка.
+    """
+
+    RULE_RE = re.compile(r'^(?:https?://)?([^\s/@:]+\.[^\s/@:.]*[^\W\d_][^\s/@:.]*)(/\S*)?$')
+
+    def __init__(self, rules: list[str]):
+        self._root = _UrlTrieNode()
+        self.rules = []
+        for rule in rules:
+            parsed = self.parse_rule(rule)
+            if parsed is None:
+                continue
+            host, prefix = parsed
+            node = self._root
+            for label in reversed(host.split('.')):
+                node = node.children.setdefault(label, _UrlTrieNode())
+            node.prefixes.append((prefix, rule.strip()))
+            self.rules.append(rule.strip())
+
+    @classmethod
+    def parse_rule(cls, rule: str) -> tuple[str, str] | None:
+        """(хост, префикс пути) для правил, похожих на адрес, иначе None"""
+        match = cls.RULE_RE.match(rule.strip().lower())
+        if not match:
+            return None
+        return normalize_host(match.group(1)), (match.group(2) or '').rstrip('/')
+
+    def match(self, url: str) -> str | None:
+        """Сработавшее правило для адреса или None"""
+        host, path = split_url(url)
+        if not host:
+            return None
+        node = self._root
+        for label in reversed(host.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                return None
+            for prefix, rule in node.prefixes:
+                if path.startswith(prefix):
+                    return rule
+        return None
+
+
+def normalize_host(host: str) -> str:
+    """Хост в нижнем регистре и punycode"""
+    host = host.strip().rstrip('.').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if host.isascii():
+        return host
+    try:
+        return host.encode('idna').decode('ascii')
+    except UnicodeError:
+        return host
+
+
+def split_url(url: str) -> tuple[str, str]:
+    """Нормализованные хост и путь адреса"""
+    url = url.strip()
+    if '://' not in url:
+        url = f"http://{url}"
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname or ''
+    except ValueError:
+        return '', ''
+    return normalize_host(host), parts.path.lower()
+
+
+# Похожие на адрес слова текста: хост с буквенным доменом верхнего уровня и путь
+HOST_TOKEN_RE = re.compile(r'(?:https?://)?\b(?:[\w-]+\.)+[^\W\d_][\w-]*(?:/[^\s]*)?')
+# Быстрая предварительная проверка: точка между символом слова и буквой
+HOST_DOT_RE = re.compile(r'[\w-]\.[^\W\d_]')
+
+
+def find_host_tokens(text: str) -> list[str]:
+    """Слова текста, похожие на адрес сайта"""
+    if not HOST_DOT_RE.search(text):
+        return []
+    return HOST_TOKEN_RE.findall(text)
+
+
+def blank_entities(text: str, entities: list[MessageEntity]) -> str:
+    """Текст с заменёнными на пробелы участками entities
+
+    Смещения entities считаются в кодовых единицах UTF-16.
+    """
+    if not entities:
+        return text
+    encoded = bytearray(text.encode('utf-16-le'))
+    for entity in entities:
+        start, end = entity.offset * 2, (entity.offset + entity.length) * 2
+        encoded[start:end] = ' '.encode('utf-16-le') * entity.length
+    return encoded.decode('utf-16-le')
+
+
+# Фразы, похожие на адрес, проверяются по ссылкам через индекс доменов
+# и по похожим на адрес словам текста, остальные (например @каналы) -
+# по тексту сообщения
+url_blocklist = UrlBlocklist(BANNED_PHRASES)
+banned_matcher = PhraseMatcher(BANNED_PHRASES)
+text_phrases = set(PhraseMatcher(
+    [phrase for phrase in BANNED_PHRASES if UrlBlocklist.parse_rule(phrase) is None]
+).phrases)
+
+# Признаки ссылки в тексте; ищутся тем же автоматом, что и запрещённые фразы
+LINK_MARKERS = {'http://', 'https://', 'www.', 't.me/', 'vk.com'}
+scan_matcher = PhraseMatcher(list(text_phrases | LINK_MARKERS))
+
+
+class AdminCache:
+    """Кэш статуса администратора по паре (чат, пользователь)
+
+    Положительные ответы живут ADMIN_CACHE_TTL секунд, отрицательные -
+    ADMIN_CACHE_NEGATIVE_TTL. Записи обновляются по событиям chat_member.
+    """
+
+    def __init__(self, ttl: int, negative_ttl: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, user_id: int) -> bool | None:
+        entry = self._entries.get((chat_id, user_id))
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def set(self, chat_id: int, user_id: int, admin: bool):
+        ttl = self.ttl if admin else self.negative_ttl
+        self._entries[(chat_id, user_id)] = (admin, time.monotonic() + ttl)
+
+    def invalidate(self, chat_id: int, user_id: int = None):
+        """Сброс записи пользователя или всего чата"""
+        if user_id is not None:
+            self._entries.pop((chat_id, user_id), None)
+            return
+        for key in [key for key in self._entries if key[0] == chat_id]:
+            del self._entries[key]
+
+
+class AdminRoster:
+    """Список администраторов группового чата с ленивым обновлением
+
+    Один запрос get_chat_administrators раз в ADMIN_ROSTER_TTL секунд
+    обслуживает и проверки прав, и упоминания админов при бане.
+    Одновременные промахи по одному чату ждут один общий запрос.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._rosters = {}
+        self._pending = {}
+        self.api_calls = 0
+
+    async def get(self, chat_id: int, bot: Bot) -> list:
+        roster = self._rosters.get(chat_id)
+        if roster is not None and roster[1] > time.monotonic():
+            return roster[0]
+
+        task = self._pending.get(chat_id)
+        if task is None:
+            task = self._pending[chat_id] = asyncio.create_task(self._fetch(chat_id, bot))
+            task.add_done_callback(lambda _: self._pending.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, chat_id: int, bot: Bot) -> list:
+        self.api_calls += 1
+        admins = await bot.get_chat_administrators(chat_id)
+        self._rosters[chat_id] = (admins, time.monotonic() + self.ttl)
+        for member in admins:
+            admin_cache.set(chat_id, member.user.id, True)
+        return admins
+
+    def invalidate(self, chat_id: int):
+        self._rosters.pop(chat_id, None)
+
+    async def warm(self, bot: Bot, chat_ids):
+        """Предзагрузка администраторов чатов одним запросом на чат"""
+        for chat_id in chat_ids:
+            try:
+                await self.get(chat_id, bot)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки администраторов чата {chat_id}: {e}")
+
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL, ADMIN_CACHE_NEGATIVE_TTL)
+admin_roster = AdminRoster(ADMIN_ROSTER_TTL)
+
+
+@metrics_reporter
+def admin_cache_metrics() -> list[str]:
+    return [
+        f"👮 Кэш админов: попаданий {admin_cache.hits}, промахов {admin_cache.misses}",
+        f"👮 Запросов списка админов: {admin_roster.api_calls}"
+    ]
+
+
+async def is_admin(chat_id: int, user_id: int, bot: Bot) -> bool:
+    """Проверка, является ли пользователь администратором"""
+    cached = admin_cache.get(chat_id, user_id)
+    if cached is not None:
+        return cached
+
+    # В группах ответ даёт общий список администраторов
+    if chat_id < 0:
+        try:
+            admins = await admin_roster.get(chat_id, bot)
+            admin = any(member.user.id == user_id for member in admins)
+            admin_cache.set(chat_id, user_id, admin)
+            return admin
+        except Exception as e:
+            logger.error(f"Ошибка загрузки администраторов чата {chat_id}: {e}")
+
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+        admin = member.status in ["administrator", "creator"]
+        admin_cache.set(chat_id, user_id, admin)
+        return admin
+    except Exception as e:
+        logger.error(f"Ошибка проверки администратора: {e}")
+        return False
+
+
+def get_unban_keyboard(user_id: str) -> InlineKeyboardMarkup:
+    """Создание клавиатуры для разбана"""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Разбанить", callback_data=f"unban_{user_id}")]
+        ]
+    )
+
+
+# ======================
+# ГРАФИКИ
+# ======================
+
+# Заготовка фигуры в процессе отрисовки, создаётся инициализатором пула
+_chart_figure = None
+_chart_ax = None
+
+
+def _init_chart_worker():
+    """Инициализация процесса отрисовки: импорт matplotlib и стилизованная заготовка"""
+    global _chart_figure, _chart_ax
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    plt.style.use('seaborn-v0_8')
+    _chart_figure, _chart_ax = plt.subplots(figsize=(12, 6))
+
+
+def render_activity_chart(dates: list[str], counts: list[int], title: str) -> bytes:
+    """Отрисовка графика активности в PNG
+
+    Выполняется в процессе пула, фигура создаётся один раз и переиспользуется.
+    """
+    if _chart_figure is None:
+        _init_chart_worker()
+
+    ax = _chart_ax
+    ax.clear()
+
+    # Основной график
+    bars = ax.bar(
+        dates, counts,
+        color='#4CAF50',
+        edgecolor='darkgreen',
+        linewidth=0.7,
+        alpha=0.8
+    )
+
+    # Линия тренда
+    if len(counts) > 1:
+        z = np.polyfit(range(len(counts)), counts, 1)
+        p = np.poly1d(z)
+        ax.plot(
+            dates, p(range(len(counts))),
+            color='#FF5722',
+            linestyle='--',
+            linewidth=2,
+            label='Тренд'
+        )
+        ax.legend()
+
+    # Настройки графика
+    ax.set_title(title, fontsize=14, pad=20)
+    ax.set_xlabel('Дата', fontsize=12)
+    ax.set_ylabel('Количество сообщений', fontsize=12)
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+
+    # Поворот дат на 45 градусов
+    ax.tick_params(axis='x', labelrotation=45)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment('right')
+
+    # Значения над столбцами
+    ax.bar_label(bars, fmt='%d', fontsize=9)
+
+    _chart_figure.tight_layout()
+    buf = io.BytesIO()
+    _chart_figure.savefig(buf, format='png', dpi=100, bbox_inches='tight')
+    return buf.getvalue()
+
+
+# Растровый шрифт 3x5 для подписей: цифры, точка и минус
+RASTER_FONT = {
+    '0': ('111', '101', '101', '101', '111'),
+    '1': ('010', '110', '010', '010', '111'),
+    '2': ('111', '001', '111', '100', '111'),
+    '3': ('111', '001', '111', '001', '111'),
+    '4': ('101', '101', '111', '001', '001'),
+    '5': ('111', '100', '111', '001', '111'),
+    '6': ('111', '100', '111', '101', '111'),
+    '7': ('111', '001', '001', '001', '001'),
+    '8': ('111', '101', '111', '101', '111'),
+    '9': ('111', '101', '111', '001', '111'),
+    '.': ('000', '000', '000', '000', '010'),
+    '-': ('000', '000', '111', '000', '000'),
+}
+
+RASTER_SCALE = 2  # Масштаб шрифта в пикселях на точку
+RASTER_GLYPHS = {
+    char: np.array([[dot == '1' for dot in row] for row in glyph])
+    .repeat(RASTER_SCALE, axis=0).repeat(RASTER_SCALE, axis=1)
+    for char, glyph in RASTER_FONT.items()
+}
+
+RASTER_WIDTH = 1000
+RASTER_HEIGHT = 500
+
+RASTER_BACKGROUND = (255, 255, 255)
+RASTER_GRID = (225, 225, 225)
+RASTER_AXIS = (90, 90, 90)
+RASTER_BAR = (76, 175, 80)
+RASTER_BAR_EDGE = (0, 100, 0)
+RASTER_TREND = (255, 87, 34)
+
+
+def encode_png(pixels: np.ndarray) -> bytes:
+    """Кодирование RGB-массива (высота x ширина x 3) в PNG без сторонних библиотек"""
+    height, width, _ = pixels.shape
+    # Каждая строка начинается с байта фильтра (0 - без фильтра)
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, width * 3)
+
+    def chunk(tag: bytes, payload: bytes) -> bytes:
+        return (
+            struct.pack('>I', len(payload)) + tag + payload
+            + struct.pack('>I', zlib.crc32(tag + payload) & 0xFFFFFFFF)
+        )
+
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6))
+        + chunk(b'IEND', b'')
+    )
+
+
+def _raster_text(canvas: np.ndarray, text: str, x: int, y: int, color: tuple, align: str = 'center'):
+    """Вывод подписи шрифтом RASTER_FONT; y - верхний край текста"""
+    step = 4 * RASTER_SCALE
+    width = len(text) * step - RASTER_SCALE
+    if align == 'center':
+        x -= width // 2
+    elif align == 'right':
+        x -= width
+    for char in text:
+        mask = RASTER_GLYPHS.get(char)
+        if mask is not None:
+            area = canvas[y:y + mask.shape[0], x:x + mask.shape[1]]
+            if area.shape[:2] == mask.shape:
+                area[mask] = color
+        x += step
+
+
+def _raster_line(canvas: np.ndarray, x0: float, y0: float, x1: float, y1: float,
+                 color: tuple, dash: int = 10, thickness: int = 2):
+    """Пунктирная линия между двумя точками"""
+    steps = int(max(abs(x1 - x0), abs(y1 - y0))) + 1
+    xs = np.linspace(x0, x1, steps).round().astype(int)
+    ys = np.linspace(y0, y1, steps).round().astype(int)
+    visible = (np.arange(steps) // dash) % 2 == 0
+    xs, ys = xs[visible], ys[visible]
+    height, width, _ = canvas.shape
+    for offset in range(thickness):
+        rows = np.clip(ys + offset, 0, height - 1)
+        canvas[rows, np.clip(xs, 0, width - 1)] = color
+
+
+def render_activity_chart_raster(dates: list[str], counts: list[int], title: str) -> bytes:
+    """Отрисовка графика активности прямо в массив пикселей NumPy
+
+    Столбцы, линия тренда, подписи значений и дат без matplotlib; заголовок
+    не рисуется, он уходит в подпись к фото.
+    """
+    canvas = np.empty((RASTER_HEIGHT, RASTER_WIDTH, 3), dtype=np.uint8)
+    canvas[:] = RASTER_BACKGROUND
+
+    left, right, top, bottom = 70, RASTER_WIDTH - 20, 30, RASTER_HEIGHT - 40
+    plot_height = bottom - top
+
+    # Шкала значений: четыре деления с «круглым» шагом
+    values = np.asarray(counts, dtype=float)
+    tick = max(1, int(np.ceil(values.max() / 4))) if len(values) else 1
+    scale_max = tick * 4
+
+    for i in range(5):
+        y = bottom - plot_height * i // 4
+        canvas[y, left:right] = RASTER_GRID
+        _raster_text(canvas, str(tick * i), left - 8, y - 5, RASTER_AXIS, align='right')
+
+    canvas[top:bottom + 1, left] = RASTER_AXIS
+    canvas[bottom, left:right] = RASTER_AXIS
+
+    if len(values):
+        slot = (right - left) / len(values)
+        bar_width = max(1, int(slot * 0.8))
+        centers = left + slot * (np.arange(len(values)) + 0.5)
+        heights = (values / scale_max * plot_height).round().astype(int)
+        # Подписи дат не должны налезать друг на друга
+        label_every = max(1, int(np.ceil(5 * 4 * RASTER_SCALE / slot)))
+
+        for i, (center, bar_height) in enumerate(zip(centers, heights)):
+            x0 = int(center - bar_width / 2)
+            x1 = x0 + bar_width
+            if bar_height > 0:
+                canvas[bottom - bar_height:bottom, x0:x1] = RASTER_BAR_EDGE
+                if bar_width > 2 and bar_height > 1:
+                    canvas[bottom - bar_height + 1:bottom, x0 + 1:x1 - 1] = RASTER_BAR
+            if slot >= 4 * RASTER_SCALE * len(str(counts[i])):
+                _raster_text(canvas, str(counts[i]), int(center), bottom - bar_height - 14, RASTER_AXIS)
+            if i % label_every == 0:
+                day = dates[i][8:10] + '.' + dates[i][5:7]
+                _raster_text(canvas, day, int(center), bottom + 10, RASTER_AXIS)
+
+        # Линия тренда
+        if len(values) > 1:
+            slope, intercept = np.polyfit(np.arange(len(values)), values, 1)
+            ends = np.array([intercept, intercept + slope * (len(values) - 1)])
+            ys = bottom - ends / scale_max * plot_height
+            _raster_line(canvas, centers[0], ys[0], centers[-1], ys[-1], RASTER_TREND)
+
+    return encode_png(canvas)
+
+
+def render_heatmap_chart(grid: list[int], title: str) -> bytes:
+    """Отрисовка тепловой карты активности по часам недели в PNG (matplotlib)"""
+    if _chart_figure is None:
+        _init_chart_worker()
+
+    ax = _chart_ax
+    ax.clear()
+    values = np.asarray(grid).reshape(7, 24)
+    ax.imshow(values, cmap='YlGn', aspect='auto')
+
+    # Подписи ненулевых ячеек
+    for (day, hour), count in np.ndenumerate(values):
+        if count:
+            ax.text(hour, day, str(count), ha='center', va='center', fontsize=7)
+
+    ax.set_title(title, fontsize=14, pad=20)
+    ax.set_xlabel('Час', fontsize=12)
+    ax.set_xticks(range(24))
+    ax.set_yticks(range(7), labels=WEEKDAY_NAMES)
+    # Наклон подписей остаётся на общих осях после графика активности
+    ax.tick_params(axis='x', labelrotation=0)
+    ax.grid(False)
+
+    _chart_figure.tight_layout()
+    buf = io.BytesIO()
+    _chart_figure.savefig(buf, format='png', dpi=100, bbox_inches='tight')
+    return buf.getvalue()
+
+
+RASTER_HEATMAP_CELL = 36
+RASTER_HEATMAP_EMPTY = (237, 247, 237)
+
+
+def render_heatmap_chart_raster(grid: list[int], title: str) -> bytes:
+    """Тепловая карта по часам недели в массиве пикселей NumPy
+
+    Часы подписаны сверху, дни недели слева номерами (1 - понедельник).
+    """
+    cell = RASTER_HEATMAP_CELL
+    left, top = 40, 40
+    canvas = np.empty((top + 7 * cell + 20, left + 24 * cell + 20, 3), dtype=np.uint8)
+    canvas[:] = RASTER_BACKGROUND
+
+    values = np.asarray(grid, dtype=float).reshape(7, 24)
+    peak = values.max()
+    intensity = (values / peak if peak else values)[..., None]
+    empty = np.asarray(RASTER_HEATMAP_EMPTY, dtype=float)
+    colors = empty + (np.asarray(RASTER_BAR_EDGE, dtype=float) - empty) * intensity
+    cells = colors.round().astype(np.uint8).repeat(cell, axis=0).repeat(cell, axis=1)
+
+    # Белые промежутки между ячейками
+    cells[::cell, :] = RASTER_BACKGROUND
+    cells[:, ::cell] = RASTER_BACKGROUND
+    canvas[top:top + 7 * cell, left:left + 24 * cell] = cells
+
+    for hour in range(24):
+        _raster_text(canvas, str(hour), left + hour * cell + cell // 2, top - 16, RASTER_AXIS)
+    for day in range(7):
+        _raster_text(canvas, str(day + 1), left - 10, top + day * cell + cell // 2 - 5, RASTER_AXIS, align='right')
+
+    return encode_png(canvas)
+
+
+def activity_series(user_data: dict, days: int = 30) -> tuple[list[str], list[int]]:
+    """Последние дни активности пользователя: даты и число сообщений"""
+    return user_data['activity'].last(days)
+
+
+# Функции отрисовки по видам графиков: (matplotlib, raster)
+CHART_KINDS = {
+    'activity': (render_activity_chart, render_activity_chart_raster),
+    'heatmap': (render_heatmap_chart, render_heatmap_chart_raster),
+}
+
+
+class ChartDiskCache:
+    """Дисковый кеш готовых графиков с адресацией по содержимому
+
+    Файл называется хешем входных данных графика, поэтому одинаковые данные
+    не отрисовываются повторно даже после перезапуска. Общий объём
+    ограничен, при переполнении удаляются давно не использованные файлы.
+    Индекс восстанавливается сканированием каталога при запуске.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()  # Имя файла -> размер, от старых к новым
+        self.total_bytes = 0
+        self.evicted = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _scan(self) -> list[tuple[str, int]]:
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.png.tmp'):
+                # Остатки прерванной записи
+                os.remove(entry.path)
+                continue
+            if not entry.name.endswith('.png'):
+                # Каталог может быть общим с файлами состояния, чужое не трогаем
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        entries.sort()
+        return [(key, size) for _, key, size in entries]
+
+    async def start(self):
+        """Восстановление индекса по содержимому каталога"""
+        self._index.clear()
+        self.total_bytes = 0
+        for key, size in await run_io('chart_cache_scan', self._scan):
+            self._index[key] = size
+            self.total_bytes += size
+        self._evict()
+        logger.info(f"Кеш графиков: {len(self._index)} файлов, {self.total_bytes / 1024 / 1024:.1f} МБ")
+
+    def _read(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), 'rb') as f:
+                png = f.read()
+        except FileNotFoundError:
+            return None
+        # Время изменения служит отметкой использования для LRU после перезапуска
+        os.utime(self._path(key))
+        return png
+
+    def _write(self, key: str, png: bytes):
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_path, self._path(key))
+
+    def _remove(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def get(self, key: str) -> bytes | None:
+        if key not in self._index:
+            return None
+        self._index.move_to_end(key)
+        png = await run_io('chart_cache_read', self._read, key)
+        if png is None:
+            self.total_bytes -= self._index.pop(key, 0)
+        return png
+
+    def put(self, key: str, png: bytes):
+        if key in self._index:
+            return
+        self._index[key] = len(png)
+        self.total_bytes += len(png)
+        submit_io('chart_cache_write', self._write, key, png)
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self.total_bytes -= size
+            self.evicted += 1
+            submit_io('chart_cache_remove', self._remove, key)
+
 
-    try:
-        if not os.path.exists(DATA_FILE):
-            init_data_file()
-            return default_data
+chart_disk_cache = ChartDiskCache(data_path(CHART_DISK_CACHE_DIR), int(CHART_DISK_CACHE_MB * 1024 * 1024))
 
-        with open(DATA_FILE, 'r') as f:
-            data = json.load(f)
 
-            # Гарантируем наличие всех ключей первого уровня
-            for key in default_data:
-                if key not in data:
-                    data[key] = default_data[key]
+class ChartRenderer:
+    """Пул процессов для отрисовки графиков с кешем готовых PNG
 
-            # Гарантируем структуру restricted_users
-            for subkey in default_data["restricted_users"]:
-                if subkey not in data["restricted_users"]:
-                    data["restricted_users"][subkey] = {}
+    Отрисовка занимает сотни миллисекунд процессорного времени и не должна
+    останавливать цикл событий. Процессы запускаются заранее и держат
+    импортированный matplotlib, а одинаковые запросы отдаются из LRU-кеша.
+    Растровые графики рисуются в собственном пуле потоков, а не в потоке
+    ввода-вывода, чтобы не задерживать журнал, SQLite и сброс состояния.
+    """
 
-            return data
+    def __init__(self, workers: int, cache_size: int, backend: str = 'matplotlib'):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.backend = backend
+        self._pool = None
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.render_time = 0.0
+        self.render_max = 0.0
+
+    def start(self):
+        """Запуск процессов отрисовки"""
+        if self._pool is not None:
+            return
+        if self.backend == 'raster':
+            # Растровая отрисовка занимает миллисекунды, отдельные процессы не нужны,
+            # но и поток ввода-вывода она занимать не должна
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='chart')
+            return
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_chart_worker
+        )
+        # Процессы создаются при отправке задач, прогреваем их сразу
+        for _ in range(self.workers):
+            self._pool.submit(os.getpid)
+
+    async def render(self, key: tuple, data_key: str, kind: str, *args) -> bytes:
+        png = self._cache.get(key)
+        if png is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return png
+
+        png = await chart_disk_cache.get(data_key)
+        if png is not None:
+            self.disk_hits += 1
+            self._remember(key, png)
+            return png
+
+        self.misses += 1
+        render_full, render_raster = CHART_KINDS[kind]
+        render = render_raster if self.backend == 'raster' else render_full
+        started = time.perf_counter()
+        try:
+            self.start()
+            png = await asyncio.get_running_loop().run_in_executor(self._pool, render, *args)
+        except BrokenProcessPool:
+            logger.error("Процесс отрисовки графиков завершился аварийно, пул будет пересоздан")
+            self._pool = None
+            raise
+        elapsed = time.perf_counter() - started
+        self.render_time += elapsed
+        self.render_max = max(self.render_max, elapsed)
 
-    except Exception as e:
-        logger.error(f"Ошибка загрузки данных: {e}", exc_info=True)
-        init_data_file()
-        return default_data
+        chart_disk_cache.put(data_key, png)
+        self._remember(key, png)
+        return png
 
+    def _remember(self, key: tuple, png: bytes):
+        self._cache[key] = png
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
 
-def save_data(data: dict):
-    """Сохранение данных в файл"""
-    try:
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=4)
-            # logger.info(f"Данные сохранены {data}")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения данных: {e}")
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
 
 
-def init_stats_file():
-    """Инициализация файла статистики"""
-    data_dir = '/app'
-    stats_file = os.path.join(data_dir, STATS_FILE)
+chart_renderer = ChartRenderer(CHART_WORKERS, CHART_CACHE_SIZE, CHART_BACKEND)
 
-    if not os.path.exists(stats_file):
-        with open(STATS_FILE, 'w') as f:
-            json.dump({}, f)
-        os.chmod(STATS_FILE, 0o666)
-        logger.info("Создан новый файл статистики")
 
+def chart_data_key(kind: str, *args) -> str:
+    """Хеш входных данных графика: одинаковые данные дают одинаковую картинку"""
+    payload = json.dumps([CHART_BACKEND, kind, *args], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-def load_stats() -> dict:
-    """Загрузка статистики из файла"""
-    try:
-        if not os.path.exists(STATS_FILE):
-            init_stats_file()
-            return {}
 
-        with open(STATS_FILE, 'r') as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки статистики: {e}")
-        return {}
+class ChartFileIdCache:
+    """Кеш file_id уже загруженных в Telegram графиков
 
+    Если данные графика не изменились, фото отправляется повторно по file_id:
+    без отрисовки и без загрузки файла. Записи вытесняются по LRU и возрасту.
+    """
 
-def save_stats(data: dict):
-    """Сохранение статистики в файл"""
-    try:
-        with open(STATS_FILE, 'w') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения статистики: {e}")
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, file_id: str):
+        self._entries[key] = (file_id, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+
+chart_file_ids = ChartFileIdCache(CHART_FILE_ID_CACHE_SIZE, CHART_FILE_ID_TTL * 3600)
+
+
+@metrics_reporter
+def chart_metrics() -> list[str]:
+    renders = chart_renderer.misses
+    avg = chart_renderer.render_time / renders * 1000 if renders else 0
+    lookups = chart_file_ids.hits + chart_file_ids.misses
+    hit_rate = chart_file_ids.hits / lookups * 100 if lookups else 0
+    return [
+        f"🖼 Графики: из памяти {chart_renderer.hits}, с диска {chart_renderer.disk_hits}, "
+        f"отрисовано {renders}, среднее {avg:.0f} мс, максимум {chart_renderer.render_max * 1000:.0f} мс",
+        f"💾 Кеш графиков на диске: {len(chart_disk_cache._index)} файлов, "
+        f"{chart_disk_cache.total_bytes / 1024 / 1024:.1f} МБ, вытеснено {chart_disk_cache.evicted}",
+        f"📎 Повторная отправка по file_id: {chart_file_ids.hits}/{lookups} ({hit_rate:.0f}%)"
+    ]
 
 
-def log_deleted_message(user_id: str, user_name: str, message_text: str, reason: str):
-    """Логирование удаленных сообщений"""
-    log_entry = {
-        'timestamp': str(datetime.now()),
-        'user_id': user_id,
-        'user_name': user_name,
-        'message': message_text,
-        'reason': reason
-    }
-    logger.info(f"Удалено сообщение: {log_entry}")
+async def send_chart(message: Message, cache_key: tuple, kind: str, args: tuple, caption: str) -> Message:
+    """Отправка графика: по file_id, из кеша или после отрисовки"""
+    data_key = chart_data_key(kind, *args)
+
+    # Тот же график уже загружен в Telegram - отправляем по file_id
+    file_id = chart_file_ids.get(data_key)
+    if file_id:
+        try:
+            return await message.answer_photo(file_id, caption=caption)
+        except TelegramBadRequest as e:
+            logger.warning(f"Сохранённый file_id графика недействителен: {e}")
+            chart_file_ids.invalidate(data_key)
 
+    png = await chart_renderer.render(cache_key, data_key, kind, *args)
+    input_file = types.BufferedInputFile(png, filename=f'{kind}.png')
+    reply_photo = await message.answer_photo(input_file, caption=caption)
+    chart_file_ids.set(data_key, reply_photo.photo[-1].file_id)
+    return reply_photo
 
-async def is_admin(chat_id: int, user_id: int, bot: Bot) -> bool:
-    """Проверка, является ли пользователь администратором"""
+
+async def track_new_messages(message: types.Message):
+    """Трекинг новых сообщений в реальном времени"""
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in ["administrator", "creator"]
+        record_message_stats(message)
     except Exception as e:
-        logger.error(f"Ошибка проверки администратора: {e}")
-        return False
+        logger.error(f"Ошибка трекинга сообщения: {e}")
 
 
-def get_unban_keyboard(user_id: str) -> InlineKeyboardMarkup:
-    """Создание клавиатуры для разбана"""
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Разбанить", callback_data=f"unban_{user_id}")]
-        ]
-    )
+# ======================
+# БЛОКИРОВКИ ПОЛЬЗОВАТЕЛЕЙ
+# ======================
+
+class StripedLock:
+    """Набор asyncio-блокировок, распределённых по ключам
 
+    Изменения состояния одного пользователя выполняются последовательно,
+    а разные пользователи (почти всегда попадающие в разные полосы)
+    обрабатываются параллельно. Память не растёт с числом пользователей.
+    """
+
+    def __init__(self, stripes: int):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+
+    def hold(self, key) -> asyncio.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+
+user_locks = StripedLock(USER_LOCK_STRIPES)
+
+
+# ======================
+# ОТЛОЖЕННОЕ УДАЛЕНИЕ
+# ======================
 
-def generate_activity_plot(user_data: dict, user_name: str) -> tuple[io.BytesIO, str]:
-    """Генерация графика активности с улучшенным дизайном
+class DeletionScheduler:
+    """Единый планировщик отложенного удаления сообщений
 
-    Возвращает:
-        BytesIO: Буфер с изображением графика
-        str: Путь к сохранённому файлу
+    Обработчики регистрируют удаление и сразу завершаются, а одна фоновая
+    задача удаляет сообщения по наступлении срока (min-куча по времени).
+    Очередь сохраняется в файл и переживает перезапуск бота.
     """
-    """Генерация графика активности с современным стилем"""
-    try:
-        # Подготовка данных
-        dates = []
-        counts = []
-
-        sorted_activity = sorted(
-            [(date, count) for date, count in user_data['activity'].items()],
-            key=lambda x: x[0]
-        )[-30:]
-
-        for date_str, count in sorted_activity:
-            dates.append(date_str)
-            counts.append(count)
-
-        # Используем современный стиль вместо 'seaborn'
-        plt.style.use('seaborn-v0_8')  # Или другой доступный стиль
-
-        fig, ax = plt.subplots(figsize=(12, 6))
-
-        # Основной график
-        bars = ax.bar(
-            dates, counts,
-            color='#4CAF50',
-            edgecolor='darkgreen',
-            linewidth=0.7,
-            alpha=0.8
-        )
 
-        # Линия тренда
-        if len(counts) > 1:
-            z = np.polyfit(range(len(counts)), counts, 1)
-            p = np.poly1d(z)
-            ax.plot(
-                dates, p(range(len(counts))),
-                color='#FF5722',
-                linestyle='--',
-                linewidth=2,
-                label='Тренд'
-            )
+    def __init__(self, path: str, flush_interval: int):
+        self.path = path
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self.dirty = False
+        self._task = None
+        self._flusher = PeriodicFlusher(self.flush, flush_interval)
 
-        # Настройки графика
-        ax.set_title(
-            f'Активность пользователя {user_name}\nза последние {len(dates)} дней',
-            fontsize=14,
-            pad=20
-        )
-        ax.set_xlabel('Дата', fontsize=12)
-        ax.set_ylabel('Количество сообщений', fontsize=12)
-        ax.grid(axis='y', linestyle='--', alpha=0.7)
-
-        # Поворот дат на 45 градусов
-        plt.xticks(rotation=45, ha='right')
-
-        # Добавляем значения над столбцами
-        for bar in bars:
-            height = bar.get_height()
-            ax.text(
-                bar.get_x() + bar.get_width() / 2., height,
-                f'{int(height)}',
-                ha='center', va='bottom',
-                fontsize=9
-            )
+    def schedule(self, chat_id: int, message_id: int, delay: float):
+        heapq.heappush(self._heap, (time.time() + delay, chat_id, message_id))
+        self.dirty = True
+        self._wakeup.set()
 
-        # Легенда если есть тренд
-        if len(counts) > 1:
-            ax.legend()
+    def __len__(self) -> int:
+        return len(self._heap)
 
-        plt.tight_layout()
+    def _read(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        return [tuple(item) for item in read_json_file(self.path)]
 
-        # Сохраняем в буфер
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
-        buf.seek(0)
+    def _write(self, items: list):
+        write_json_file(self.path, items)
 
-        # Дополнительно сохраняем в файл
-        plot_filename = f"user_activity_{user_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-        plot_path = os.path.join('tmp', plot_filename)
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        try:
+            await run_io('save_pending_deletions', self._write, list(self._heap))
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Ошибка сохранения очереди удаления: {e}")
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            _, chat_id, message_id = heapq.heappop(self._heap)
+            self.dirty = True
+            await self._delete(chat_id, message_id)
+
+    async def _delete(self, chat_id: int, message_id: int):
+        deletion_batcher.enqueue(chat_id, message_id)
+
+    async def start(self):
+        """Загрузка сохранённой очереди и запуск фоновых задач"""
+        # Ошибка чтения останавливает запуск: иначе очередь перезаписалась бы пустой
+        saved = await run_io('load_pending_deletions', self._read)
+        self._heap.extend(saved)
+        heapq.heapify(self._heap)
+        if saved:
+            logger.info(f"Восстановлено отложенных удалений: {len(saved)}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._flusher.start()
+
+    async def stop(self):
+        """Остановка с сохранением невыполненных удалений"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.dirty = True
+        await self._flusher.stop()
 
-        os.makedirs('tmp', exist_ok=True)
-        plt.savefig(plot_path, format='png', dpi=100, bbox_inches='tight')
 
-        plt.close()
+class DeletionBatcher:
+    """Пакетное удаление сообщений через deleteMessages
 
-        return buf, plot_path
+    Удаления по каждому чату копятся DELETE_BATCH_WINDOW секунд (или до
+    DELETE_BATCH_SIZE штук) и уходят одним запросом. Если пакетный запрос
+    не удался, сообщения удаляются по одному.
+    """
 
-    except Exception as e:
-        logger.error(f"Ошибка генерации графика: {e}", exc_info=True)
-        raise
+    # Границы корзин распределения размеров пакетов
+    BUCKETS = (1, 5, 20, 50, DELETE_BATCH_SIZE)
+
+    def __init__(self, window: float, batch_size: int):
+        self.window = window
+        self.batch_size = batch_size
+        self._pending = defaultdict(list)
+        self._timers = {}
+        # Цикл событий держит на задачи только слабые ссылки
+        self._flushing = set()
+        self.batch_sizes = dict.fromkeys(self.BUCKETS, 0)
+        self.fallbacks = 0
+
+    def enqueue(self, chat_id: int, message_id: int):
+        ids = self._pending[chat_id]
+        ids.append(message_id)
+        if len(ids) >= self.batch_size:
+            timer = self._timers.pop(chat_id, None)
+            if timer is not None:
+                timer.cancel()
+            task = asyncio.create_task(self._flush(chat_id))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self.window)
+        self._timers.pop(chat_id, None)
+        await self._flush(chat_id)
+
+    async def _flush(self, chat_id: int):
+        ids = self._pending.pop(chat_id, [])
+        for start in range(0, len(ids), self.batch_size):
+            await self._delete_batch(chat_id, ids[start:start + self.batch_size])
+
+    async def _delete_batch(self, chat_id: int, ids: list[int]):
+        self.batch_sizes[next(bucket for bucket in self.BUCKETS if len(ids) <= bucket)] += 1
+        try:
+            if len(ids) == 1:
+                await bot.delete_message(chat_id, ids[0])
+            else:
+                await bot.delete_messages(chat_id, ids)
+            return
+        except Exception as e:
+            if len(ids) == 1:
+                logger.error(f"Ошибка удаления сообщения {ids[0]} в чате {chat_id}: {e}")
+                return
+            logger.error(f"Ошибка пакетного удаления в чате {chat_id}, удаляем по одному: {e}")
 
+        self.fallbacks += 1
+        for message_id in ids:
+            try:
+                await bot.delete_message(chat_id, message_id)
+            except Exception as e:
+                logger.error(f"Ошибка удаления сообщения {message_id} в чате {chat_id}: {e}")
 
-async def track_new_messages(message: types.Message):
-    """Трекинг новых сообщений в реальном времени"""
-    try:
-        user_id = str(message.from_user.id)
-        msg_date = message.date.date()
-        date_str = msg_date.strftime('%Y-%m-%d')
+    async def stop(self):
+        """Немедленная отправка накопленных удалений"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+        for chat_id in list(self._pending):
+            await self._flush(chat_id)
 
-        stats_data = load_stats()
 
-        # Инициализируем структуру при необходимости
-        if user_id not in stats_data:
-            stats_data[user_id] = {
-                'total_messages': 0,
-                'activity': {},
-                'username': message.from_user.username,
-                'full_name': message.from_user.full_name,
-                'first_seen': date_str,
-                'last_active': date_str
-            }
+deletion_scheduler = DeletionScheduler(PENDING_DELETIONS_FILE, FLUSH_INTERVAL)
+deletion_batcher = DeletionBatcher(DELETE_BATCH_WINDOW, DELETE_BATCH_SIZE)
 
-        # Обновляем статистику
-        stats_data[user_id]['total_messages'] += 1
-        stats_data[user_id]['activity'][date_str] = stats_data[user_id]['activity'].get(date_str, 0) + 1
-        stats_data[user_id]['last_active'] = date_str
 
-        save_stats(stats_data)
+def schedule_delete(message: Message, delay: float):
+    """Удалить сообщение бота через delay секунд"""
+    deletion_scheduler.schedule(message.chat.id, message.message_id, delay)
 
-    except Exception as e:
-        logger.error(f"Ошибка трекинга сообщения: {e}")
+
+def delete_message_soon(message: Message):
+    """Удалить сообщение в ближайшем пакете"""
+    deletion_batcher.enqueue(message.chat.id, message.message_id)
+
+
+@metrics_reporter
+def deletion_metrics() -> list[str]:
+    sizes = ", ".join(f"≤{bucket}: {count}" for bucket, count in deletion_batcher.batch_sizes.items())
+    return [
+        f"🗑 Ожидают удаления: {len(deletion_scheduler)}",
+        f"🗑 Пакеты удаления по размеру: {sizes}",
+        f"🗑 Откатов на одиночное удаление: {deletion_batcher.fallbacks}"
+    ]
 
 
 # ======================
@@ -362,8 +3040,7 @@ async def restrict_user(message: Message):
     try:
         if not message.reply_to_message:
             reply_msg = await message.reply("ℹ️ Ответьте на сообщение пользователя, которого хотите ограничить")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         target_user = message.reply_to_message.from_user
@@ -383,8 +3060,7 @@ async def restrict_user(message: Message):
     except Exception as e:
         logger.error(f"Ошибка при ограничении пользователя: {e}")
         error_msg = await message.reply("❌ Произошла ошибка при ограничении пользователя")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 @dp.message(Command("unrestrict"), AdminFilter())
@@ -393,8 +3069,7 @@ async def unrestrict_user(message: Message):
     try:
         if not message.reply_to_message:
             reply_msg = await message.reply("ℹ️ Ответьте на сообщение пользователя, которого хотите разограничить")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         target_user = message.reply_to_message.from_user
@@ -415,16 +3090,14 @@ async def unrestrict_user(message: Message):
             )
         else:
             reply_msg = await message.reply("ℹ️ Этот пользователь не был ограничен")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
     except Exception as e:
         logger.error(f"Ошибка при снятии ограничений: {e}")
         error_msg = await message.reply("❌ Произошла ошибка при снятии ограничений")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
-@dp.message(Command("restricted_list"), AdminFilter())
+@dp.message(Command("restricted_list"), AdminFilter(), flags={"lane": "info"})
 async def list_restricted_users(message: Message):
     """Список ограниченных пользователей"""
     data = load_data()
@@ -432,8 +3105,7 @@ async def list_restricted_users(message: Message):
 
     if not restricted_users:
         reply_msg = await message.reply("ℹ️ Нет ограниченных пользователей")
-        await asyncio.sleep(AUTO_REMOVE)
-        await reply_msg.delete()
+        schedule_delete(reply_msg, AUTO_REMOVE)
         return
 
     users_list = []
@@ -443,8 +3115,7 @@ async def list_restricted_users(message: Message):
         users_list.append(f"👤 {name} (ID: {user_id}) - ограничен {restricted_at}")
 
     reply_msg = await message.reply("📋 Ограниченные пользователи:\n\n" + "\n".join(users_list))
-    await asyncio.sleep(AUTO_REMOVE)
-    await reply_msg.delete()
+    schedule_delete(reply_msg, AUTO_REMOVE)
 
 
 @dp.message(Command("ban_links"), AdminFilter())
@@ -453,8 +3124,7 @@ async def ban_links_for_user(message: Message):
     try:
         if not message.reply_to_message:
             reply_msg = await message.reply("ℹ️ Ответьте на сообщение пользователя")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         user = message.reply_to_message.from_user
@@ -473,8 +3143,7 @@ async def ban_links_for_user(message: Message):
     except Exception as e:
         logger.error(f"Ошибка при запрете ссылок: {e}")
         error_msg = await message.reply("❌ Произошла ошибка при запрете ссылок")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 @dp.message(Command("allow_links"), AdminFilter())
@@ -483,8 +3152,7 @@ async def allow_links_for_user(message: Message):
     try:
         if not message.reply_to_message:
             reply_msg = await message.reply("ℹ️ Ответьте на сообщение пользователя")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         user = message.reply_to_message.from_user
@@ -500,16 +3168,14 @@ async def allow_links_for_user(message: Message):
             )
         else:
             reply_msg = await message.reply("ℹ️ Этому пользователю не был запрещён отправка ссылок")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
     except Exception as e:
         logger.error(f"Ошибка при разрешении ссылок: {e}")
         error_msg = await message.reply("❌ Произошла ошибка при разрешении ссылок")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
-@dp.message(Command("link_restrictions"), AdminFilter())
+@dp.message(Command("link_restrictions"), AdminFilter(), flags={"lane": "info"})
 async def show_link_restrictions(message: Message):
     """Показать пользователей с запретом ссылок"""
     try:
@@ -518,8 +3184,7 @@ async def show_link_restrictions(message: Message):
 
         if not restricted:
             reply_msg = await message.reply("ℹ️ Нет пользователей с запретом на ссылки")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         users_list = [
@@ -530,13 +3195,11 @@ async def show_link_restrictions(message: Message):
         reply_msg = await message.reply(
             "📋 Пользователи с запретом на ссылки:\n\n" + "\n".join(users_list)
         )
-        await asyncio.sleep(AUTO_REMOVE)
-        await reply_msg.delete()
+        schedule_delete(reply_msg, AUTO_REMOVE)
     except Exception as e:
         logger.error(f"Ошибка при показе ограничений: {e}")
         error_msg = await message.reply("❌ Произошла ошибка при получении списка ограничений")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 @dp.message(Command("ban_forwards"), AdminFilter())
@@ -545,8 +3208,7 @@ async def ban_forwards_for_user(message: Message):
     try:
         if not message.reply_to_message:
             reply_msg = await message.reply("ℹ️ Ответьте на сообщение пользователя")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         user = message.reply_to_message.from_user
@@ -566,8 +3228,7 @@ async def ban_forwards_for_user(message: Message):
     except Exception as e:
         logger.error(f"Ошибка при запрете пересылки: {e}")
         error_msg = await message.reply("❌ Произошла ошибка при запрете пересылки")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 @dp.message(Command("allow_forwards"), AdminFilter())
@@ -576,8 +3237,7 @@ async def allow_forwards_for_user(message: Message):
     try:
         if not message.reply_to_message:
             reply_msg = await message.reply("ℹ️ Ответьте на сообщение пользователя")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         user = message.reply_to_message.from_user
@@ -593,16 +3253,14 @@ async def allow_forwards_for_user(message: Message):
             )
         else:
             reply_msg = await message.reply("ℹ️ Этому пользователю не был запрещена пересылка")
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
     except Exception as e:
         logger.error(f"Ошибка при разрешении пересылки: {e}")
         error_msg = await message.reply("❌ Произошла ошибка при разрешении пересылки")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
-@dp.message(Command("forward_restrictions"), AdminFilter())
+@dp.message(Command("forward_restrictions"), AdminFilter(), flags={"lane": "info"})
 async def show_forward_restrictions(message: Message):
     """Показать пользователей с запретом пересылки с автоматическим удалением"""
     try:
@@ -612,8 +3270,7 @@ async def show_forward_restrictions(message: Message):
         if not restricted:
             reply_msg = await message.reply("ℹ️ Нет пользователей с запретом на пересылку")
 
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         users_list = [
@@ -624,15 +3281,12 @@ async def show_forward_restrictions(message: Message):
         reply_msg = await message.reply(
             "📋 Пользователи с запретом на пересылку:\n\n" + "\n".join(users_list)
         )
-        # Удаляем сообщение
-        await asyncio.sleep(AUTO_REMOVE)
-        await reply_msg.delete()
+        schedule_delete(reply_msg, AUTO_REMOVE)
 
     except Exception as e:
         logger.error(f"Ошибка при показе ограничений: {e}", exc_info=True)
         error_msg = await message.reply("❌ Произошла ошибка при получении списка ограничений")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 @dp.message(Command("ban_channel"), AdminFilter())
@@ -641,15 +3295,13 @@ async def ban_channel_handler(message: Message):
     try:
         if not message.reply_to_message or not message.reply_to_message.forward_from_chat:
             msg = await message.reply("ℹ️ Ответьте на пересланное сообщение из канала, который нужно заблокировать")
-            await asyncio.sleep(10)
-            await msg.delete()
+            schedule_delete(msg, 10)
             return
 
         channel = message.reply_to_message.forward_from_chat
         if channel.type != "channel":
             msg = await message.reply("❌ Это не канал! Можно блокировать только каналы")
-            await asyncio.sleep(10)
-            await msg.delete()
+            schedule_delete(msg, 10)
             return
 
         data = load_data()
@@ -685,8 +3337,7 @@ async def unban_channel_handler(message: Message):
         # Проверяем, что команда вызвана ответом на пересланное сообщение
         if not message.reply_to_message or not message.reply_to_message.forward_from_chat:
             msg = await message.reply("ℹ️ Ответьте на пересланное сообщение из канала, который нужно разблокировать")
-            await asyncio.sleep(10)
-            await msg.delete()
+            schedule_delete(msg, 10)
             return
 
         channel = message.reply_to_message.forward_from_chat
@@ -696,8 +3347,7 @@ async def unban_channel_handler(message: Message):
         # Проверяем, есть ли канал в списке заблокированных
         if "banned_channels" not in data or channel_id not in data["banned_channels"]:
             msg = await message.reply("ℹ️ Этот канал не заблокирован")
-            await asyncio.sleep(10)
-            await msg.delete()
+            schedule_delete(msg, 10)
             return
 
         # Удаляем канал из списка заблокированных
@@ -716,7 +3366,148 @@ async def unban_channel_handler(message: Message):
 
 
 
-@dp.message(Command("help"))
+@dp.message(Command("metrics"), AdminFilter(), flags={"lane": "info"})
+async def show_metrics(message: Message):
+    """Внутренние метрики бота"""
+    try:
+        lines = []
+        for reporter in metric_reporters:
+            lines.extend(reporter())
+            lines.append("")
+
+        reply_msg = await message.reply("📈 Метрики бота:\n\n" + "\n".join(lines))
+        schedule_delete(reply_msg, AUTO_REMOVE)
+    except Exception as e:
+        logger.error(f"Ошибка при показе метрик: {e}", exc_info=True)
+        error_msg = await message.reply("❌ Произошла ошибка при получении метрик")
+        schedule_delete(error_msg, AUTO_REMOVE)
+
+
+async def deny_other_chat(message: Message, chat_id: int) -> bool:
+    """Отказ в данных чужого чата вне чата администраторов
+
+    Права администратора проверяются в текущем чате, поэтому данные другого
+    чата по chat_id выдаются только в ADMIN_CHAT_ID.
+    """
+    if chat_id == message.chat.id or message.chat.id == ADMIN_CHAT_ID:
+        return False
+    msg = await message.reply("⛔ Данные другого чата доступны только в чате администраторов")
+    schedule_delete(msg, 10)
+    return True
+
+
+@dp.message(Command("chatstats"), F.chat.id == ADMIN_CHAT_ID, AdminFilter(), flags={"lane": "info"})
+async def show_chat_stats(message: Message, command: CommandObject):
+    """Сводная статистика по всем чатам за последние N дней
+
+    При шардировании команду обрабатывает только шард чата администраторов,
+    а его матрица после разделения пополняется лишь сообщениями своих чатов.
+    """
+    try:
+        days = int(command.args) if command.args and command.args.strip().isdigit() else 30
+        report = activity_matrix.report(days)
+        days = report['days']
+        scope = "всем чатам" if SHARD_INDEX is None else f"чатам шарда {SHARD_INDEX} из {SHARD_WORKERS}"
+
+        lines = [
+            f"📊 <b>Статистика по {scope} за {days} дн.</b>\n",
+            f"✉️ Сообщений: <b>{report['total_messages']}</b> "
+            f"(в среднем {report['total_messages'] / days:.1f} в день)",
+            f"👥 Активных участников: <b>{report['active_users']}</b>, "
+            f"новых: {report['new_users']}, вернувшихся: {report['returning_users']}",
+        ]
+
+        if report['top']:
+            lines.append("\n🏆 <b>Самые активные:</b>")
+            for place, (name, count) in enumerate(report['top'], 1):
+                lines.append(f"{place}. {html.escape(name)} - {count}")
+
+        lines.append("\n📅 <b>По дням</b> (сообщений / активных / новых):")
+        for offset in range(max(0, days - 14), days):
+            day = datetime.fromordinal(report['first_day'] + offset).strftime('%d.%m')
+            lines.append(
+                f"{day}: {report['daily_messages'][offset]} / "
+                f"{report['daily_active'][offset]} / {report['daily_new'][offset]}"
+            )
+
+        reply_msg = await message.reply("\n".join(lines), parse_mode="HTML")
+        schedule_delete(reply_msg, AUTO_REMOVE * 3)
+    except Exception as e:
+        logger.error(f"Ошибка в команде chatstats: {e}", exc_info=True)
+        error_msg = await message.reply("❌ Ошибка при получении статистики чата")
+        schedule_delete(error_msg, 10)
+
+
+@dp.message(Command("heatmap"), AdminFilter(), flags={"lane": "info"})
+async def show_heatmap(message: Message, command: CommandObject):
+    """Тепловая карта активности по часам недели для пользователя или чата"""
+    try:
+        if message.reply_to_message:
+            target_user = message.reply_to_message.from_user
+            scope = ('user', str(target_user.id))
+            counters = hour_activity.users.get(scope[1])
+            title = f'Активность {target_user.full_name} по часам недели'
+        else:
+            chat_arg = command.args.strip() if command.args else ''
+            chat_id = int(chat_arg) if chat_arg.lstrip('-').isdigit() else message.chat.id
+            if await deny_other_chat(message, chat_id):
+                return
+            chat_id = str(chat_id)
+            scope = ('chat', chat_id)
+            counters = hour_activity.chats.get(chat_id)
+            title = 'Активность чата по часам недели'
+
+        if counters is None or not any(counters):
+            msg = await message.reply("ℹ️ Нет данных об активности")
+            schedule_delete(msg, 10)
+            return
+
+        grid = counters.tolist()
+        peak_day, peak_hour = divmod(grid.index(max(grid)), 24)
+        caption = (
+            f"🕒 Активность по часам недели (UTC{HEATMAP_UTC_OFFSET:+g}), "
+            f"пик: {WEEKDAY_NAMES[peak_day]} {peak_hour}:00"
+        )
+        reply_photo = await send_chart(message, ('heatmap', *scope, sum(grid)), 'heatmap', (grid, title), caption)
+        schedule_delete(reply_photo, AUTO_REMOVE * 3)
+    except Exception as e:
+        logger.error(f"Ошибка в команде heatmap: {e}", exc_info=True)
+        error_msg = await message.reply("❌ Ошибка при построении тепловой карты")
+        schedule_delete(error_msg, 10)
+
+
+@dp.message(Command("top"), AdminFilter(), flags={"lane": "info"})
+async def show_top(message: Message, command: CommandObject):
+    """Самые активные участники чата за день, неделю или месяц"""
+    try:
+        window, chat_id = 'week', message.chat.id
+        for arg in (command.args or '').split():
+            if arg in LEADERBOARD_WINDOWS:
+                window = arg
+            elif arg.lstrip('-').isdigit():
+                chat_id = int(arg)
+        if await deny_other_chat(message, chat_id):
+            return
+
+        top = leaderboard.top(chat_id, window, LEADERBOARD_SIZE)
+        if not top:
+            msg = await message.reply("ℹ️ Нет данных об активности")
+            schedule_delete(msg, 10)
+            return
+
+        lines = [f"🏆 <b>Самые активные за {LEADERBOARD_WINDOW_NAMES[window]}:</b>\n"]
+        for place, (name, count) in enumerate(top, 1):
+            lines.append(f"{place}. {html.escape(name)} - {count}")
+
+        reply_msg = await message.reply("\n".join(lines), parse_mode="HTML")
+        schedule_delete(reply_msg, AUTO_REMOVE * 3)
+    except Exception as e:
+        logger.error(f"Ошибка в команде top: {e}", exc_info=True)
+        error_msg = await message.reply("❌ Ошибка при получении рейтинга")
+        schedule_delete(error_msg, 10)
+
+
+@dp.message(Command("help"), flags={"lane": "info"})
 async def handle_help(message: Message):
     """Обработчик команды /help"""
     try:
@@ -727,8 +3518,7 @@ async def handle_help(message: Message):
     except Exception as e:
         logger.error(f"Ошибка в обработчике help: {e}")
         error_msg = await message.reply("⚠️ Произошла ошибка при обработке команды")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 async def show_admin_help(message: Message):
@@ -748,6 +3538,10 @@ async def show_admin_help(message: Message):
 <code>/restricted_list</code> - Список ограниченных
 <code>/link_restrictions</code> - Кто не может отправлять ссылки
 <code>/forward_restrictions</code> - Кто не может пересылать сообщения с каналов
+<code>/chatstats [дней]</code> - Сводная статистика по всем чатам (по умолчанию за 30 дней, только в чате администраторов)
+<code>/heatmap [chat_id]</code> - Активность по часам недели (ответьте на сообщение для пользователя; chat_id - только в чате администраторов)
+<code>/top [day|week|month] [chat_id]</code> - Самые активные участники (по умолчанию за неделю; chat_id - только в чате администраторов)
+<code>/metrics</code> - Внутренние метрики бота
 
 
 <b>Автоматические ограничения:</b>
@@ -757,8 +3551,7 @@ async def show_admin_help(message: Message):
 • Система предупреждений (3 = бан) на {BAN_DURATION} минуты
 """
     reply_msg = await message.answer(help_text, parse_mode="HTML")
-    await asyncio.sleep(AUTO_REMOVE)
-    await reply_msg.delete()
+    schedule_delete(reply_msg, AUTO_REMOVE)
 
 
 async def show_user_help(message: Message):
@@ -773,25 +3566,22 @@ async def show_user_help(message: Message):
 /help - показать эту справку
 """
     reply_msg = await message.answer(help_text, parse_mode="HTML")
-    await asyncio.sleep(AUTO_REMOVE)
-    await reply_msg.delete()
+    schedule_delete(reply_msg, AUTO_REMOVE)
 
 
-@dp.message(Command("userstats"), AdminFilter())
+@dp.message(Command("userstats"), AdminFilter(), flags={"lane": "info"})
 async def show_user_stats(message: Message):
     """Показать статистику пользователя с графиком активности"""
     try:
         if not message.reply_to_message:
             msg = await message.reply("ℹ️ Ответьте на сообщение пользователя")
-            await asyncio.sleep(10)
-            await msg.delete()
+            schedule_delete(msg, 10)
             return
 
         target_user = message.reply_to_message.from_user
         user_id = str(target_user.id)
-        stats_data = load_stats()
         mod_data = load_data()
-        user_stats = stats_data.get(user_id, {})
+        user_stats = await get_user_stats(user_id)
 
         # Формируем текстовую часть
         stats_text = (
@@ -808,73 +3598,26 @@ async def show_user_stats(message: Message):
         # Генерируем и отправляем график если есть данные
         if user_stats.get('activity'):
             try:
-                # Подготовка данных
-                dates = []
-                counts = []
-                # Подготовка данных с правильным парсингом дат
-                sorted_activity = sorted(
-                    [(datetime.strptime(date, '%Y-%m-%d'), count)
-                     for date, count in user_stats['activity'].items()],
-                    key=lambda x: x[0]
-                )[-30:]
-
-                # Преобразуем даты обратно в строки для отображения
-                dates = [date.strftime('%Y-%m-%d') for date, _ in sorted_activity]
-                counts = [count for _, count in sorted_activity]
-
-                # Создаем график
-                plt.style.use('seaborn-v0_8')
-                fig, ax = plt.subplots(figsize=(12, 6))
-
-                # Основной график
-                bars = ax.bar(dates, counts, color='#4CAF50', alpha=0.8)
-
-                # Настройки графика
-                ax.set_title(f'Активность {target_user.full_name}')
-                ax.set_xlabel('Дата')
-                ax.set_ylabel('Сообщений')
-                plt.xticks(rotation=45)
-                plt.tight_layout()
-
-                # Сохраняем в буфер
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
-                plt.close()
-
-                # Правильное создание InputFile
-                buf.seek(0)
-                input_file = types.BufferedInputFile(buf.read(), filename='activity.png')
-
-                # Отправляем фото
-                reply_photo = await message.answer_photo(
-                    input_file,
-                    caption=f"📈 Активность за {len(dates)} дней"
+                dates, counts = activity_series(user_stats)
+                reply_photo = await send_chart(
+                    message,
+                    ('activity', user_id, user_stats.get('last_active'), user_stats.get('total_messages', 0),
+                     target_user.full_name),
+                    'activity',
+                    (dates, counts, f'Активность {target_user.full_name}\nза последние {len(dates)} дней'),
+                    f"📈 Активность за {len(dates)} дней"
                 )
-                await asyncio.sleep(AUTO_REMOVE * 3)
-                await reply_photo.delete()
+                schedule_delete(reply_photo, AUTO_REMOVE * 3)
             except Exception as e:
                 logger.error(f"Ошибка генерации графика: {e}", exc_info=True)
-            finally:
-                buf.close()
 
         # Удаляем текстовое сообщение через 300 сек
-        await asyncio.sleep(AUTO_REMOVE * 3)
-        await reply_msg.delete()
+        schedule_delete(reply_msg, AUTO_REMOVE * 3)
 
     except Exception as e:
         logger.error(f"Ошибка в команде userstats: {e}", exc_info=True)
         error_msg = await message.reply("❌ Ошибка при получении статистики")
-        await asyncio.sleep(10)
-        await error_msg.delete()
-
-
-async def delete_later(filepath: str, delay: int = 300):
-    """Удаление файла с задержкой"""
-    await asyncio.sleep(delay)
-    try:
-        os.remove(filepath)
-    except Exception as e:
-        logger.error(f"Ошибка удаления файла {filepath}: {e}")
+        schedule_delete(error_msg, 10)
 
 
 # ======================
@@ -900,8 +3643,7 @@ async def handle_voice_message(message: Message):
     except Exception as e:
         logger.error(f"Ошибка обработки голосового: {e}")
         error_msg = await message.reply("⚠️ Ошибка обработки голосового сообщения")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 @dp.message(
@@ -928,8 +3670,7 @@ async def handle_video_note(message: Message):
         logger.error(f"Ошибка обработки видеосообщения: {e}", exc_info=True)
         try:
             error_msg = await message.reply("⚠️ Ошибка обработки видеосообщения")
-            await asyncio.sleep(AUTO_REMOVE)
-            await error_msg.delete()
+            schedule_delete(error_msg, AUTO_REMOVE)
         except Exception as delete_error:
             logger.error(f"Ошибка при удалении сообщения: {delete_error}")
 
@@ -949,7 +3690,7 @@ async def handle_channel_forward(message: Message):
 
         # 1. Проверка блокировки канала
         if "banned_channels" in data and channel_id in data["banned_channels"]:
-            await message.delete()
+            delete_message_soon(message)
             channel_info = data["banned_channels"][channel_id]
 
             warning = await message.answer(
@@ -966,24 +3707,25 @@ async def handle_channel_forward(message: Message):
                 chat_id=message.chat.id
             )
 
-            await asyncio.sleep(10)
-            await warning.delete()
+            schedule_delete(warning, 10)
             return
 
         # 2. Проверка запрета пересылки для пользователя
         if user_id in data['restricted_users']['no_forwards']:
-            await message.delete()
+            delete_message_soon(message)
             reply_msg = await message.answer(
                 f"⛔ {message.from_user.mention_html()}, вам запрещена пересылка сообщений",
                 parse_mode='HTML'
             )
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
-        # 3. Проверка запрещённых фраз в тексте
-        text = message.text or message.caption or ""
-        if text and any(phrase in text.lower() for phrase in BANNED_PHRASES):
+        verdict = scan_message(message)
+
+        # 3. Проверка запрещённых фраз в тексте и ссылках
+        phrase = verdict.violation
+        if phrase:
+            logger.info(f"Запрещённая фраза '{phrase}' в пересылке от {user_id}")
             await handle_rule_break(
                 message=message,
                 reason=f"пересылка из канала {channel.title} с запрещённой фразой",
@@ -994,23 +3736,21 @@ async def handle_channel_forward(message: Message):
             return
 
         # 4. Проверка запрещённых фраз в документах
-        if message.document and message.document.file_name:
-            filename = message.document.file_name.lower()
-            if any(phrase in filename for phrase in BANNED_PHRASES):
-                await handle_rule_break(
-                    message=message,
-                    reason=f"пересылка файла с запрещённым названием из канала {channel.title}",
-                    data=data,
-                    user_id=user_id,
-                    chat_id=message.chat.id
-                )
-                return
+        if verdict.filename_phrase:
+            logger.info(f"Запрещённая фраза '{verdict.filename_phrase}' в имени файла от {user_id}")
+            await handle_rule_break(
+                message=message,
+                reason=f"пересылка файла с запрещённым названием из канала {channel.title}",
+                data=data,
+                user_id=user_id,
+                chat_id=message.chat.id
+            )
+            return
 
     except Exception as e:
         logger.error(f"Ошибка обработки пересланного сообщения: {e}", exc_info=True)
         error_msg = await message.reply("⚠️ Ошибка обработки сообщения")
-        await asyncio.sleep(AUTO_REMOVE)
-        await error_msg.delete()
+        schedule_delete(error_msg, AUTO_REMOVE)
 
 
 @dp.message(
@@ -1028,55 +3768,37 @@ async def check_regular_message(message: Message):
         data = load_data()
         user_id = str(message.from_user.id)
         chat_id = message.chat.id
-        current_date = message.date.strftime('%Y-%m-%d')
-
-        # Загружаем текущую статистику
-        stats = load_stats()
-
-        # Инициализируем структуру для нового пользователя
-        if user_id not in stats:
-            stats[user_id] = {
-                'total_messages': 0,
-                'activity': {},
-                'username': message.from_user.username,
-                'full_name': message.from_user.full_name,
-                'first_seen': current_date
-            }
 
         # Обновляем статистику
-        stats[user_id]['total_messages'] += 1
-        stats[user_id]['activity'][current_date] = stats[user_id]['activity'].get(current_date, 0) + 1
-        stats[user_id]['last_active'] = current_date
+        record_message_stats(message)
 
-        # Сохраняем обновлённые данные
-        save_stats(stats)
+        verdict = scan_message(message)
 
         # Проверка ограниченных пользователей
         if user_id in data.get('restricted_users', {}).get('fully_restricted', {}):
-            await message.delete()
+            delete_message_soon(message)
             reply_msg = await message.answer(
                 f"⛔ {message.from_user.mention_html()}, ваши сообщения ограничены",
                 parse_mode='HTML'
             )
-            await asyncio.sleep(AUTO_REMOVE)
-            await reply_msg.delete()
+            schedule_delete(reply_msg, AUTO_REMOVE)
             return
 
         # Проверка запрета ссылок
         if user_id in data.get('restricted_users', {}).get('no_links', {}):
-            if contains_links(message):
-                await message.delete()
+            if verdict.has_links:
+                delete_message_soon(message)
                 reply_msg = await message.answer(
                     f"⛔ {message.from_user.mention_html()}, вам запрещены ссылки",
                     parse_mode='HTML'
                 )
-                await asyncio.sleep(AUTO_REMOVE)
-                await reply_msg.delete()
+                schedule_delete(reply_msg, AUTO_REMOVE)
                 return
 
-        # Проверка текста на запрещенные фразы
-        text = message.text or message.caption or ""
-        if text and any(phrase in text.lower() for phrase in BANNED_PHRASES):
+        # Проверка текста на запрещённые фразы и ссылок по индексу доменов
+        phrase = verdict.violation
+        if phrase:
+            logger.info(f"Запрещённая фраза '{phrase}' в сообщении от {user_id}")
             await handle_rule_break(
                 message=message,
                 reason="запрещённые ссылки",
@@ -1086,75 +3808,150 @@ async def check_regular_message(message: Message):
             )
             return
 
-        # Проверка URL в entities
-        for entity in (message.entities or []) + (message.caption_entities or []):
-            if entity.type in ["url", "text_link"]:
-                url = ""
-                if entity.type == "url":
-                    url = text[entity.offset:entity.offset + entity.length]
-                elif entity.type == "text_link":
-                    url = entity.url
-
-                if url and any(phrase in url.lower() for phrase in BANNED_PHRASES):
-                    await handle_rule_break(
-                        message=message,
-                        reason="запрещённые ссылки",
-                        data=data,
-                        user_id=user_id,
-                        chat_id=chat_id
-                    )
-                    return
-
     except Exception as e:
         logger.error(f"Ошибка проверки сообщения: {e}")
 
 
-def contains_links(message: Message) -> bool:
-    """Проверка наличия ссылок в сообщении"""
-    # Проверка текста
-    if message.text or message.caption:
-        text = (message.text or message.caption).lower()
-        if any(proto in text for proto in ['http://', 'https://', 'www.', 't.me/', 'vk.com']):
-            return True
-
-    # Проверка entities
-    entities = message.entities or message.caption_entities or []
-    for entity in entities:
-        if entity.type in ["url", "text_link"]:
-            return True
-
-    # Проверка кнопок
-    if message.reply_markup:
+@dataclass
+class ScanVerdict:
+    """Результат проверки сообщения"""
+    has_links: bool = False
+    phrases: list[str] = field(default_factory=list)
+    blocked_urls: list[str] = field(default_factory=list)
+    offending_entity: MessageEntity | None = None
+    filename_phrase: str | None = None
+
+    @property
+    def violation(self) -> str | None:
+        """Первое найденное нарушение в тексте или ссылках"""
+        if self.phrases:
+            return self.phrases[0]
+        if self.blocked_urls:
+            return self.blocked_urls[0]
+        return None
+
+
+def scan_message(message: Message) -> ScanVerdict:
+    """Проверка текста, entities, имени файла и кнопок сообщения за один проход"""
+    verdict = ScanVerdict()
+
+    # Текст: запрещённые фразы и признаки ссылок одним проходом автомата
+    text = message.text or message.caption or ""
+    for phrase in scan_matcher.find_all(text):
+        if phrase in LINK_MARKERS:
+            verdict.has_links = True
+        if phrase in text_phrases:
+            verdict.phrases.append(phrase)
+
+    # Entities текста и подписи
+    for source, entities in ((message.text, message.entities), (message.caption, message.caption_entities)):
+        url_entities = []
+        for entity in entities or []:
+            if entity.type == "url" and source:
+                url = entity.extract_from(source)
+                url_entities.append(entity)
+            elif entity.type == "text_link":
+                url = entity.url
+            else:
+                continue
+
+            verdict.has_links = True
+            rule = url_blocklist.match(url)
+            if rule:
+                verdict.blocked_urls.append(rule)
+                if verdict.offending_entity is None:
+                    verdict.offending_entity = entity
+
+        # Адреса без entity (например, внутри code/pre) проверяются по тексту
+        if source and url_blocklist.rules:
+            for token in find_host_tokens(blank_entities(source, url_entities)):
+                rule = url_blocklist.match(token)
+                if rule:
+                    verdict.has_links = True
+                    verdict.blocked_urls.append(rule)
+
+    # Имя документа
+    if message.document and message.document.file_name:
+        verdict.filename_phrase = banned_matcher.search(message.document.file_name)
+
+    # Кнопки
+    if message.reply_markup and getattr(message.reply_markup, 'inline_keyboard', None):
         for row in message.reply_markup.inline_keyboard:
             for button in row:
                 if button.url:
-                    return True
+                    verdict.has_links = True
+                    rule = url_blocklist.match(button.url)
+                    if rule:
+                        verdict.blocked_urls.append(rule)
+
+    return verdict
+
+
+# Чаты, в которых уже применён текущий бан: user_id -> (срок бана, {chat_id})
+# Бан общий для всех чатов, а ограничение Telegram действует в одном чате,
+# поэтому нарушение в другом чате применяет тот же бан и там
+ban_chats = {}
 
-    return False
+
+def register_violation(data: dict, user_id: str, chat_id: int) -> tuple[int, datetime | None] | None:
+    """Учёт нарушения в состоянии модерации, без сетевых вызовов
+
+    Возвращает число предупреждений и срок бана, если бан нужно применить
+    в этом чате, или None, если в этом чате он уже применён.
+    """
+    banned_until = data['banned'].get(user_id)
+    if banned_until is not None:
+        until, chats = ban_chats.get(user_id, (None, None))
+        if until != banned_until:
+            chats = set()
+            ban_chats[user_id] = (banned_until, chats)
+        if chat_id in chats:
+            return None
+        chats.add(chat_id)
+        return data['warnings'].get(user_id, MAX_WARNINGS), datetime.strptime(banned_until, ExpiryIndex.TIME_FORMAT)
+
+    # Добавление предупреждения
+    data['warnings'][user_id] = data['warnings'].get(user_id, 0) + 1
+    warnings = data['warnings'][user_id]
+    data['warned_at'][user_id] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    expiry_index.track_warning(user_id, data['warned_at'][user_id])
+
+    ban_until = None
+    if warnings >= MAX_WARNINGS:
+        ban_until = datetime.now() + timedelta(minutes=BAN_DURATION)
+        data['banned'][user_id] = ban_until.strftime('%Y-%m-%d %H:%M:%S')
+        expiry_index.track_ban(user_id, data['banned'][user_id])
+        ban_chats[user_id] = (data['banned'][user_id], {chat_id})
+
+    save_data(data)
+    return warnings, ban_until
 
 
 async def handle_rule_break(message: Message, reason: str, data: dict, user_id: str, chat_id: int):
-    """Обработка нарушений правил"""
+    """Обработка нарушений правил
+
+    Изменение состояния выполняется под блокировкой пользователя и без
+    ожидания сети: одновременные нарушения дают ровно один бан, а сетевые
+    вызовы не задерживают других пользователей той же полосы блокировок.
+    """
     try:
         # Логирование
         log_text = message.text or message.caption or "[медиа-сообщение]"
         log_deleted_message(user_id, message.from_user.full_name, log_text, reason)
 
         # Удаление сообщения
-        await message.delete()
+        delete_message_soon(message)
 
-        # Добавление предупреждения
-        data['warnings'][user_id] = data.get('warnings', {}).get(user_id, 0) + 1
-        warnings = data['warnings'][user_id]
-        save_data(data)
+        async with user_locks.hold(user_id):
+            violation = register_violation(data, user_id, chat_id)
+        if violation is None:
+            # Бан в этом чате уже применён параллельным нарушением
+            return
+        warnings, ban_until = violation
 
         # Уведомление пользователя
-        if warnings >= MAX_WARNINGS:
+        if ban_until is not None:
             # Бан пользователя
-            ban_until = datetime.now() + timedelta(minutes=BAN_DURATION)
-            data['banned'][user_id] = ban_until.strftime('%Y-%m-%d %H:%M:%S')
-            save_data(data)
-
             await bot.restrict_chat_member(
                 chat_id=chat_id,
                 user_id=user_id,
@@ -1168,20 +3965,23 @@ async def handle_rule_break(message: Message, reason: str, data: dict, user_id:
             )
 
             # Уведомление для администраторов
-            admins = await bot.get_chat_administrators(chat_id)
+            try:
+                admins = await admin_roster.get(chat_id, bot)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки администраторов чата {chat_id}: {e}")
+                admins = []
             admins_mentions = "\n".join([f"@{admin.user.username}" for admin in admins if admin.user.username])
 
             warning_msg = await message.answer(
                 f"⚠️ Пользователь {message.from_user.mention_html()} получил бан на {BAN_DURATION} минут "
                 f"за нарушение правил ({reason}).\n\n"
-                f"Админы могут разбанить:",
+                f"Админы могут разбанить:\n{admins_mentions}",
                 reply_markup=get_unban_keyboard(user_id),
                 parse_mode='HTML'
             )
 
             # Удаление уведомления через BAN_DURATION
-            await asyncio.sleep(int(BAN_DURATION) * 60)
-            await warning_msg.delete()
+            schedule_delete(warning_msg, int(BAN_DURATION) * 60)
         else:
             # Обычное предупреждение
             warning_msg = await message.answer(
@@ -1191,8 +3991,7 @@ async def handle_rule_break(message: Message, reason: str, data: dict, user_id:
             )
 
             # Удаление уведомления через 10 секунд
-            await asyncio.sleep(int(BAN_DURATION) * 60)
-            await warning_msg.delete()
+            schedule_delete(warning_msg, int(BAN_DURATION) * 60)
 
     except Exception as e:
         logger.error(f"Ошибка обработки нарушения: {e}")
@@ -1214,28 +4013,44 @@ async def unban_callback_handler(callback: CallbackQuery):
             await callback.answer("Только администраторы могут разбанивать", show_alert=True)
             return
 
-        data = load_data()
-
-        if user_id not in data['banned']:
+        # Состояние меняется под блокировкой, запрос к API - после её снятия
+        async with user_locks.hold(user_id):
+            data = load_data()
+            until = data['banned'].pop(user_id, None)
+            if until is not None:
+                previous = (data['warnings'].get(user_id), data['warned_at'].pop(user_id, None))
+                ban_chats.pop(user_id, None)
+                data['warnings'][user_id] = 0
+                save_data(data)
+
+        if until is None:
             await callback.answer("Пользователь не забанен", show_alert=True)
             return
 
         # Снятие ограничений
-        await bot.restrict_chat_member(
-            chat_id=chat_id,
-            user_id=user_id,
-            permissions=ChatPermissions(
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True
+        try:
+            await bot.restrict_chat_member(
+                chat_id=chat_id,
+                user_id=user_id,
+                permissions=ChatPermissions(
+                    can_send_messages=True,
+                    can_send_media_messages=True,
+                    can_send_other_messages=True,
+                    can_add_web_page_previews=True
+                )
             )
-        )
-
-        # Обновление данных
-        data['banned'].pop(user_id)
-        data['warnings'][user_id] = 0
-        save_data(data)
+        except Exception:
+            # Ограничение осталось в силе: возвращаем бан, чтобы разбан можно было повторить
+            async with user_locks.hold(user_id):
+                if user_id not in data['banned']:
+                    data['banned'][user_id] = until
+                    warnings, warned_at = previous
+                    if warnings is not None:
+                        data['warnings'][user_id] = warnings
+                    if warned_at is not None:
+                        data['warned_at'][user_id] = warned_at
+                    save_data(data)
+            raise
 
         await callback.answer("Пользователь разбанен", show_alert=True)
         await callback.message.edit_text(
@@ -1247,13 +4062,50 @@ async def unban_callback_handler(callback: CallbackQuery):
         await callback.answer("Произошла ошибка", show_alert=True)
 
 
+# ======================
+# ИЗМЕНЕНИЯ УЧАСТНИКОВ
+# ======================
+
+@dp.chat_member()
+async def handle_chat_member_update(event: ChatMemberUpdated):
+    """Обновление кэша при изменении статуса участника"""
+    admin_statuses = ["administrator", "creator"]
+    if event.old_chat_member.status in admin_statuses or event.new_chat_member.status in admin_statuses:
+        admin_roster.invalidate(event.chat.id)
+    admin_cache.set(
+        event.chat.id,
+        event.new_chat_member.user.id,
+        event.new_chat_member.status in ["administrator", "creator"]
+    )
+
+
+@dp.my_chat_member()
+async def handle_my_chat_member_update(event: ChatMemberUpdated):
+    """Сброс кэша чата при изменении прав самого бота"""
+    admin_cache.invalidate(event.chat.id)
+    admin_roster.invalidate(event.chat.id)
+
+
 # ======================
 # ЗАПУСК БОТА
 # ======================
 
 async def on_startup():
     """Действия при запуске бота"""
-    init_data_file()
+    await run_io('ensure_data_dir', ensure_data_dir)
+    await data_storage.start()
+    await moderation_state.start()
+    expiry_index.start()
+    stats = await run_io('load_stats', load_stats)
+    await run_io('activity_matrix_load', activity_matrix.load, stats, utc_today())
+    await hour_activity.start()
+    await leaderboard.start()
+    await deletion_scheduler.start()
+    await chart_disk_cache.start()
+    chart_renderer.start()
+    await admin_roster.warm(bot, [chat_id for chat_id in MODERATED_CHATS if owns_chat(chat_id)])
+    if SHARD_INDEX not in (None, 0):
+        return
     try:
         await bot.send_message(
             chat_id=ADMIN_CHAT_ID,
@@ -1263,9 +4115,316 @@ async def on_startup():
         logger.error(f"Ошибка отправки уведомления о запуске: {e}")
 
 
+async def on_shutdown():
+    """Действия при остановке бота"""
+    await deletion_scheduler.stop()
+    await deletion_batcher.stop()
+    await expiry_index.stop()
+    await hour_activity.stop()
+    await leaderboard.stop()
+    await moderation_state.stop()
+    await data_storage.stop()
+    chart_renderer.stop()
+    io_executor.shutdown(wait=True)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничение числа одновременно обрабатываемых обновлений"""
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    """Проверка живости для прокси и оркестратора"""
+    return web.json_response({
+        "status": "ok",
+        "mode": BOT_MODE,
+        "pending_deletions": len(deletion_scheduler)
+    })
+
+
+async def on_webhook_startup():
+    """Регистрация webhook в Telegram"""
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(max(WEBHOOK_MAX_UPDATES, 1), 100)
+    )
+    logger.info(f"Webhook установлен на {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+
+async def run_webhook(dispatcher: Dispatcher):
+    """Приём обновлений через встроенный aiohttp-сервер"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужно указать WEBHOOK_URL")
+
+    dispatcher.update.outer_middleware(ConcurrencyLimitMiddleware(WEBHOOK_MAX_UPDATES))
+    dispatcher.startup.register(on_webhook_startup)
+
+    app = web.Application()
+    app.router.add_get(HEALTH_PATH, handle_health)
+    SimpleRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+
+    # В отличие от start_polling, aiohttp-сервер сам сигналы не обрабатывает:
+    # без этого docker stop завершил бы процесс, минуя on_shutdown
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    stop_signals = (signal.SIGTERM, signal.SIGINT)
+    for sig in stop_signals:
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Сервер webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+        await stop.wait()
+        logger.info("Получен сигнал остановки, сервер webhook завершает работу")
+    finally:
+        for sig in stop_signals:
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
+
+
+# ======================
+# ШАРДИРОВАНИЕ ПО ЧАТАМ
+# ======================
+
+def get_update_chat_id(update: Update) -> int | None:
+    """Чат, к которому относится обновление"""
+    event = update.event
+    if isinstance(event, CallbackQuery):
+        return event.message.chat.id if event.message else None
+    chat = getattr(event, 'chat', None)
+    return chat.id if chat else None
+
+
+def chat_shard(chat_id: int | None) -> int:
+    """Номер шарда, владеющего чатом"""
+    return chat_id % SHARD_WORKERS if chat_id is not None else 0
+
+
+def owns_chat(chat_id: int) -> bool:
+    """Обслуживается ли чат текущим процессом"""
+    return SHARD_INDEX is None or chat_shard(chat_id) == SHARD_INDEX
+
+
+class ShardRouterMiddleware(BaseMiddleware):
+    """Пересылка обновлений процессу-обработчику, владеющему чатом"""
+
+    def __init__(self, inboxes: list):
+        self.inboxes = inboxes
+        self.routed = [0] * len(inboxes)
+
+    async def __call__(self, handler, event: Update, data):
+        shard = chat_shard(get_update_chat_id(event))
+        self.inboxes[shard].put(('update', event.model_dump_json(exclude_none=True, by_alias=True)))
+        self.routed[shard] += 1
+
+
+def run_shard_worker(inbox, events):
+    """Точка входа процесса-обработчика"""
+    global shard_events
+    shard_events = events
+    try:
+        asyncio.run(shard_worker_main(inbox))
+    except KeyboardInterrupt:
+        pass
+
+
+async def shard_worker_main(inbox):
+    """Обработка обновлений своего шарда и синхронизация общих разделов"""
+    loop = asyncio.get_running_loop()
+    # Сигнал всей группе процессов (Ctrl+C, остановка контейнера с init)
+    # завершает обработчик так же, как команда приёмника
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, inbox.put, ('stop',))
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    logger.info(f"Обработчик шарда {SHARD_INDEX} запущен")
+
+    tasks = set()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item[0] == 'stop':
+                break
+            if item[0] == 'sync':
+                moderation_state.apply_replicated(*item[1:])
+                continue
+            task = asyncio.create_task(dp.feed_raw_update(bot, json.loads(item[1])))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
+
+async def relay_shard_events(events, inboxes: list):
+    """Рассылка изменений общих разделов всем шардам, кроме источника"""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await loop.run_in_executor(None, events.get)
+        if item[0] == 'stop':
+            return
+        _, origin, path, key, value = item
+        for index, inbox in enumerate(inboxes):
+            if index != origin:
+                inbox.put(('sync', path, key, value))
+
+
+def seed_shards():
+    """Перенос состояния из общих файлов в файлы шардов при первом запуске
+
+    Данные пользователей (предупреждения, баны, ограничения, статистика,
+    активность по часам) и база SQLite копируются во все шарды, а данные
+    чатов (отложенные удаления, активность чатов, рейтинги) - только
+    владельцу чата. Уже существующие файлы шардов не трогаются.
+    """
+    def missing(path: str, target: str = None) -> list[int]:
+        """Шарды без своей копии target, если есть общий файл path"""
+        if not os.path.exists(path):
+            return []
+        target = target or path
+        return [index for index in range(SHARD_WORKERS) if not os.path.exists(shard_file(target, index))]
+
+    def owned(chat_id, index: int) -> bool:
+        return chat_shard(int(chat_id)) == index
+
+    def seeded(path: str, shards: list[int]):
+        logger.info(f"Состояние {path} перенесено в шарды {shards}")
+
+    shards = missing(DATA_FILE)
+    if shards:
+        data = read_data_file()
+        for index in shards:
+            write_json_file(shard_file(DATA_FILE, index), data, indent=4)
+        seeded(DATA_FILE, shards)
+
+    # Снимок без журнала не полон, поэтому статистика собирается из обоих;
+    # запущенный однажды шард всегда имеет свой снимок
+    shards = missing(STATS_FILE) or missing(STATS_JOURNAL_FILE, STATS_FILE)
+    if shards:
+        stats = stats_journal.load()
+        for index in shards:
+            write_stats_file(stats, shard_file(STATS_FILE, index))
+        stats_journal.stats = None
+        seeded(STATS_FILE, shards)
+
+    shards = missing(PENDING_DELETIONS_FILE)
+    if shards:
+        pending = read_json_file(PENDING_DELETIONS_FILE)
+        for index in shards:
+            write_json_file(shard_file(PENDING_DELETIONS_FILE, index),
+                            [item for item in pending if owned(item[1], index)])
+        seeded(PENDING_DELETIONS_FILE, shards)
+
+    shards = missing(HOUR_ACTIVITY_FILE)
+    if shards:
+        saved = read_json_file(HOUR_ACTIVITY_FILE)
+        for index in shards:
+            write_json_file(shard_file(HOUR_ACTIVITY_FILE, index), {
+                'users': saved.get('users', {}),
+                'chats': {key: values for key, values in saved.get('chats', {}).items() if owned(key, index)}
+            })
+        seeded(HOUR_ACTIVITY_FILE, shards)
+
+    shards = missing(LEADERBOARD_FILE)
+    if shards:
+        saved = read_json_file(LEADERBOARD_FILE)
+        for index in shards:
+            write_json_file(shard_file(LEADERBOARD_FILE, index),
+                            {key: state for key, state in saved.items() if owned(key, index)},
+                            ensure_ascii=False)
+        seeded(LEADERBOARD_FILE, shards)
+
+    sqlite_path = data_path(SQLITE_FILE)
+    shards = missing(sqlite_path) if STORAGE_BACKEND == 'sqlite' else []
+    if shards:
+        source = sqlite3.connect(sqlite_path)
+        try:
+            for index in shards:
+                target = sqlite3.connect(shard_file(sqlite_path, index))
+                try:
+                    # Резервное копирование SQLite учитывает и файл -wal
+                    source.backup(target)
+                finally:
+                    target.close()
+        finally:
+            source.close()
+        seeded(sqlite_path, shards)
+
+
+async def run_sharded():
+    """Процесс-приёмник: получает обновления и раздаёт их обработчикам по chat_id"""
+    await run_io('seed_shards', seed_shards)
+
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(SHARD_WORKERS)]
+    events = context.Queue()
+
+    workers = []
+    for index in range(SHARD_WORKERS):
+        # Процесс-обработчик читает свой номер из окружения при импорте модуля
+        os.environ['SHARD_INDEX'] = str(index)
+        worker = context.Process(target=run_shard_worker, args=(inboxes[index], events))
+        worker.start()
+        workers.append(worker)
+    os.environ.pop('SHARD_INDEX', None)
+
+    router = ShardRouterMiddleware(inboxes)
+    front_dp = Dispatcher()
+    front_dp.update.outer_middleware(allowed_chats)
+    front_dp.update.outer_middleware(router)
+    relay = asyncio.create_task(relay_shard_events(events, inboxes))
+
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(front_dp)
+        else:
+            await bot.delete_webhook()
+            await front_dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop',))
+        events.put(('stop',))
+        await relay
+        loop = asyncio.get_running_loop()
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, 30)
+        logger.info(f"Обновлений передано по шардам: {router.routed}")
+
+
 async def main():
+    if SHARD_WORKERS > 1:
+        await run_sharded()
+        return
+
     dp.startup.register(on_startup)
-    await dp.start_polling(bot)
+    dp.shutdown.register(on_shutdown)
+    if BOT_MODE == 'webhook':
+        await run_webhook(dp)
+        return
+
+    # Long polling не работает, пока у бота установлен webhook
+    await bot.delete_webhook()
+    # chat_member приходит только при явном запросе в allowed_updates
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
 if __name__ == "__main__":
@@ -1,6 +1,17 @@
 #!/bin/bash
-# Создаем файлы с правильной структурой
-echo '{
+# Каталог данных монтируется в контейнер целиком (см. docker-compose.yml)
+mkdir -p data
+
+# Перенос файлов из прежней схемы, где каждый файл монтировался отдельно
+for file in moderation_data.json user_stats.json user_stats.journal pending_deletions.json hour_activity.json leaderboard.json; do
+  if [ -f "$file" ] && [ ! -f "data/$file" ]; then
+    mv "$file" "data/$file"
+    echo "Перенесён $file в data/"
+  fi
+done
+
+# Создаем недостающие файлы с правильной структурой, существующие не трогаем
+[ -f data/moderation_data.json ] || echo '{
   "warnings": {},
   "banned": {},
   "restricted_users": {
@@ -8,13 +19,18 @@ echo '{
     "fully_restricted": {},
     "no_forwards": {}
   },
-  "banned_channels": {}
-}' > moderation_data.json
+  "banned_channels": {},
+  "warned_at": {}
+}' > data/moderation_data.json
 
-echo '{}' > user_stats.json
+[ -f data/user_stats.json ] || echo '{}' > data/user_stats.json
+[ -f data/pending_deletions.json ] || echo '[]' > data/pending_deletions.json
+[ -f data/hour_activity.json ] || echo '{}' > data/hour_activity.json
+[ -f data/leaderboard.json ] || echo '{}' > data/leaderboard.json
 touch moderation.log
 
 # Устанавливаем правильные права
-chmod 666 moderation_data.json user_stats.json moderation.log
+chmod 777 data
+chmod 666 data/*.json moderation.log
 
 echo "Файлы инициализированы"
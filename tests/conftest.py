@@ -0,0 +1,118 @@
+"""Общая настройка тестов: окружение бота, чистое состояние и поддельный Telegram
+
+bot.py читает конфигурацию и создаёт файлы состояния при импорте,
+поэтому переменные окружения и рабочий каталог задаются до импорта.
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST-TOKEN')
+os.environ.setdefault('ADMIN_CHAT_ID', '-1000')
+os.chdir(tempfile.mkdtemp(prefix='moderation-bot-tests-'))
+
+import bot as bot_module  # noqa: E402
+
+
+@pytest.fixture
+def bot_env(monkeypatch):
+    """Модуль бота с пустым состоянием модерации и статистики"""
+    for path in (bot_module.DATA_FILE, bot_module.STATS_FILE, bot_module.STATS_JOURNAL_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    monkeypatch.setattr(bot_module.moderation_state, 'data', None)
+    monkeypatch.setattr(bot_module.stats_journal, 'stats', None)
+    monkeypatch.setattr(bot_module, 'ban_chats', {})
+    # Блокировки asyncio привязываются к циклу событий, у каждого теста он свой
+    monkeypatch.setattr(bot_module, 'user_locks', bot_module.StripedLock(bot_module.USER_LOCK_STRIPES))
+    return bot_module
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f'user{user_id}'
+        self.full_name = f'User {user_id}'
+
+    def mention_html(self) -> str:
+        return self.full_name
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class FakeTelegram:
+    """Запоминает сетевые вызовы и отвечает с задержкой, как настоящий API"""
+
+    def __init__(self):
+        self.restricted = []
+        self.notices = []
+        self.next_message_id = 1_000_000
+
+    async def delay(self):
+        await asyncio.sleep(random.uniform(0, 0.01))
+
+    async def restrict_chat_member(self, chat_id, user_id, **kwargs):
+        await self.delay()
+        self.restricted.append((chat_id, user_id))
+
+    def message(self, user: FakeUser, chat_id: int, text: str) -> 'FakeMessage':
+        self.next_message_id += 1
+        return FakeMessage(chat_id, user, text, telegram=self, message_id=self.next_message_id)
+
+
+class FakeMessage:
+    """Сообщение с полями, которые читают обработчики бота
+
+    Ответы сохраняются в replies, а при заданном telegram ещё и уходят
+    в него как сетевой вызов.
+    """
+
+    def __init__(self, chat_id: int, user: FakeUser = None, text: str = None,
+                 telegram: FakeTelegram = None, message_id: int = 1):
+        self.telegram = telegram
+        self.from_user = user
+        self.chat = FakeChat(chat_id)
+        self.message_id = message_id
+        self.text = text
+        self.caption = None
+        self.reply_to_message = None
+        self.date = datetime.now(timezone.utc)
+        self.replies = []
+
+    async def answer(self, text, **kwargs):
+        self.replies.append(text)
+        if self.telegram is None:
+            return self
+        await self.telegram.delay()
+        self.telegram.notices.append(text)
+        return self.telegram.message(FakeUser(0), self.chat.id, text)
+
+    async def reply(self, text, **kwargs):
+        return await self.answer(text, **kwargs)
+
+
+@pytest.fixture
+def telegram(bot_env, monkeypatch) -> FakeTelegram:
+    """Поддельный Telegram вместо сетевых вызовов бота"""
+    telegram = FakeTelegram()
+    monkeypatch.setattr(bot_env.bot, 'restrict_chat_member', telegram.restrict_chat_member)
+
+    async def no_admins(chat_id, bot):
+        await telegram.delay()
+        return []
+
+    monkeypatch.setattr(bot_env.admin_roster, 'get', no_admins)
+    monkeypatch.setattr(bot_env, 'delete_message_soon', lambda message: None)
+    monkeypatch.setattr(bot_env, 'schedule_delete', lambda message, delay: None)
+    return telegram
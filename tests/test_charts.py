@@ -0,0 +1,84 @@
+"""Отрисовка графиков в пулах matplotlib и raster"""
+import asyncio
+import threading
+
+import pytest
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+DATES = [f'2024-01-{day:02d}' for day in range(1, 8)]
+COUNTS = [1, 5, 3, 2, 7, 4, 6]
+GRID = [hour % 5 for hour in range(7 * 24)]
+
+
+def png_size(png: bytes) -> bytes:
+    """Ширина и высота из заголовка IHDR"""
+    return png[16:24]
+
+
+@pytest.fixture
+def disk_cache(bot_env, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_env, 'chart_disk_cache', bot_env.ChartDiskCache(str(tmp_path), 1 << 30))
+
+
+@pytest.fixture
+def renderer(bot_env, disk_cache):
+    pytest.importorskip('matplotlib')
+    # Один процесс, чтобы все графики рисовались на одних и тех же осях
+    renderer = bot_env.ChartRenderer(1, 8, 'matplotlib')
+    yield renderer
+    renderer.stop()
+
+
+def test_matplotlib_renders_both_kinds_on_reused_axes(renderer):
+    async def scenario():
+        charts = []
+        for step, (kind, args) in enumerate([
+            ('heatmap', (GRID, 'Активность по часам')),
+            ('activity', (DATES, COUNTS, 'Активность')),
+            ('heatmap', (GRID, 'Активность по часам')),
+            ('activity', (DATES, COUNTS, 'Активность')),
+        ]):
+            # Разные ключи, чтобы каждый график действительно отрисовывался
+            charts.append(await renderer.render((kind, step), f'{kind}-{step}', kind, *args))
+        return charts
+
+    first_heatmap, first_activity, heatmap, activity = asyncio.run(scenario())
+
+    assert renderer.misses == 4
+    for png in (first_heatmap, first_activity, heatmap, activity):
+        assert png.startswith(PNG_SIGNATURE)
+    # Оформление графика активности не переносится на тепловую карту и обратно
+    assert heatmap == first_heatmap
+    assert png_size(activity) == png_size(first_activity)
+
+
+def test_raster_charts_do_not_wait_for_io_thread(bot_env, disk_cache):
+    renderer = bot_env.ChartRenderer(1, 8, 'raster')
+    release = threading.Event()
+
+    async def scenario():
+        # Поток ввода-вывода занят долгой операцией, например сбросом в SQLite
+        busy = bot_env.io_executor.submit(release.wait, 10)
+        try:
+            return await asyncio.wait_for(renderer.render(('heatmap',), 'heatmap', 'heatmap', GRID, ''), 5)
+        finally:
+            release.set()
+            busy.result()
+            renderer.stop()
+
+    assert asyncio.run(scenario()).startswith(PNG_SIGNATURE)
+
+
+def test_disk_cache_scan_keeps_foreign_files(bot_env, tmp_path):
+    # Кеш настроен на каталог с файлами состояния
+    (tmp_path / 'moderation_data.json').write_text('{}')
+    (tmp_path / 'stats.db').write_bytes(b'SQLite')
+    (tmp_path / 'ab12.png').write_bytes(PNG_SIGNATURE)
+    (tmp_path / 'cd34.png.tmp').write_bytes(PNG_SIGNATURE[:3])
+    cache = bot_env.ChartDiskCache(str(tmp_path), 1 << 30)
+
+    asyncio.run(cache.start())
+
+    assert list(cache._index) == ['ab12']
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['ab12.png', 'moderation_data.json', 'stats.db']
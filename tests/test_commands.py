@@ -0,0 +1,70 @@
+"""Доступ к данным чужих чатов в командах администратора"""
+import asyncio
+
+import pytest
+from aiogram.filters import CommandObject
+
+from conftest import FakeMessage
+
+OTHER_CHAT = -200
+
+
+@pytest.fixture
+def sent_charts(bot_env, monkeypatch):
+    charts = []
+
+    async def send_chart(message, key, kind, args, caption):
+        charts.append(key)
+        return message
+
+    monkeypatch.setattr(bot_env, 'send_chart', send_chart)
+    monkeypatch.setattr(bot_env, 'schedule_delete', lambda message, delay: None)
+    monkeypatch.setattr(bot_env.hour_activity, 'chats', {})
+    bot_env.hour_activity._counters(bot_env.hour_activity.chats, str(OTHER_CHAT))[0] = 5
+    return charts
+
+
+def heatmap(bot_env, chat_id: int, args: str = None) -> FakeMessage:
+    message = FakeMessage(chat_id)
+    asyncio.run(bot_env.show_heatmap(message, CommandObject(command='heatmap', args=args)))
+    return message
+
+
+def test_heatmap_of_other_chat_is_denied_outside_admin_chat(bot_env, sent_charts):
+    message = heatmap(bot_env, -100, str(OTHER_CHAT))
+    assert sent_charts == []
+    assert message.replies and message.replies[0].startswith('⛔')
+
+
+def test_heatmap_of_other_chat_from_admin_chat(bot_env, sent_charts):
+    heatmap(bot_env, bot_env.ADMIN_CHAT_ID, str(OTHER_CHAT))
+    assert sent_charts == [('heatmap', 'chat', str(OTHER_CHAT), 5)]
+
+
+def test_heatmap_of_own_chat(bot_env, sent_charts):
+    heatmap(bot_env, OTHER_CHAT)
+    assert sent_charts == [('heatmap', 'chat', str(OTHER_CHAT), 5)]
+
+
+def top(bot_env, chat_id: int, args: str) -> FakeMessage:
+    message = FakeMessage(chat_id)
+    asyncio.run(bot_env.show_top(message, CommandObject(command='top', args=args)))
+    return message
+
+
+@pytest.fixture
+def other_chat_top(bot_env, monkeypatch):
+    monkeypatch.setattr(bot_env, 'schedule_delete', lambda message, delay: None)
+    monkeypatch.setattr(bot_env.leaderboard, 'chats', {})
+    bot_env.leaderboard.record(OTHER_CHAT, '7', 'User 7', bot_env.utc_today())
+
+
+def test_top_of_other_chat_is_denied_outside_admin_chat(bot_env, other_chat_top):
+    message = top(bot_env, -100, f'day {OTHER_CHAT}')
+    assert len(message.replies) == 1
+    assert message.replies[0].startswith('⛔')
+
+
+def test_top_of_other_chat_from_admin_chat(bot_env, other_chat_top):
+    message = top(bot_env, bot_env.ADMIN_CHAT_ID, f'day {OTHER_CHAT}')
+    assert 'User 7 - 1' in message.replies[0]
@@ -0,0 +1,192 @@
+"""Одновременные нарушения и учёт сообщений одного пользователя"""
+import asyncio
+import random
+from datetime import datetime, timezone
+
+from conftest import FakeTelegram, FakeUser
+
+
+def test_concurrent_violations_give_exactly_one_ban(bot_env, telegram):
+    chat_id = -100
+    user = FakeUser(42)
+
+    async def scenario():
+        data = bot_env.load_data()
+        await asyncio.gather(*(
+            bot_env.handle_rule_break(
+                telegram.message(user, chat_id, 'vk.com'), 'ссылка', data, str(user.id), chat_id
+            )
+            for _ in range(3000)
+        ))
+        return data
+
+    data = asyncio.run(scenario())
+
+    assert data['warnings']['42'] == bot_env.MAX_WARNINGS
+    assert '42' in data['banned']
+    assert telegram.restricted == [(chat_id, '42')]
+    assert sum('получил бан' in notice for notice in telegram.notices) == 1
+    assert len(telegram.notices) == bot_env.MAX_WARNINGS
+
+
+def test_ban_is_applied_in_every_chat_where_rules_are_broken(bot_env, telegram):
+    user = FakeUser(42)
+
+    async def violate(chat_id: int, times: int):
+        await asyncio.gather(*(
+            bot_env.handle_rule_break(
+                telegram.message(user, chat_id, 'vk.com'), 'ссылка', data, str(user.id), chat_id
+            )
+            for _ in range(times)
+        ))
+
+    async def scenario():
+        await violate(-100, bot_env.MAX_WARNINGS)
+        # Бан общий, но в другом чате его ещё нужно применить
+        await violate(-200, 5)
+
+    data = bot_env.load_data()
+    asyncio.run(scenario())
+
+    assert telegram.restricted == [(-100, '42'), (-200, '42')]
+    assert sum('получил бан' in notice for notice in telegram.notices) == 2
+    assert data['warnings']['42'] == bot_env.MAX_WARNINGS
+
+
+def test_many_users_violating_concurrently(bot_env, telegram):
+    chat_id = -100
+    users = [FakeUser(user_id) for user_id in range(1, 201)]
+    violations = [user for user in users for _ in range(20)]
+    random.shuffle(violations)
+
+    async def scenario():
+        data = bot_env.load_data()
+        await asyncio.gather(*(
+            bot_env.handle_rule_break(
+                telegram.message(user, chat_id, 'vk.com'), 'ссылка', data, str(user.id), chat_id
+            )
+            for user in violations
+        ))
+        return data
+
+    data = asyncio.run(scenario())
+
+    assert all(data['warnings'][str(user.id)] == bot_env.MAX_WARNINGS for user in users)
+    assert set(data['banned']) == {str(user.id) for user in users}
+    assert sorted(user_id for _, user_id in telegram.restricted) == sorted(str(user.id) for user in users)
+
+
+def test_network_calls_do_not_block_lock_stripe(bot_env, telegram, monkeypatch):
+    monkeypatch.setattr(bot_env, 'user_locks', bot_env.StripedLock(1))
+    chat_id = -100
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_restrict(chat_id, user_id, **kwargs):
+            await release.wait()
+            telegram.restricted.append((chat_id, user_id))
+
+        monkeypatch.setattr(bot_env.bot, 'restrict_chat_member', slow_restrict)
+        data = bot_env.load_data()
+        data['warnings']['1'] = bot_env.MAX_WARNINGS - 1
+
+        # Бан первого пользователя ждёт сети, второй пользователь той же полосы не ждёт
+        banning = asyncio.create_task(bot_env.handle_rule_break(
+            telegram.message(FakeUser(1), chat_id, 'vk.com'), 'ссылка', data, '1', chat_id
+        ))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(bot_env.handle_rule_break(
+            telegram.message(FakeUser(2), chat_id, 'vk.com'), 'ссылка', data, '2', chat_id
+        ), timeout=1)
+        assert data['warnings']['2'] == 1
+        assert not banning.done()
+
+        release.set()
+        await banning
+
+    asyncio.run(scenario())
+    assert telegram.restricted == [(chat_id, '1')]
+
+
+class FakeCallback:
+    def __init__(self, telegram: FakeTelegram, admin: FakeUser, chat_id: int, user_id: str):
+        self.data = f'unban_{user_id}'
+        self.from_user = admin
+        self.message = telegram.message(FakeUser(0), chat_id, 'бан')
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+def test_unban_does_not_hold_lock_stripe_during_api_call(bot_env, telegram, monkeypatch):
+    monkeypatch.setattr(bot_env, 'user_locks', bot_env.StripedLock(1))
+    chat_id = -100
+
+    async def always_admin(chat_id, user_id, bot):
+        return True
+
+    async def edit_text(text, **kwargs):
+        pass
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_restrict(chat_id, user_id, **kwargs):
+            await release.wait()
+            telegram.restricted.append((chat_id, user_id))
+
+        monkeypatch.setattr(bot_env, 'is_admin', always_admin)
+        monkeypatch.setattr(bot_env.bot, 'restrict_chat_member', slow_restrict)
+        data = bot_env.load_data()
+        data['banned']['1'] = '2099-01-01 00:00:00'
+        data['warnings']['1'] = bot_env.MAX_WARNINGS
+
+        callback = FakeCallback(telegram, FakeUser(99), chat_id, '1')
+        callback.message.edit_text = edit_text
+        unbanning = asyncio.create_task(bot_env.unban_callback_handler(callback))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(bot_env.handle_rule_break(
+            telegram.message(FakeUser(2), chat_id, 'vk.com'), 'ссылка', data, '2', chat_id
+        ), timeout=1)
+        assert '1' not in data['banned']
+        assert not unbanning.done()
+
+        release.set()
+        await unbanning
+        return callback
+
+    callback = asyncio.run(scenario())
+    assert telegram.restricted == [(chat_id, '1')]
+    assert callback.answers == ['Пользователь разбанен']
+
+
+def test_concurrent_stats_increments_are_exact(bot_env, telegram):
+    chat_id = -100
+    users = [FakeUser(user_id) for user_id in range(1, 51)]
+    messages = [user for user in users for _ in range(100)]
+    random.shuffle(messages)
+
+    async def track(user: FakeUser):
+        await asyncio.sleep(random.uniform(0, 0.005))
+        await bot_env.track_new_messages(telegram.message(user, chat_id, 'привет'))
+
+    async def scenario():
+        await asyncio.gather(*(track(user) for user in messages))
+        # Дожидаемся записи журнала в потоке ввода-вывода
+        await bot_env.run_io('test_barrier', lambda: None)
+
+    asyncio.run(scenario())
+
+    stats = bot_env.load_stats()
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    for user in users:
+        user_stats = stats[str(user.id)]
+        assert user_stats['total_messages'] == 100
+        assert user_stats['activity'].get(today) == 100
+
+    # Журнал на диске восстанавливает те же итоги
+    bot_env.stats_journal.stats = None
+    replayed = bot_env.load_stats()
+    assert all(replayed[str(user.id)]['total_messages'] == 100 for user in users)
@@ -0,0 +1,17 @@
+"""Снятие истёкших банов и затухание предупреждений"""
+import pytest
+
+
+@pytest.mark.parametrize('decay_hours, warnings_left', [(0, 3), (24, None)])
+def test_expired_ban_keeps_warnings_unless_decay_is_enabled(bot_env, decay_hours, warnings_left):
+    index = bot_env.ExpiryIndex(decay_hours)
+    data = bot_env.load_data()
+    data['banned']['7'] = '2024-05-01 10:00:00'
+    data['warnings']['7'] = 3
+    data['warned_at']['7'] = '2024-05-01 09:00:00'
+
+    assert index._expire('ban', '7', '2024-05-01 10:00:00')
+
+    assert '7' not in data['banned']
+    assert data['warnings'].get('7') == warnings_left
+    assert ('7' in data['warned_at']) == (warnings_left is not None)
@@ -0,0 +1,32 @@
+"""Проверка сообщений на запрещённые ссылки"""
+from aiogram.types import Message
+
+
+def message(text: str, entities: list[dict] = ()) -> Message:
+    return Message.model_validate({
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': -100, 'type': 'supergroup'},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'User'},
+        'text': text,
+        'entities': list(entities)
+    })
+
+
+def test_address_in_code_formatting_is_blocked(bot_env):
+    text = 'смотри 👉 vk.com/clip-1_2'
+    verdict = bot_env.scan_message(message(text, [{'type': 'code', 'offset': 10, 'length': 15}]))
+    assert verdict.violation == 'vk.com'
+    assert verdict.has_links
+
+
+def test_address_with_url_entity_is_reported_once(bot_env):
+    text = 'https://m.vk.com/id1'
+    verdict = bot_env.scan_message(message(text, [{'type': 'url', 'offset': 0, 'length': len(text)}]))
+    assert verdict.blocked_urls == ['vk.com']
+    assert verdict.offending_entity is not None
+
+
+def test_lookalike_domains_are_not_blocked(bot_env):
+    verdict = bot_env.scan_message(message('notvk.com и vk.community и 3.14'))
+    assert verdict.violation is None
@@ -0,0 +1,84 @@
+"""Перенос общего состояния в файлы шардов при переходе на SHARD_WORKERS"""
+import json
+import sqlite3
+
+import pytest
+
+SHARD0_CHAT, SHARD1_CHAT = -100, -201
+
+
+@pytest.fixture
+def unsharded(bot_env, monkeypatch, tmp_path):
+    """Общие файлы состояния в отдельном каталоге и два шарда"""
+    monkeypatch.setattr(bot_env, 'SHARD_WORKERS', 2)
+    for name in ('DATA_FILE', 'STATS_FILE', 'PENDING_DELETIONS_FILE', 'HOUR_ACTIVITY_FILE', 'LEADERBOARD_FILE'):
+        monkeypatch.setattr(bot_env, name, str(tmp_path / getattr(bot_env, name)))
+    journal = str(tmp_path / 'user_stats.journal')
+    monkeypatch.setattr(bot_env, 'STATS_JOURNAL_FILE', journal)
+    monkeypatch.setattr(bot_env.stats_journal, 'journal_path', journal)
+    monkeypatch.setattr(bot_env.stats_journal, 'old_journal_path', f"{journal}.old")
+
+    data = bot_env.read_data_file()
+    data['banned']['7'] = '2099-01-01T00:00:00'
+    bot_env.write_data_file(data)
+    # Журнал дописывается в потоке ввода-вывода: ждём записи и закрываем файл
+    bot_env.stats_journal._close()
+    bot_env.stats_journal.record('7', '2024-05-01', 'user7', 'User 7')
+    bot_env.io_executor.submit(bot_env.stats_journal._close).result()
+    bot_env.stats_journal.stats = None
+    bot_env.write_json_file(bot_env.PENDING_DELETIONS_FILE, [[1.0, SHARD0_CHAT, 1], [2.0, SHARD1_CHAT, 2]])
+    bot_env.write_json_file(bot_env.HOUR_ACTIVITY_FILE, {
+        'users': {'7': [1] * 168},
+        'chats': {str(SHARD0_CHAT): [2] * 168, str(SHARD1_CHAT): [3] * 168}
+    })
+    bot_env.write_json_file(bot_env.LEADERBOARD_FILE, {
+        str(SHARD0_CHAT): {'today': 1, 'users': {}},
+        str(SHARD1_CHAT): {'today': 1, 'users': {}}
+    })
+    return bot_env
+
+
+def read_shard(bot_env, path: str, index: int):
+    with open(bot_env.shard_file(path, index), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_user_state_goes_to_every_shard_and_chat_state_to_its_owner(unsharded):
+    bot_env = unsharded
+    bot_env.seed_shards()
+
+    for index, chat_id in enumerate((SHARD0_CHAT, SHARD1_CHAT)):
+        assert read_shard(bot_env, bot_env.DATA_FILE, index)['banned'] == {'7': '2099-01-01T00:00:00'}
+        assert read_shard(bot_env, bot_env.STATS_FILE, index)['7']['total_messages'] == 1
+        assert [item[1] for item in read_shard(bot_env, bot_env.PENDING_DELETIONS_FILE, index)] == [chat_id]
+        hours = read_shard(bot_env, bot_env.HOUR_ACTIVITY_FILE, index)
+        assert list(hours['users']) == ['7']
+        assert list(hours['chats']) == [str(chat_id)]
+        assert list(read_shard(bot_env, bot_env.LEADERBOARD_FILE, index)) == [str(chat_id)]
+
+
+def test_existing_shard_files_are_kept(unsharded):
+    bot_env = unsharded
+    bot_env.write_json_file(bot_env.shard_file(bot_env.LEADERBOARD_FILE, 1), {})
+    bot_env.seed_shards()
+
+    assert read_shard(bot_env, bot_env.LEADERBOARD_FILE, 1) == {}
+    assert list(read_shard(bot_env, bot_env.LEADERBOARD_FILE, 0)) == [str(SHARD0_CHAT)]
+
+
+def test_sqlite_database_is_copied_to_every_shard(bot_env, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_env, 'SHARD_WORKERS', 2)
+    monkeypatch.setattr(bot_env, 'STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setattr(bot_env, 'DATA_DIR', str(tmp_path))
+    base = tmp_path / bot_env.SQLITE_FILE
+    with sqlite3.connect(base) as conn:
+        conn.execute("CREATE TABLE bans (user_id TEXT PRIMARY KEY, until TEXT NOT NULL)")
+        conn.execute("INSERT INTO bans VALUES ('7', '2099-01-01T00:00:00')")
+    conn.close()
+
+    bot_env.seed_shards()
+
+    for index in range(2):
+        conn = sqlite3.connect(bot_env.shard_file(str(base), index))
+        assert conn.execute("SELECT user_id FROM bans").fetchall() == [('7',)]
+        conn.close()
@@ -0,0 +1,169 @@
+"""Сохранность снимков состояния при сбоях записи"""
+import asyncio
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+
+def test_stats_snapshot_roundtrip(bot_env):
+    stats = bot_env.load_stats()
+    bot_env.stats_journal.record('7', '2024-05-01', 'user7', 'User 7')
+    bot_env.write_stats_file(bot_env.copy_stats(stats))
+
+    bot_env.stats_journal.stats = None
+    assert bot_env.read_stats_file()['7']['activity'].to_dict() == {'2024-05-01': 1}
+    assert not os.path.exists(f"{bot_env.STATS_FILE}.tmp")
+
+
+def test_torn_snapshot_is_never_replaced_with_empty_stats(bot_env):
+    with open(bot_env.STATS_FILE, 'w') as f:
+        f.write('{"7": {"total_messages": 3, "act')
+
+    with pytest.raises(RuntimeError):
+        bot_env.read_stats_file()
+    with pytest.raises(RuntimeError):
+        bot_env.stats_journal.load()
+    assert bot_env.stats_journal.stats is None
+
+
+def test_torn_snapshot_falls_back_to_backup(bot_env):
+    backup = f"{bot_env.STATS_FILE}.bak"
+    with open(backup, 'w') as f:
+        json.dump({'7': {'total_messages': 3, 'activity': ['2024-05-01', [3]]}}, f)
+    with open(bot_env.STATS_FILE, 'w') as f:
+        f.write('{"7": {"total_messages": 3, "act')
+
+    try:
+        assert bot_env.read_stats_file()['7']['total_messages'] == 3
+    finally:
+        os.remove(backup)
+
+
+def test_in_place_rewrite_keeps_backup_until_done(bot_env, monkeypatch):
+    path = bot_env.STATS_FILE
+    bot_env.write_json_file(path, {'old': 1})
+
+    # Смонтированный отдельно файл: os.replace невозможен
+    def busy(source, target):
+        raise OSError(16, 'Device or resource busy')
+
+    copies = []
+    real_copy = bot_env._copy_durable
+
+    def tracking_copy(source, target):
+        copies.append((os.path.basename(source), os.path.basename(target)))
+        real_copy(source, target)
+
+    monkeypatch.setattr(bot_env.os, 'replace', busy)
+    monkeypatch.setattr(bot_env, '_copy_durable', tracking_copy)
+    bot_env.write_json_file(path, {'new': 2})
+
+    name = os.path.basename(path)
+    assert copies == [(name, f'{name}.bak'), (f'{name}.tmp', name)]
+    with open(path) as f:
+        assert json.load(f) == {'new': 2}
+    assert not os.path.exists(f'{path}.bak')
+
+
+def test_sqlite_import_runs_once_and_archives_json(bot_env, tmp_path):
+    data = bot_env.read_data_file()
+    data['warnings']['7'] = 2
+    bot_env.write_data_file(data)
+    bot_env.stats_journal.record('7', '2024-05-01', 'user7', 'User 7')
+
+    storage = bot_env.SqliteStorage(str(tmp_path / 'moderation.db'))
+    storage._open()
+    try:
+        assert storage.load_moderation()['warnings'] == {'7': 2}
+        assert storage.load_stats()['7']['total_messages'] == 1
+        for path in (bot_env.DATA_FILE, bot_env.STATS_FILE):
+            assert not os.path.exists(path)
+            assert os.path.exists(f"{path}.imported")
+        assert not os.path.exists(bot_env.STATS_JOURNAL_FILE)
+    finally:
+        storage._close()
+
+
+def test_background_state_is_flushed_on_stop(bot_env, tmp_path):
+    async def scenario():
+        counters = bot_env.HourOfWeekCounters(str(tmp_path / 'hours.json'), 3600, 0)
+        board = bot_env.Leaderboard(str(tmp_path / 'top.json'), 3600)
+        scheduler = bot_env.DeletionScheduler(str(tmp_path / 'pending.json'), 3600)
+        for component in (counters, board, scheduler):
+            await component.start()
+
+        counters.record(-100, '7', datetime(2024, 5, 6, 10))
+        board.record(-100, '7', 'User 7', bot_env.utc_today())
+        scheduler.schedule(-100, 42, 3600)
+
+        for component in (counters, board, scheduler):
+            await component.stop()
+        return counters, board, scheduler
+
+    counters, board, scheduler = asyncio.run(scenario())
+
+    users, chats = counters._read()
+    assert users['7'][counters.slot(datetime(2024, 5, 6, 10))] == 1
+    assert board._read()[-100].top('day', 1) == [('User 7', 1)]
+    assert [item[1:] for item in scheduler._read()] == [(-100, 42)]
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_background_state_falls_back_to_backup_or_stops_startup(bot_env, tmp_path):
+    path = tmp_path / 'hours.json'
+    counters = bot_env.HourOfWeekCounters(str(path), 3600, 0)
+    counters.record(-100, '7', datetime(2024, 5, 6, 10))
+    counters._write(counters.users, counters.chats)
+    os.replace(path, f"{path}.bak")
+    path.write_text('{"users": {"7": [0, 0')
+
+    async def start_and_stop(component):
+        await component.start()
+        await component.stop()
+
+    restored = bot_env.HourOfWeekCounters(str(path), 3600, 0)
+    asyncio.run(start_and_stop(restored))
+    assert sum(restored.users['7']) == 1
+
+    os.remove(f"{path}.bak")
+    path.write_text('{"users": {"7": [0, 0')
+    for component in (bot_env.HourOfWeekCounters(str(path), 3600, 0),
+                      bot_env.Leaderboard(str(path), 3600),
+                      bot_env.DeletionScheduler(str(path), 3600)):
+        with pytest.raises(RuntimeError):
+            asyncio.run(start_and_stop(component))
+    assert path.read_text() == '{"users": {"7": [0, 0'
+
+
+def test_sqlite_saves_only_changed_moderation_rows(bot_env, tmp_path):
+    storage = bot_env.SqliteStorage(str(tmp_path / 'moderation.db'))
+    storage._open()
+    try:
+        data = storage.load_moderation()
+        for user_id in range(100):
+            data['warnings'][str(user_id)] = 1
+        data['banned']['5'] = '2030-01-01 00:00:00'
+        data['restricted_users']['no_links']['6'] = {'until': '2030-01-01 00:00:00'}
+        storage.save_moderation(data)
+
+        statements = []
+        storage.conn.set_trace_callback(statements.append)
+        data['warnings']['7'] = 2
+        del data['warnings']['8']
+        del data['banned']['5']
+        storage.save_moderation(data)
+        storage.conn.set_trace_callback(None)
+
+        writes = [sql for sql in statements if sql.startswith(('INSERT', 'DELETE'))]
+        assert sorted(writes) == [
+            "DELETE FROM bans WHERE user_id = '5'",
+            "DELETE FROM warnings WHERE user_id = '8'",
+            "INSERT OR REPLACE INTO warnings VALUES ('7', 2)",
+        ]
+        reopened = bot_env.SqliteStorage(storage.path)
+        assert reopened.load_moderation() == data
+        reopened._close()
+    finally:
+        storage._close()
@@ -0,0 +1,112 @@
+"""Режим webhook против локального поддельного сервера Telegram"""
+import asyncio
+import os
+import signal
+import socket
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+SECRET = 'test-secret'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotApi:
+    """Bot API, который запоминает вызовы методов"""
+
+    def __init__(self):
+        self.calls = []
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.calls.append(request.match_info['method'])
+        return web.json_response({'ok': True, 'result': True})
+
+
+def update(update_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': -100, 'type': 'supergroup'},
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'User'},
+            'text': text
+        }
+    }
+
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+async def wait_for_health(client: aiohttp.ClientSession, url: str, timeout: float = 5) -> dict:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        try:
+            async with client.get(url) as response:
+                return await response.json()
+        except aiohttp.ClientConnectorError:
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.01)
+
+
+def test_webhook_serves_updates_and_shuts_down_on_sigterm(bot_env, monkeypatch):
+    port = free_port()
+    monkeypatch.setattr(bot_env, 'WEBHOOK_URL', 'https://bot.example')
+    monkeypatch.setattr(bot_env, 'WEBHOOK_SECRET', SECRET)
+    monkeypatch.setattr(bot_env, 'WEBHOOK_HOST', '127.0.0.1')
+    monkeypatch.setattr(bot_env, 'WEBHOOK_PORT', port)
+
+    received, shutdowns = [], []
+    dispatcher = Dispatcher()
+    dispatcher.message.register(lambda message: received.append(message.text))
+    dispatcher.shutdown.register(lambda: shutdowns.append(True))
+
+    async def scenario():
+        telegram = FakeBotApi()
+        runner = web.AppRunner(telegram.app)
+        await runner.setup()
+        api_port = free_port()
+        await web.TCPSite(runner, '127.0.0.1', api_port).start()
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{api_port}'))
+        monkeypatch.setattr(bot_env, 'bot', Bot(bot_env.API_TOKEN, session=session))
+        server = asyncio.create_task(bot_env.run_webhook(dispatcher))
+        base = f'http://127.0.0.1:{port}'
+        try:
+            await wait_for(lambda: 'setWebhook' in telegram.calls)
+            async with aiohttp.ClientSession() as client:
+                # setWebhook уходит при запуске приложения, до того как сервер начнёт слушать порт
+                health = await wait_for_health(client, f'{base}{bot_env.HEALTH_PATH}')
+                assert health['status'] == 'ok'
+
+                webhook = f'{base}{bot_env.WEBHOOK_PATH}'
+                async with client.post(webhook, json=update(1, 'forged')) as response:
+                    assert response.status == 401
+                headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+                async with client.post(webhook, json=update(2, 'hello'), headers=headers) as response:
+                    assert response.status == 200
+                await wait_for(lambda: received)
+
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.wait_for(server, 5)
+        finally:
+            server.cancel()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    assert received == ['hello']
+    assert shutdowns == [True]